@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+from psycopg2 import extras
+
+
+class Checkpoint(object):
+  """How far an import got, stored in import.checkpoint under name.
+
+  position is importer specific (pages or lines read, streams done), offset is the matching position
+  in the compressed dump and data holds anything else the importer needs to carry over. save() only
+  executes the update, so it becomes durable together with the rows it describes when the importer
+  commits.
+  """
+
+  def __init__(self, cursor, name):
+    self._cursor = cursor
+    self.name = name
+    cursor.execute('CREATE SCHEMA IF NOT EXISTS import;')
+    cursor.execute('CREATE TABLE IF NOT EXISTS import.checkpoint ('
+                   '    name TEXT PRIMARY KEY,'
+                   '    position BIGINT NOT NULL,'
+                   '    byte_offset BIGINT,'
+                   '    data JSONB,'
+                   '    updated TIMESTAMP NOT NULL DEFAULT now()'
+                   ')')
+    cursor.execute('SELECT position, byte_offset, data FROM import.checkpoint WHERE name = %s', (name,))
+    row = cursor.fetchone()
+    self.position, self.offset, self.data = row or (0, 0, None)
+    self.data = self.data or {}
+
+  def save(self, position, offset=None, data=None):
+    self.position, self.offset, self.data = position, offset, data or {}
+    self._cursor.execute('INSERT INTO import.checkpoint (name, position, byte_offset, data, updated) '
+                         'VALUES (%s, %s, %s, %s, now()) '
+                         'ON CONFLICT (name) DO UPDATE SET position = EXCLUDED.position, '
+                         'byte_offset = EXCLUDED.byte_offset, data = EXCLUDED.data, updated = EXCLUDED.updated',
+                         (self.name, position, offset, extras.Json(self.data)))
+
+  def clear(self):
+    self.position, self.offset, self.data = 0, 0, {}
+    self._cursor.execute('DELETE FROM import.checkpoint WHERE name = %s', (self.name,))
+
+
+class Watermark(object):
+  """Tracks batches that are numbered in order but may complete out of order. position is the one passed
+  for the last batch that completed along with every batch before it."""
+
+  def __init__(self):
+    self._next = 0
+    self._done = {}
+    self.position = None
+
+  def done(self, seq, position):
+    self._done[seq] = position
+    while self._next in self._done:
+      self.position = self._done.pop(self._next)
+      self._next += 1
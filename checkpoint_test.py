@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import unittest
+
+from checkpoint import Watermark
+
+
+class TestCheckpoint(unittest.TestCase):
+  def test_watermark(self):
+    watermark = Watermark()
+    watermark.done(1, 'b')
+    self.assertIsNone(watermark.position)
+    watermark.done(0, 'a')
+    self.assertEqual(watermark.position, 'b')
+    watermark.done(3, 'd')
+    self.assertEqual(watermark.position, 'b')
+    watermark.done(2, 'c')
+    self.assertEqual(watermark.position, 'd')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,81 @@
+#!/bin/python3
+
+import argparse
+import xml.sax
+
+from dump_reader import DumpReader
+from import_wikipedia import WikiXmlHandler, WIKIPEDIA_COLUMNS, extract_page, extract_page_fast, scan_wikitext
+
+COMPARED_COLUMNS = ('infobox', 'templates', 'categories', 'general')
+
+
+def compare_page(page_id, title, text, revision_id=None, sha1=None):
+  """Return the columns for which the fast extractor disagrees with the mwparserfromhell one."""
+  expected = extract_page(page_id, title, text)
+  actual = extract_page_fast(page_id, title, text)
+  if expected is None or actual is None:
+    return [] if expected == actual else ['row']
+  diffs = []
+  for column, e, a in zip(WIKIPEDIA_COLUMNS, expected, actual):
+    if column in COMPARED_COLUMNS:
+      # templates, categories and general are sets stored as lists
+      if isinstance(e, list):
+        e, a = sorted(e), sorted(a)
+      if e != a:
+        diffs.append(column)
+  return diffs
+
+
+class Comparison(object):
+  """Writer for WikiXmlHandler(extract=None) that compares both extractors on every page it gets."""
+  def __init__(self, limit=None, verbose=True):
+    self._limit = limit
+    self._verbose = verbose
+    self.pages = 0
+    self.scanned = 0
+    self.mismatches = []
+
+  def write(self, page):
+    if self._limit and self.pages >= self._limit:
+      raise StopIteration
+    self.pages += 1
+    if scan_wikitext(page[2]) is not None:
+      self.scanned += 1
+    diffs = compare_page(*page)
+    if diffs:
+      self.mismatches.append((page[1], diffs))
+      if self._verbose:
+        print('MISMATCH', page[1], diffs)
+
+  def close(self):
+    pass
+
+  def report(self):
+    print('pages: %d, handled by the scanner: %d (%.1f%%), mismatches: %d' % (
+        self.pages, self.scanned, 100.0 * self.scanned / max(self.pages, 1), len(self.mismatches)))
+
+
+def main(dump, limit):
+  comparison = Comparison(limit)
+  parser = xml.sax.make_parser()
+  parser.setContentHandler(WikiXmlHandler(comparison, extract=None, progress=False))
+  with DumpReader(dump, progress=True) as reader:
+    for chunk in reader.chunks():
+      try:
+        parser.feed(chunk)
+      except StopIteration:
+        break
+  comparison.report()
+  return comparison
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare the fast and the mwparserfromhell extractors on a wikipedia dump')
+  parser.add_argument('dump', type=str,
+                      help='BZipped wikipedia dump')
+  parser.add_argument('--limit', type=int, default=10000,
+                      help='number of pages to compare, 0 for all')
+
+  args = parser.parse_args()
+  if main(args.dump, args.limit).mismatches:
+    exit(1)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import io
+
+COPY_READ_SIZE = 1 << 16
+
+
+def copy_array(values):
+  """Format a python list as a postgres array literal (e.g. for TEXT[] columns)."""
+  return '{%s}' % ','.join(
+      'NULL' if v is None else '"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"')
+      for v in values)
+
+
+def copy_escape(value):
+  """Format a single value as a field in COPY's text format."""
+  if value is None:
+    return '\\N'
+  if isinstance(value, (list, tuple)):
+    value = copy_array(value)
+  else:
+    value = str(value)
+  return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyWriter(object):
+  """Buffers rows and streams them into a table using COPY ... FROM STDIN.
+
+  Rows are sent every batch_size rows and the transaction is committed once at least commit_every
+  rows were sent since the last commit. If unique names a column, rows with a value for that column
+  we've already written are dropped, like INSERT ... ON CONFLICT DO NOTHING would; seen can hold the
+  values already in the table. before_commit is called right before every commit, once everything
+  written so far has been sent, so progress can be recorded in the same transaction. merge is a statement
+  run after every COPY, e.g. to upsert rows from a staging table into their final place.
+  """
+
+  def __init__(self, cursor, conn, table, columns, batch_size=10000, commit_every=100000, unique=None,
+               seen=None, before_commit=None, merge=None):
+    self._cursor = cursor
+    self._conn = conn
+    self._sql = 'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns))
+    self._batch_size = batch_size
+    self._commit_every = commit_every
+    self._unique = columns.index(unique) if unique else None
+    self._seen = set(seen or ())
+    self.before_commit = before_commit
+    self._merge = merge
+    self._buffer = []
+    self._committed = 0
+    self.count = 0
+    self.dupes = 0
+
+  def write(self, row):
+    if self._unique is not None:
+      key = row[self._unique]
+      if key in self._seen:
+        self.dupes += 1
+        return False
+      self._seen.add(key)
+    self._buffer.append('\t'.join(copy_escape(v) for v in row))
+    self.count += 1
+    if len(self._buffer) >= self._batch_size:
+      self.flush()
+    return True
+
+  def flush(self):
+    if self._buffer:
+      self._buffer.append('')
+      self._cursor.copy_expert(self._sql, io.StringIO('\n'.join(self._buffer)), COPY_READ_SIZE)
+      if self._merge:
+        self._cursor.execute(self._merge)
+      self._buffer = []
+    if self.count - self._committed >= self._commit_every:
+      self.commit()
+
+  def commit(self):
+    if self.before_commit:
+      self.before_commit()
+    self._conn.commit()
+    self._committed = self.count
+
+  def close(self):
+    self.flush()
+    self.commit()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import unittest
+
+from copy_writer import CopyWriter, copy_array, copy_escape
+
+
+class FakeCursor():
+  def __init__(self):
+    self.copies = []
+
+  def copy_expert(self, sql, f, size=8192):
+    self.copies.append((sql, f.read()))
+
+
+class FakeConn():
+  def __init__(self):
+    self.commits = 0
+
+  def commit(self):
+    self.commits += 1
+
+
+class TestCopyWriter(unittest.TestCase):
+  def test_copy_escape(self):
+    self.assertEqual(copy_escape(None), '\\N')
+    self.assertEqual(copy_escape(12), '12')
+    self.assertEqual(copy_escape('a\tb\nc\\d'), 'a\\tb\\nc\\\\d')
+    self.assertEqual(copy_array(['x', 'say "hi"', None]), '{"x","say \\"hi\\"",NULL}')
+    self.assertEqual(copy_escape(['back\\slash']), '{"back\\\\\\\\slash"}')
+    self.assertEqual(copy_escape([]), '{}')
+
+  def test_batches_and_commits(self):
+    cursor = FakeCursor()
+    conn = FakeConn()
+    writer = CopyWriter(cursor, conn, 'import.t', ('id', 'title'), batch_size=2, commit_every=4, unique='title')
+    for i, title in enumerate(['a', 'b', 'a', 'c', 'd', 'e']):
+      writer.write((i, title))
+    self.assertEqual(writer.dupes, 1)
+    self.assertEqual(len(cursor.copies), 2)
+    self.assertEqual(cursor.copies[0], ('COPY import.t (id, title) FROM STDIN', '0\ta\n1\tb\n'))
+    self.assertEqual(conn.commits, 1)
+    writer.close()
+    self.assertEqual(cursor.copies[-1][1], '5\te\n')
+    self.assertEqual(conn.commits, 2)
+    self.assertEqual(writer.count, 5)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+
+from progressbar import ProgressBar, Bar, Percentage, FileTransferSpeed, AdaptiveETA
+
+CHUNK_SIZE = 1 << 20
+PROGRESS_EVERY = 10000
+
+# Decompressors to try in order of preference, per extension. The parallel ones come first.
+DECOMPRESSORS = {
+  '.bz2': (['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']),
+  '.gz': (['pigz', '-dc'], ['gzip', '-dc']),
+}
+OPENERS = {
+  '.bz2': bz2.open,
+  '.gz': gzip.open,
+}
+
+
+def find_decompressor(path):
+  """Return the command line of the best installed decompressor for path, or None if there is none."""
+  for command in DECOMPRESSORS.get(os.path.splitext(path)[1], ()):
+    if shutil.which(command[0]):
+      return command
+  return None
+
+
+class DumpReader(object):
+  """Reads a (compressed) dump in large chunks or by line.
+
+  Decompression runs in an external process when one is installed, preferring the parallel ones,
+  otherwise in python. The decompressor reads from our file descriptor, so its offset tells us how
+  far into the compressed file we are; that drives the progress bar and status().
+  """
+
+  def __init__(self, path, chunk_size=CHUNK_SIZE, progress=False):
+    self._file = open(path, 'rb')
+    self._chunk_size = chunk_size
+    self._process = None
+    self.size = os.fstat(self._file.fileno()).st_size
+    command = find_decompressor(path)
+    if command:
+      self._process = subprocess.Popen(command, stdin=self._file, stdout=subprocess.PIPE, bufsize=chunk_size)
+      self._out = self._process.stdout
+    else:
+      opener = OPENERS.get(os.path.splitext(path)[1])
+      self._out = opener(self._file) if opener else self._file
+    self._pbar = None
+    if progress:
+      self._pbar = ProgressBar(widgets=[Bar(), Percentage(), ' ', FileTransferSpeed(), ' ', AdaptiveETA()],
+                               maxval=self.size).start()
+
+  def tell(self):
+    """Number of compressed bytes consumed so far."""
+    return os.lseek(self._file.fileno(), 0, os.SEEK_CUR)
+
+  def status(self):
+    return '%.1f%%' % (100.0 * self.tell() / max(self.size, 1))
+
+  def _update(self):
+    if self._pbar:
+      self._pbar.update(min(self.tell(), self.size))
+
+  def chunks(self):
+    while True:
+      data = self._out.read(self._chunk_size)
+      if not data:
+        break
+      self._update()
+      yield data
+
+  def lines(self):
+    for idx, line in enumerate(self._out):
+      if idx % PROGRESS_EVERY == 0:
+        self._update()
+      yield line
+
+  def __iter__(self):
+    return self.lines()
+
+  def close(self):
+    self._out.close()
+    self._file.close()
+    if self._process and self._process.wait() not in (0, -13):
+      # -13 is SIGPIPE, which we get when we stop reading early
+      raise IOError('%s exited with %d' % (self._process.args[0], self._process.returncode))
+    if self._pbar:
+      self._pbar.finish()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import bz2
+import gzip
+import os
+import tempfile
+import unittest
+
+import dump_reader
+from dump_reader import DumpReader
+
+LINES = [('{"id": "Q%d", "labels": {}},\n' % i).encode('utf-8') for i in range(5000)]
+
+
+class TestDumpReader(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.bz2_path = os.path.join(self._tmp.name, 'dump.json.bz2')
+    with bz2.open(self.bz2_path, 'wb') as f:
+      f.writelines(LINES)
+    self.gz_path = os.path.join(self._tmp.name, 'dump.gz')
+    with gzip.open(self.gz_path, 'wb') as f:
+      f.writelines(LINES)
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def test_lines(self):
+    for path in self.bz2_path, self.gz_path:
+      with DumpReader(path) as reader:
+        self.assertEqual(list(reader), LINES)
+        self.assertEqual(reader.tell(), reader.size)
+        self.assertEqual(reader.status(), '100.0%')
+
+  def test_chunks(self):
+    with DumpReader(self.bz2_path, chunk_size=1000) as reader:
+      chunks = list(reader.chunks())
+    self.assertEqual(b''.join(chunks), b''.join(LINES))
+    self.assertTrue(all(len(chunk) == 1000 for chunk in chunks[:-1]))
+
+  def test_python_fallback(self):
+    decompressors = dump_reader.DECOMPRESSORS
+    dump_reader.DECOMPRESSORS = {}
+    try:
+      with DumpReader(self.bz2_path) as reader:
+        self.assertEqual(list(reader), LINES)
+    finally:
+      dump_reader.DECOMPRESSORS = decompressors
+
+
+if __name__ == '__main__':
+  unittest.main()
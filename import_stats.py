@@ -1,20 +1,28 @@
 #!/bin/python3
 
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import os
 import argparse
-import subprocess
 import datetime
 import calendar
 import random
 import psycopg2
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib
 
+from dump_reader import DumpReader
+
 # REMOTE_PATH = 'https://dumps.wikimedia.org/other/pagecounts-raw/%(year)04d/%(year)04d-%(month)02d/pagecounts-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
 REMOTE_PATH = 'https://dumps.wikimedia.org/other/pageviews/%(year)04d/%(year)04d-%(month)02d/pageviews-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
 LOCAL_PATH = 'pageviews-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
 
+FETCH_WORKERS = 4
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 60
+
 
 def setup_db(connection_string):
     conn = psycopg2.connect(connection_string)
@@ -27,7 +35,55 @@ def setup_db(connection_string):
     return conn, cursor
 
 
-def fetch_dumps(dump_dir, dumps_to_fetch):
+def make_session(workers=FETCH_WORKERS):
+    """A session that keeps a connection per worker open and retries failed requests with a backoff."""
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(session, remote_path, local_path):
+    """Stream remote_path to local_path. The download goes to a .part file that is renamed once it's complete,
+    so a file that exists is complete and skipped, and an interrupted download continues where it stopped
+    with a Range request. Returns whether local_path is there; dumps that don't exist are skipped."""
+    if os.path.isfile(local_path):
+        return True
+    part_path = local_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    with session.get(remote_path, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 404:
+            print('missing', remote_path)
+            return False
+        if response.status_code == 416:
+            # nothing past what we have, the .part was complete
+            os.replace(part_path, local_path)
+            return True
+        response.raise_for_status()
+        if response.status_code != 206:
+            # the server sent all of it
+            offset = 0
+        print('getting', local_path, 'from byte %d' % offset if offset else '')
+        with open(part_path, 'ab' if offset else 'wb') as fout:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                fout.write(chunk)
+    os.replace(part_path, local_path)
+    return True
+
+
+def fetch_all(paths, workers=FETCH_WORKERS, session=None):
+    """Fetch the (remote_path, local_path) pairs in paths, workers at a time over one pooled session. Returns the
+    local paths that are there."""
+    session = session or make_session(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        fetched = list(executor.map(lambda path: fetch(session, *path), paths))
+    return [local_path for (remote_path, local_path), ok in zip(paths, fetched) if ok]
+
+
+def fetch_dumps(dump_dir, dumps_to_fetch, workers=FETCH_WORKERS):
     # don't try anything in the last month, it might not be online yet
     last_date = datetime.datetime.today() - datetime.timedelta(30)
     year = last_date.year
@@ -37,55 +93,52 @@ def fetch_dumps(dump_dir, dumps_to_fetch):
         days = 366
     else:
         days = 365
+    paths = {}
     for i in range(dumps_to_fetch):
         local_path = None
         remote_path = None
-        while not local_path or os.path.isdir(local_path):
+        while not local_path or local_path in paths:
             random_day = last_date - datetime.timedelta(days=random.randint(1, days))
-            random_hour = random.randint(1, 24)
+            random_hour = random.randint(0, 23)
             d = {'year': random_day.year, 'month': random_day.month, 'day': random_day.day, 'hour': random_hour}
             remote_path = REMOTE_PATH % d
             local_path = os.path.join(dump_dir, LOCAL_PATH % d)
-        print('getting', local_path)
-        data = requests.get(remote_path).content
-        with open(local_path, 'wb') as fout:
-            fout.write(data)
+        paths[local_path] = remote_path
+    return fetch_all([(remote_path, local_path) for local_path, remote_path in paths.items()], workers)
 
 
-def fetch_dumps_days(dump_dir, start_date, days):
+def fetch_dumps_days(dump_dir, start_date, days, workers=FETCH_WORKERS):
     hour = datetime.timedelta(hours=1)
     last_date = datetime.datetime.strptime(start_date, '%Y%m%d') - hour
     print(last_date, last_date - hour)
+    paths = []
     for i in range(days * 24):
         d = {'year': last_date.year, 'month': last_date.month, 'day': last_date.day, 'hour': last_date.hour}
-        remote_path = REMOTE_PATH % d
-        local_path = os.path.join(dump_dir, LOCAL_PATH % d)
-        print('getting', local_path)
-        data = requests.get(remote_path).content
-        with open(local_path, 'wb') as fout:
-            fout.write(data)
+        paths.append((REMOTE_PATH % d, os.path.join(dump_dir, LOCAL_PATH % d)))
         last_date = last_date - hour
+    return fetch_all(paths, workers)
 
-def main(dump_dir, cursor, dumps_to_fetch, start_date):
+def main(dump_dir, cursor, dumps_to_fetch, start_date, workers=FETCH_WORKERS):
     if dumps_to_fetch > 0:
-        fetch_dumps_days(dump_dir, start_date, dumps_to_fetch)
+        fetch_dumps_days(dump_dir, start_date, dumps_to_fetch, workers)
 
     c = Counter()
     for fn in os.listdir(dump_dir):
         if fn.endswith('.gz'):
             print(fn)
             path = os.path.join(dump_dir, fn)
-            for line in subprocess.Popen(['zcat'], stdin=open(path, 'r'), stdout=subprocess.PIPE).stdout:
-                line = line.decode('utf-8')
-                if line.startswith('en '):
-                    bits = line.split(' ')
-                    _, wikipedia_id, count, size = bits
-                    if not ':' in wikipedia_id:
-                        try:
-                            title = urllib.parse.unquote(wikipedia_id).replace('_', ' ')
-                        except UnicodeDecodeError:
-                            continue
-                        c[title] += int(count)
+            with DumpReader(path) as reader:
+                for line in reader:
+                    line = line.decode('utf-8')
+                    if line.startswith('en '):
+                        bits = line.split(' ')
+                        _, wikipedia_id, count, size = bits
+                        if not ':' in wikipedia_id:
+                            try:
+                                title = urllib.parse.unquote(wikipedia_id).replace('_', ' ')
+                            except UnicodeDecodeError:
+                                continue
+                            c[title] += int(count)
     for k, v in c.items():
         try:
             cursor.execute("INSERT INTO wp.wikistats (title, viewcount) VALUES (%s, %s)", (k, v))
@@ -104,6 +157,8 @@ if __name__ == '__main__':
             help='randomly fetch this amount of dumps from the last year')
     parser.add_argument('start_date', type=str, help='YYYYMMDD formatted date to load stats to (last date)')
     parser.add_argument('dumps', type=str, help='directory where the downloaded page counts are stored')
+    parser.add_argument('--fetch_workers', type=int, default=FETCH_WORKERS,
+            help='download this many page count files at the same time')
 
     args = parser.parse_args()
     conn, cursor = setup_db(args.postgres)
@@ -111,7 +166,7 @@ if __name__ == '__main__':
     if not os.path.isdir(args.dumps):
         os.makedirs(args.dumps)
 
-    main(args.dumps, cursor, args.dumps_to_fetch, args.start_date)
+    main(args.dumps, cursor, args.dumps_to_fetch, args.start_date, args.fetch_workers)
 
     conn.commit()
 
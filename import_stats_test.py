@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+
+import import_stats
+
+CONTENT = bytes(range(256)) * 100
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+  """Serves CONTENT at every path but /missing, honouring Range unless the server says not to."""
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.server.requests.append((self.path, self.headers.get('Range')))
+    if self.path == '/missing':
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    start = 0
+    range_header = self.headers.get('Range')
+    if range_header and self.server.ranges:
+      start = int(range_header[len('bytes='):].rstrip('-'))
+      if start >= len(CONTENT):
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % len(CONTENT))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(CONTENT) - 1, len(CONTENT)))
+    else:
+      self.send_response(200)
+    self.send_header('Content-Length', str(len(CONTENT) - start))
+    self.end_headers()
+    self.wfile.write(CONTENT[start:])
+
+  def log_message(self, format, *args):
+    pass
+
+
+class TestFetch(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    self.server.requests = []
+    self.server.ranges = True
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.base_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self._tmp.cleanup()
+
+  def path(self, name):
+    return os.path.join(self._tmp.name, name)
+
+  def read(self, name):
+    with open(self.path(name), 'rb') as f:
+      return f.read()
+
+  def write(self, name, content):
+    with open(self.path(name), 'wb') as f:
+      f.write(content)
+
+  def test_fetch_all(self):
+    self.write('done', b'already here')
+    paths = [(self.base_url + name, self.path(name)) for name in ('a', 'missing', 'done', 'b')]
+    fetched = import_stats.fetch_all(paths, workers=2)
+    self.assertEqual(fetched, [self.path('a'), self.path('done'), self.path('b')])
+    self.assertEqual((self.read('a'), self.read('b'), self.read('done')), (CONTENT, CONTENT, b'already here'))
+    self.assertFalse(os.path.exists(self.path('missing')))
+    # complete files aren't requested again
+    self.assertEqual(sorted(path for path, range_header in self.server.requests), ['/a', '/b', '/missing'])
+
+  def test_resume(self):
+    self.write('a.part', CONTENT[:1000])
+    self.write('b.part', CONTENT)
+    session = import_stats.make_session(1)
+    self.assertTrue(import_stats.fetch(session, self.base_url + 'a', self.path('a')))
+    self.assertTrue(import_stats.fetch(session, self.base_url + 'b', self.path('b')))
+    self.assertEqual(self.server.requests, [('/a', 'bytes=1000-'), ('/b', 'bytes=%d-' % len(CONTENT))])
+    self.assertEqual((self.read('a'), self.read('b')), (CONTENT, CONTENT))
+    self.assertFalse(os.path.exists(self.path('a.part')))
+
+  def test_no_ranges(self):
+    self.server.ranges = False
+    self.write('a.part', b'garbage')
+    self.assertTrue(import_stats.fetch(import_stats.make_session(1), self.base_url + 'a', self.path('a')))
+    self.assertEqual(self.read('a'), CONTENT)
+
+
+if __name__ == '__main__':
+  unittest.main()
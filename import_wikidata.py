@@ -1,53 +1,191 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
+from collections import Counter, defaultdict
+import functools
 
 import argparse
-import subprocess
 import json
+import multiprocessing
 import os
+import pickle
 import re
+import tempfile
 
 import psycopg2
-from psycopg2 import extras
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+from checkpoint import Checkpoint, Watermark
+from copy_writer import CopyWriter
+from dump_reader import DumpReader
+from index_builder import IndexBuilder, Step, report_indexes
+from index_config import DEFAULT_INDEX_CONFIG, load_index_config
+from name_store import NAMES_FILE, NAMES_LOG, NameStore, NameStoreWriter, entity_key, entity_name, open_names
+import pipeline
+from projection import Projection
+from staging import STAGING_SCHEMA, TARGET_SCHEMA, publish, unlogged
+from typed_claims import (CLAIMS_COLUMNS, ENTITY_CLAIMS_COLUMNS, REFS_COLUMNS, compact_claims, entity_refs,
+                          typed_claims)
 
 DATE_PARSE_RE = re.compile(
     r'([-+]?[0-9]+)-([0-9][0-9])-([0-9][0-9])T([0-9][0-9]):([0-9][0-9]):([0-9][0-9])Z?')
 
+WIKIDATA_COLUMNS = ('wikipedia_id', 'title', 'wikidata_id', 'labels', 'sitelinks', 'description', 'properties')
+# tables derived from wikidata, filled while it's loaded
+DERIVED_COLUMNS = {
+  'geo': ('wikidata_id', 'geometry'),
+  'labels': ('wikidata_id', 'label'),
+  'instance': ('wikidata_id', 'instance_of'),
+  'claims': CLAIMS_COLUMNS,
+  'refs': REFS_COLUMNS,
+  'entity_claims': ENTITY_CLAIMS_COLUMNS,
+}
+
+# with --workers, lines are passed between processes in batches of this size; each queue holds at most
+# QUEUE_DEPTH batches per worker.
+LINE_BATCH = 1000
+QUEUE_DEPTH = 4
+
+# only entities with an english wikipedia page are stored. Lines without this can't qualify and in the second
+# pass we just pick their revision out of them instead of decoding them.
+ENWIKI_SITELINK = b'"enwiki"'
+RE_LASTREVID = re.compile(rb'"lastrevid":\s*([0-9]+)')
+
+KEEP_ALL = Projection()
+
+
+# tables setup_db and the post processing in __main__ create, in the order they're built
+TABLES = ['wikidata', 'id2name', 'geo', 'labels', 'instance', 'claims', 'refs', 'entity_claims', 'stale']
+
+# with integer ids (Q42 -> 42, P31 -> -31, see name_store.entity_key) the tables get a view that shows them
+# as text again, named after the table with this suffix
+TEXT_VIEW_SUFFIX = '_text'
+TEXT_ID_COLUMNS = {'id2name': ('id', ), 'refs': ('wikidata_id', 'ref')}
+TEXT_ID = '''CASE WHEN "%(column)s" < 0 THEN 'P' || -"%(column)s" ELSE 'Q' || "%(column)s" END AS "%(column)s"'''
+
 
-def setup_db(connection_string):
+def setup_db(connection_string, resume=False, schema=TARGET_SCHEMA, index_config=DEFAULT_INDEX_CONFIG,
+             integer_ids=False):
+  """The constraints on wikidata, id2name and the tables derived from wikidata are added by the post_load_steps,
+  main() and the name store already skip duplicates. wikidata gets the generated columns of index_config. With
+  integer_ids the entity ids are stored as BIGINT, see create_text_views."""
   conn = psycopg2.connect(connection_string)
   cursor = conn.cursor()
-  cursor.execute('CREATE SCHEMA IF NOT EXISTS import;')
-  cursor.execute('DROP TABLE IF EXISTS import.wikidata;')
-  cursor.execute('CREATE TABLE import.wikidata ('
-                 '    wikipedia_id TEXT PRIMARY KEY,'
+  cursor.execute('CREATE SCHEMA IF NOT EXISTS %s;' % schema)
+  if resume:
+    return conn, cursor
+  id_type = 'BIGINT' if integer_ids else 'TEXT'
+  drop_text_views(cursor, schema)
+  cursor.execute('DROP TABLE IF EXISTS %s.wikidata;' % schema)
+  cursor.execute('CREATE %sTABLE %s.wikidata (' % (unlogged(schema), schema) +
+                 '    wikipedia_id TEXT,'
                  '    title TEXT,'
-                 '    wikidata_id TEXT,'
+                 '    wikidata_id %s,' % id_type +
                  '    description TEXT,'
                  '    labels JSONB,'
                  '    sitelinks JSONB,'
-                 '    properties JSONB, '
-                 '    CONSTRAINT wd_wikidata_id_unique UNIQUE (wikidata_id) '
+                 '    properties JSONB' +
+                 ''.join(',    ' + column for column in index_config.column_definitions()) +
                  ');')
-  cursor.execute('DROP TABLE IF EXISTS import.id2name;')
-  cursor.execute('CREATE TABLE import.id2name ('
-                 '    id TEXT PRIMARY KEY,'
-                 '    title TEXT,'
-                 '    CONSTRAINT id2name_wikidata_id UNIQUE (id)'
+  cursor.execute('DROP TABLE IF EXISTS %s.id2name;' % schema)
+  cursor.execute('CREATE %sTABLE %s.id2name (' % (unlogged(schema), schema) +
+                 '    id %s,' % id_type +
+                 '    title TEXT'
                  ');')
+  cursor.execute('DROP TABLE IF EXISTS %s.geo' % schema)
+  cursor.execute('CREATE %sTABLE %s.geo (' % (unlogged(schema), schema) +
+                 '    wikidata_id %s,' % id_type +
+                 '    geometry geometry(POINT, 4326)'
+                 ')')
+  cursor.execute('DROP TABLE IF EXISTS %s.labels' % schema)
+  cursor.execute('CREATE %sTABLE %s.labels (' % (unlogged(schema), schema) +
+                 '    wikidata_id %s,' % id_type +
+                 '    label TEXT'
+                 ')')
+  cursor.execute('DROP TABLE IF EXISTS %s.instance' % schema)
+  cursor.execute('CREATE %sTABLE %s.instance (' % (unlogged(schema), schema) +
+                 '    wikidata_id %s,' % id_type +
+                 '    instance_of TEXT'
+                 ')')
+  cursor.execute('DROP TABLE IF EXISTS %s.claims' % schema)
+  cursor.execute('CREATE %sTABLE %s.claims (' % (unlogged(schema), schema) +
+                 '    wikidata_id %s,' % id_type +
+                 '    property TEXT,'
+                 '    quantity DOUBLE PRECISION,'
+                 '    unit TEXT,'
+                 '    time TIMESTAMP,'
+                 '    precision SMALLINT'
+                 ')')
+  cursor.execute('DROP TABLE IF EXISTS %s.refs' % schema)
+  cursor.execute('CREATE %sTABLE %s.refs (' % (unlogged(schema), schema) +
+                 '    wikidata_id %s,' % id_type +
+                 '    ref %s' % id_type +
+                 ')')
+  # the compacted claims the properties were made from, for wd_updater to make them again when names change
+  cursor.execute('DROP TABLE IF EXISTS %s.entity_claims' % schema)
+  cursor.execute('CREATE %sTABLE %s.entity_claims (' % (unlogged(schema), schema) +
+                 '    wikidata_id %s,' % id_type +
+                 '    claims JSONB'
+                 ')')
+  # the rows wd_updater finds to refer to renamed entities
+  cursor.execute('DROP TABLE IF EXISTS %s.stale' % schema)
+  cursor.execute('CREATE %sTABLE %s.stale (wikidata_id %s PRIMARY KEY)' % (unlogged(schema), schema, id_type))
 
   conn.commit()
   return conn, cursor
 
 
+def drop_text_views(cursor, schema=TARGET_SCHEMA):
+  """Drop the views create_text_views made, they'd keep the tables from being dropped."""
+  for table in TABLES:
+    cursor.execute('DROP VIEW IF EXISTS %s.%s%s' % (schema, table, TEXT_VIEW_SUFFIX))
+
+
+def create_text_views(cursor, conn, schema=TARGET_SCHEMA):
+  """For tables stored with integer ids, create views with the same columns but the ids as text (Q42), for
+  queries written against those. Filtering on the id through a view can't use the index, join on the integer
+  in the table for that."""
+  for table in TABLES:
+    cursor.execute('SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s '
+                   'ORDER BY ordinal_position', (schema, table))
+    id_columns = TEXT_ID_COLUMNS.get(table, ('wikidata_id', ))
+    columns = [TEXT_ID % {'column': column} if column in id_columns else '"%s"' % column
+               for column, in cursor.fetchall()]
+    cursor.execute('CREATE VIEW %s.%s%s AS SELECT %s FROM %s.%s' % (
+        schema, table, TEXT_VIEW_SUFFIX, ', '.join(columns), schema, table))
+  conn.commit()
+
+
+def store_names(cursor, conn, id_name_map, schema=TARGET_SCHEMA, integer_ids=False):
+  """Fill id2name from the name store."""
+  cursor.execute('TRUNCATE %s.id2name' % schema)
+  writer = CopyWriter(cursor, conn, schema + '.id2name', ('id', 'title'))
+  for entity_id, name in id_name_map.items():
+    writer.write((entity_key(entity_id) if integer_ids else entity_id, name))
+  writer.close()
+  print('Stored', writer.count, 'names')
+
+
+def json_loads(data):
+  """orjson's loads when it's installed, falling back on json for what orjson refuses and json takes, like lone
+  surrogates ("\\ud800") and numbers out of float range (1e400)."""
+  if orjson:
+    try:
+      return orjson.loads(data)
+    except orjson.JSONDecodeError:
+      pass
+  return json.loads(data)
+
+
 def parse_wikidata(line):
 
-    line = line.decode("utf-8").strip()
-    if line and line[0] == '{':
-      if line[-1] == ',':
+    line = line.strip()
+    if line[:1] == b'{':
+      if line[-1:] == b',':
         line = line[:-1]
-      return json.loads(line)
+      return json_loads(line)
 
 
 def map_value(value, id_name_map):
@@ -89,113 +227,532 @@ def map_value(value, id_name_map):
   return None
 
 
-def main(dump, cursor, conn):
-  """We do two scans:
-     - first collect the id -> name / wikipedia title
-     - then store the actual objects with a json property.
-     The first step takes quite a bit of memory (5Gb) - could possibly be done using a temporary table in postgres.
+def read_entities(reader):
+  """Yield (line_no, entity) for every entity in the dump."""
+  line_no = 0
+  for line in reader:
+    line_no += 1
+    d = parse_wikidata(line)
+    if d:
+      yield line_no, d
+
+
+def map_claims(claims, id_name_map):
+  """Map the (compacted) claims of an entity to its properties, keyed on property name.
+
+  Properties are mapped in a way where we create lists as values for wiki entities if there is more
+  than one value. For other types, we always pick one value. If there is a preferred value, we'll
+  pick that one.
+  Mostly this does what you want. For filtering on colors for flags it alllows for the query:
+    SELECT title FROM wikidata WHERE properties @> '{"color": ["Green", "Red", "White"]}'
+  However, if you'd want all flags that have Blue in them, you'd have to check for just "Blue"
+  and also ["Blue"].
   """
-  maxrevid = 0
-  id_name_map = {}
-  if os.path.isfile('properties.json'):
-      print('loading properties from file')
-      id_name_map = json.load(open('properties.json'))
-  else:
-    c = 0
-    skip = 0
-    for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
-        d = parse_wikidata(line)
-        if not d:
-            print('Failed to parse', line[0])
-            continue
-        c += 1
-        if c % 1000 == 0:
-          print(c, skip)
-        if d.get('sitelinks') and d['sitelinks'].get('enwiki'):
-          value = d['sitelinks']['enwiki']['title']
-        elif d['labels'].get('en'):
-          value = id_name_map[d['id']] = d['labels']['en']['value']
-        else:
-          skip += 1
-          continue
-        id_name_map[d['id']] = value
-
-    json.dump(id_name_map, open('properties.json', 'w'))
+  properties = {}
+  for prop_id, values in claims.items():
+    prop_name = id_name_map.get(prop_id)
+    if prop_name:
+      ranks = defaultdict(list)
+      for rank, datavalue in values:
+        data_value = map_value(datavalue, id_name_map)
+        if data_value:
+          lst = ranks[rank]
+          if datavalue.get('type') != 'wikibase-entityid':
+            del lst[:]
+          lst.append(data_value)
+      for r in 'preferred', 'normal', 'depricated':
+        value = ranks[r]
+        if value:
+          if len(value) == 1:
+            value = value[0]
+          else:
+            value = sorted(value)
+          properties[prop_name] = value
+          break
+  return properties
 
-  wp_ids = set()
+
+def make_record(d, projection=KEEP_ALL):
+  """The columns to store for d with its claims still unresolved, or None if d has no english wikipedia
+  page or label. projection picks the labels and sitelinks to keep."""
+  wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
+  title = d['labels'].get('en', {}).get('value')
+  if not (wikipedia_id and title):
+    return None
+  label_map = projection.labels(d.get('labels'))
+  sitelink_map = projection.sitelinks(d.get('sitelinks'))
+  labels = [label['value'] for label in label_map.values()]
+  sitelinks = [sitelink['title'] for sitelink in sitelink_map.values()]
+  description = d['descriptions'].get('en', {}).get('value')
+  properties = projection.properties(label_map, sitelink_map)
+  return wikipedia_id, title, d['id'], labels, sitelinks, description, properties, compact_claims(d['claims'])
+
+
+def resolve_record(record, id_name_map):
+  """The row to store for a record from make_record, with its claims mapped to properties."""
+  wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, claims = record
+  properties.update(map_claims(claims, id_name_map))
+  return wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties
+
+
+def ewkt_point(coordinate):
+  """A coordinate location as mapped by map_value in EWKT, or None if it lacks a latitude or longitude."""
+  if not isinstance(coordinate, dict) or coordinate.get('lat') is None or coordinate.get('lng') is None:
+    return None
+  return 'SRID=4326;POINT(%s %s)' % (coordinate['lng'], coordinate['lat'])
+
+
+def entity_rows(wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties):
+  """The wikidata row ready for COPY, and the rows derived from it for geo, labels and instance. instance_of
+  holds the lowercased 'instance of' names as a json list."""
+  row = (wikipedia_id, title, wikidata_id, json.dumps(labels), json.dumps(sitelinks), description,
+         json.dumps(properties))
+  derived = {'geo': [], 'labels': [], 'instance': []}
+  if 'coordinate location' in properties:
+    derived['geo'].append((wikidata_id, ewkt_point(properties['coordinate location'])))
+  seen = set()
+  for label in labels:
+    if label not in seen:
+      seen.add(label)
+      derived['labels'].append((wikidata_id, label))
+  instance_of = properties.get('instance of')
+  if isinstance(instance_of, str):
+    instance_of = [instance_of]
+  if isinstance(instance_of, list):
+    derived['instance'].append((wikidata_id, json.dumps([name.lower() for name in instance_of], ensure_ascii=False)))
+  return row, derived
+
+
+def record_rows(record, id_name_map):
+  """entity_rows for a record from make_record, with the rows for the claims, refs and entity_claims tables
+  added to the derived ones."""
+  row, derived = entity_rows(*resolve_record(record, id_name_map))
+  derived['claims'] = typed_claims(record[2], record[7])
+  derived['refs'] = entity_refs(record[2], record[7])
+  derived['entity_claims'] = [(record[2], json.dumps(record[7]))]
+  return row, derived
+
+
+class EntityWriter(object):
+  """Writes what entity_rows returns: COPYs the wikidata rows and the rows derived from them. Like a
+  CopyWriter on wikidata, rows whose wikipedia_id was written before are dropped, along with their derived
+  rows. The derived rows are sent whenever wikidata commits, so a checkpoint saved in before_commit covers
+  them too; flush() sends everything without committing. With integer_ids the wikidata_ids are written as
+  integers, for tables setup_db made with integer_ids."""
+
+  def __init__(self, cursor, conn, schema, batch_size=1000, commit_every=10000, seen=None, before_commit=None,
+               integer_ids=False):
+    self._before_commit = before_commit
+    self._integer_ids = integer_ids
+    self._derived = {table: CopyWriter(cursor, conn, '%s.%s' % (schema, table), columns, batch_size=batch_size,
+                                       commit_every=float('inf'))
+                     for table, columns in DERIVED_COLUMNS.items()}
+    self.wikidata = CopyWriter(cursor, conn, schema + '.wikidata', WIKIDATA_COLUMNS, batch_size=batch_size,
+                               commit_every=commit_every, unique='wikipedia_id', seen=seen,
+                               before_commit=self._flush_derived)
+
+  def _flush_derived(self):
+    for writer in self._derived.values():
+      writer.flush()
+    if self._before_commit:
+      self._before_commit()
+
+  def write(self, row, derived):
+    if self._integer_ids:
+      key = entity_key(row[2])
+      row = row[:2] + (key,) + row[3:]
+      derived = {table: [(key,) + derived_row[1:] for derived_row in rows] for table, rows in derived.items()}
+      if 'refs' in derived:
+        derived['refs'] = [(key, entity_key(ref)) for _, ref in derived['refs']]
+    if not self.wikidata.write(row):
+      return False
+    for table, rows in derived.items():
+      for derived_row in rows:
+        self._derived[table].write(derived_row)
+    return True
+
+  def flush(self):
+    for writer in [self.wikidata] + list(self._derived.values()):
+      writer.flush()
+
+  def close(self):
+    self.wikidata.close()
+
+
+class Spool(object):
+  """Records pickled one after the other into an anonymous file in directory, to be read back once.
+  Quacks enough like a DumpReader for store_records."""
+
+  def __init__(self, directory=None):
+    self._file = tempfile.TemporaryFile(dir=directory)
+    self.count = 0
+
+  def write(self, record):
+    pickle.dump(record, self._file, pickle.HIGHEST_PROTOCOL)
+    self.count += 1
+
+  def __iter__(self):
+    self._size = self._file.tell()
+    self._file.seek(0)
+    while True:
+      try:
+        yield pickle.load(self._file)
+      except EOFError:
+        return
+
+  def tell(self):
+    # there's no offset in the dump that goes with a position in the spool
+    return None
+
+  def status(self):
+    return '%2.1f%%' % (100.0 * self._file.tell() / max(self._size, 1))
+
+  def close(self):
+    self._file.close()
+
+
+def read_names(dump):
+  """First pass: collect the id -> name map."""
+  id_name_map = NameStoreWriter()
   c = 0
-  rec = 0
-  dupes = 0
-  for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
-    d = parse_wikidata(line)
-    if not d:
-        continue
+  skip = 0
+  reader = DumpReader(dump)
+  for line_no, d in read_entities(reader):
+    c += 1
+    if c % 1000 == 0:
+      print(c, skip, reader.status())
+    name = entity_name(d)
+    if name:
+      id_name_map[d['id']] = name
+    else:
+      skip += 1
+  reader.close()
+  return id_name_map
+
+
+def save_names(names):
+  """Write names as the name store and open it. Names the updates of an older import logged don't apply."""
+  names.save(NAMES_FILE)
+  if os.path.isfile(NAMES_LOG):
+    os.remove(NAMES_LOG)
+  return NameStore(NAMES_FILE)
+
+
+def scan_dump(dump, spool, projection=KEEP_ALL):
+  """Single pass: collect the id -> name map while spooling the record of every entity we'll store, with
+  the line it came from and its revision. Returns the map and the highest revision in the dump."""
+  id_name_map = NameStoreWriter()
+  maxrevid = 0
+  c = 0
+  reader = DumpReader(dump)
+  for line_no, d in read_entities(reader):
+    c += 1
+    if c % 1000 == 0:
+      print(c, spool.count, reader.status())
+    name = entity_name(d)
+    if name:
+      id_name_map[d['id']] = name
     lastrevid = int(d.get('lastrevid', 0))
     maxrevid = max(lastrevid, maxrevid)
+    record = make_record(d, projection)
+    if record:
+      spool.write((line_no, lastrevid, record))
+  reader.close()
+  return id_name_map, maxrevid
+
+
+def decode_line(item, prefilter=True, stats=None, projection=KEEP_ALL):
+  """(line_no, line) -> (line_no, lastrevid, record) for the second pass, None for lines without an entity.
+  With prefilter lines that can't have a record aren't decoded. stats counts the lines decoded and
+  prefiltered."""
+  line_no, line = item
+  if prefilter and ENWIKI_SITELINK not in line:
+    match = RE_LASTREVID.search(line)
+    if match:
+      if stats is not None:
+        stats['prefiltered'] += 1
+      return line_no, int(match.group(1)), None
+  d = parse_wikidata(line)
+  if d:
+    if stats is not None:
+      stats['decoded'] += 1
+    return line_no, int(d.get('lastrevid', 0)), make_record(d, projection)
+  return None
+
+
+def dump_records(reader, skip_lines=0, prefilter=True, stats=None, projection=KEEP_ALL):
+  """Second pass: yield (line_no, lastrevid, record) for every entity in the dump after the first skip_lines
+  lines."""
+  for line_no, line in enumerate(reader, 1):
+    if line_no <= skip_lines:
+      # the bzip2 dump isn't seekable, but skipping lines without decoding them is cheap
+      continue
+    item = decode_line((line_no, line), prefilter, stats, projection)
+    if item:
+      yield item
+
+
+def store_records(records, reader, cursor, conn, id_name_map, checkpoint=None, schema=TARGET_SCHEMA, wp_ids=None,
+                  maxrevid=0, stats=None, integer_ids=False):
+  """Resolve the claims of records against id_name_map and insert them. Every 10000 records the transaction
+  is committed, along with a checkpoint of the line that was reached. Returns the highest revision seen.
+  stats, as filled by dump_records, is printed along with the progress."""
+  # There are some duplicate wikipedia_id's in there. We could make wikidata_id the primary key
+  # but that doesn't fix the underlying dupe. The writer skips them.
+  writer = EntityWriter(cursor, conn, schema, commit_every=float('inf'), seen=wp_ids, integer_ids=integer_ids)
+  c = 0
+  line_no = 0
+  for line_no, lastrevid, record in records:
     c += 1
     if c % 1000 == 0:
-      print(c, rec, dupes)
+      print(c, writer.wikidata.count, writer.wikidata.dupes, dict(stats or {}), reader.status())
     if c % 10000 == 0:
+      writer.flush()
+      if checkpoint:
+        checkpoint.save(line_no - 1, reader.tell(), {'maxrevid': maxrevid})
       conn.commit()
+    maxrevid = max(lastrevid, maxrevid)
+    if record:
+      writer.write(*record_rows(record, id_name_map))
+  writer.flush()
+  if checkpoint:
+    checkpoint.save(line_no, reader.tell(), {'maxrevid': maxrevid})
+  conn.commit()
+  return maxrevid
+
 
-    labels = [d['labels'][x]['value'] for x in d.get('labels', {})]
-    sitelinks = [d.get('sitelinks')[x]['title']
-                 for x in d.get('sitelinks', {})]
-
-    wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
-    title = d['labels'].get('en', {}).get('value')
-    description = d['descriptions'].get('en', {}).get('value')
-    wikidata_id = d['id']
-    properties = {}
-    properties['sitelinks'] = d.get('sitelinks')
-    properties['labels'] = d.get('labels')
-
-    if wikipedia_id and title:
-      # There are some duplicate wikipedia_id's in there. We could make wikidata_id the primary key
-      # but that doesn't fix the underlying dupe
-      if wikipedia_id in wp_ids:
-        dupes += 1
+def map_entities(batches, results, names_path, decode=None):
+  """Worker process: turns batches of (line_no, lastrevid, record) - or whatever decode turns into those -
+  into rows ready for COPY by an EntityWriter, until it gets a None. The name store is memory mapped, so all
+  workers share one copy of it in the page cache. decode gets a Counter to count what it did with the batch in."""
+  id_name_map = NameStore(names_path)
+  for seq, position, batch in iter(batches.get, None):
+    rows = []
+    maxrevid = 0
+    stats = Counter()
+    for item in batch:
+      if decode:
+        item = decode(item, stats=stats)
+      if not item:
         continue
-      wp_ids.add(wikipedia_id)
-      # Properties are mapped in a way where we create lists as values for wiki entities if there is more
-      # than one value. For other types, we always pick one value. If there is a preferred value, we'll
-      # pick that one.
-      # Mostly this does what you want. For filtering on colors for flags it alllows for the query:
-      #   SELECT title FROM wikidata WHERE properties @> '{"color": ["Green", "Red", "White"]}'
-      # However, if you'd want all flags that have Blue in them, you'd have to check for just "Blue"
-      # and also ["Blue"].
-      for prop_id, claims in d['claims'].items():
-        prop_name = id_name_map.get(prop_id)
-        if prop_name:
-          ranks = defaultdict(list)
-          for claim in claims:
-            mainsnak = claim.get('mainsnak')
-            if mainsnak:
-              data_value = map_value(mainsnak.get('datavalue'), id_name_map)
-              if data_value:
-                lst = ranks[claim['rank']]
-                if mainsnak['datavalue'].get('type') != 'wikibase-entityid':
-                  del lst[:]
-                lst.append(data_value)
-          for r in 'preferred', 'normal', 'depricated':
-            value = ranks[r]
-            if value:
-              if len(value) == 1:
-                value = value[0]
-              else:
-                value = sorted(value)
-              properties[prop_name] = value
-              break
-
-      rec += 1
-      cursor.execute('INSERT INTO import.wikidata (wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                     (wikipedia_id, title, wikidata_id, extras.Json(labels), extras.Json(sitelinks), description, extras.Json(properties)))
+      line_no, lastrevid, record = item
+      maxrevid = max(lastrevid, maxrevid)
+      if record:
+        rows.append(record_rows(record, id_name_map))
+    results.put((seq, position, maxrevid, rows, stats))
+  id_name_map.close()
+  results.put(None)
 
+
+def write_entities(results, workers, connection_string, schema, checkpoint_name, resume, maxrevid, integer_ids=False,
+                   commit_every=10000):
+  """Writer process: COPYs the rows from the workers until each of them is done. As in import_wikipedia,
+  batches arrive out of order and the checkpoint is the position of the last batch stored along with all
+  batches before it. A resumed import skips the wikipedia_ids already in the table."""
+  conn = psycopg2.connect(connection_string)
+  cursor = conn.cursor()
+  checkpoint = Checkpoint(cursor, checkpoint_name)
+  watermark = Watermark()
+  seen = None
+  if resume:
+    cursor.execute('SELECT wikipedia_id FROM %s.wikidata' % schema)
+    seen = set(wikipedia_id for wikipedia_id, in cursor)
+
+  def save_checkpoint():
+    if watermark.position:
+      checkpoint.save(*watermark.position, data={'maxrevid': maxrevid})
+
+  writer = EntityWriter(cursor, conn, schema, commit_every=commit_every, seen=seen, before_commit=save_checkpoint,
+                        integer_ids=integer_ids)
+  stats = Counter()
+  done = 0
+  while done < workers:
+    message = results.get()
+    if message is None:
+      done += 1
+      continue
+    seq, position, batch_maxrevid, rows, batch_stats = message
+    maxrevid = max(batch_maxrevid, maxrevid)
+    stats.update(batch_stats)
+    for row, derived in rows:
+      writer.write(row, derived)
+    watermark.done(seq, position)
+  writer.close()
+  conn.close()
+  print('Stored', writer.wikidata.count, 'records, skipped', writer.wikidata.dupes, 'duplicates', dict(stats))
+  write_maxrevid(maxrevid)
+
+
+def store_parallel(items, reader, connection_string, workers, checkpoint_name, schema=TARGET_SCHEMA, resume=False,
+                   maxrevid=0, decode=None, integer_ids=False):
+  """Store items - raw (line_no, line) from the dump with decode_line or records from a spool - using a pool of
+  workers that decode and map them and a writer process. The queues are bounded so a slow stage blocks
+  the ones feeding it; if the writer fails, so does this (see pipeline.put)."""
+  batches = multiprocessing.Queue(maxsize=workers * QUEUE_DEPTH)
+  results = multiprocessing.Queue(maxsize=workers * QUEUE_DEPTH)
+  mappers = [multiprocessing.Process(target=map_entities, args=(batches, results, NAMES_FILE, decode))
+             for _ in range(workers)]
+  writer = multiprocessing.Process(target=write_entities,
+                                   args=(results, workers, connection_string, schema, checkpoint_name, resume,
+                                         maxrevid, integer_ids))
+  for process in mappers + [writer]:
+    process.start()
+
+  seq = 0
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= LINE_BATCH:
+      pipeline.put(batches, (seq, (item[0], reader.tell()), batch), writer, mappers)
+      seq += 1
+      batch = []
+      if seq % 100 == 0:
+        print(seq * LINE_BATCH, reader.status())
+  if batch:
+    pipeline.put(batches, (seq, (batch[-1][0], reader.tell()), batch), writer, mappers)
+  for _ in mappers:
+    pipeline.put(batches, None, writer, mappers)
+  pipeline.join(writer, mappers)
+
+
+def main(dump, cursor, conn, checkpoint=None, schema=TARGET_SCHEMA, single_pass=False, spool_dir=None, workers=0,
+         connection_string=None, prefilter=True, projection=KEEP_ALL, integer_ids=False):
+  """We do two scans:
+     - first collect the id -> name / wikipedia title
+     - then store the actual objects with a json property.
+     The first step is cached in a name store (names.bin, see name_store.py), which is memory mapped rather than
+     loaded. A properties.json left by an older import is converted. If a checkpoint is given, the second step
+     records how many lines it got through with every commit and skips those lines when the checkpoint isn't empty.
+
+     With single_pass and no name store yet, the dump is only decompressed once: the records to store are
+     spooled to a file in spool_dir with their claims unresolved and stored from there once the map is complete.
+     The checkpoints still count lines in the dump, so a resumed import reads the dump with the cached map.
+
+     With workers, the storing step decodes and maps entities in that many processes and a separate process
+     writes them to connection_string. This needs a checkpoint.
+
+     With prefilter the second pass doesn't decode lines that can't hold an entity with an english wikipedia
+     page. orjson is used to decode the json when it's installed.
+
+     projection is saved next to the name store, for the updates to use as well. integer_ids should match the
+     tables setup_db created.
+  """
+  print('decoding json with', 'orjson' if orjson else 'json')
+  projection.save()
+  maxrevid = 0
+  id_name_map = open_names()
+  if id_name_map is not None:
+    print('loaded', len(id_name_map), 'names from file')
+  elif single_pass and not (checkpoint and checkpoint.position):
+    spool = Spool(spool_dir)
+    names, maxrevid = scan_dump(dump, spool, projection)
+    id_name_map = save_names(names)
+    # the store is memory mapped, the writer's arrays aren't needed while storing
+    del names
+    print('Storing', spool.count, 'records')
+    if workers:
+      store_parallel(spool, spool, connection_string, workers, checkpoint.name, schema, maxrevid=maxrevid,
+                     integer_ids=integer_ids)
+    else:
+      maxrevid = store_records(spool, spool, cursor, conn, id_name_map, checkpoint, schema, maxrevid=maxrevid,
+                               integer_ids=integer_ids)
+      write_maxrevid(maxrevid)
+    spool.close()
+    return
+  else:
+    id_name_map = save_names(read_names(dump))
+
+  skip_lines = 0
+  if checkpoint and checkpoint.position:
+    skip_lines = checkpoint.position
+    maxrevid = checkpoint.data.get('maxrevid', 0)
+  if workers:
+    if skip_lines:
+      print('Resuming after line', skip_lines)
+    reader = DumpReader(dump)
+    lines = ((line_no, line) for line_no, line in enumerate(reader, 1) if line_no > skip_lines)
+    store_parallel(lines, reader, connection_string, workers, checkpoint.name, schema, skip_lines > 0, maxrevid,
+                   functools.partial(decode_line, prefilter=prefilter, projection=projection), integer_ids)
+    reader.close()
+    return
+
+  wp_ids = set()
+  if skip_lines:
+    cursor.execute('SELECT wikipedia_id FROM %s.wikidata' % schema)
+    wp_ids = set(wikipedia_id for wikipedia_id, in cursor)
+    print('Resuming after line', skip_lines, 'with', len(wp_ids), 'records')
+  reader = DumpReader(dump)
+  stats = Counter()
+  maxrevid = store_records(dump_records(reader, skip_lines, prefilter, stats, projection), reader, cursor, conn, id_name_map,
+                           checkpoint, schema, wp_ids, maxrevid, stats, integer_ids)
+  print('Lines', dict(stats))
+  reader.close()
+  write_maxrevid(maxrevid)
+
+
+def write_maxrevid(maxrevid):
   # save max rev id as it's going to be used by update script
   with open('maxrevid.txt', 'w') as f:
       f.write(str(maxrevid))
 
 
+def post_load_steps(schema=TARGET_SCHEMA, maintenance_work_mem=None, index_config=DEFAULT_INDEX_CONFIG):
+  """Steps for IndexBuilder: the indexes on wikidata, including those index_config asks for, and on the tables
+  derived from it, which main() fills along with wikidata. Constraint indexes are built alongside the others
+  and attached once everything else is done, since ALTER TABLE locks out every other step reading the table."""
+  steps = [
+    Step('wikidata_pkey', 'CREATE UNIQUE INDEX wikidata_pkey ON %s.wikidata(wikipedia_id)' % schema),
+    Step('wd_wikidata_id_unique', 'CREATE UNIQUE INDEX wd_wikidata_id_unique ON %s.wikidata(wikidata_id)' % schema),
+    Step('wd_wikidata_wikidata_id', 'CREATE INDEX wd_wikidata_wikidata_id ON %s.wikidata(wikidata_id)' % schema),
+    Step('wd_wikidata_wikipedia_id',
+         '''CREATE INDEX wd_wikidata_wikipedia_id
+            ON %s.wikidata USING btree
+            (wikipedia_id COLLATE pg_catalog."default" ASC NULLS LAST)
+            TABLESPACE pg_default;''' % schema),
+    Step('wd_wikidata_labels', 'CREATE INDEX wd_wikidata_labels ON %s.wikidata USING gin(labels)' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_wikidata_sitelinks', 'CREATE INDEX wd_wikidata_sitelinks ON %s.wikidata USING gin(sitelinks)' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+
+    Step('id2name_pkey', 'CREATE UNIQUE INDEX id2name_pkey ON %s.id2name(id)' % schema),
+
+    Step('wd_geo_unique', 'CREATE UNIQUE INDEX wd_geo_unique ON %s.geo(wikidata_id)' % schema),
+    Step('wd_geo_geometry', 'CREATE INDEX wd_geo_geometry ON %s.geo USING gist (geometry) TABLESPACE pg_default;' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_label_unique', 'CREATE UNIQUE INDEX wd_label_unique ON %s.labels(wikidata_id, label)' % schema),
+    Step('wd_wikidata_labels_trgm',
+         'CREATE INDEX wd_wikidata_labels_trgm ON %s.labels USING gist (label COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_instance_unique', 'CREATE UNIQUE INDEX wd_instance_unique ON %s.instance(wikidata_id)' % schema),
+    Step('wd_wikidata_instance',
+         'CREATE INDEX wd_wikidata_instance ON %s.instance USING gist (instance_of COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_claims_wikidata_id', 'CREATE INDEX wd_claims_wikidata_id ON %s.claims(wikidata_id)' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_claims_quantity',
+         'CREATE INDEX wd_claims_quantity ON %s.claims(property, quantity) WHERE quantity IS NOT NULL' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_claims_time', 'CREATE INDEX wd_claims_time ON %s.claims(property, time) WHERE time IS NOT NULL' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_refs_ref', 'CREATE INDEX wd_refs_ref ON %s.refs(ref)' % schema, maintenance_work_mem=maintenance_work_mem),
+    Step('wd_refs_wikidata_id', 'CREATE INDEX wd_refs_wikidata_id ON %s.refs(wikidata_id)' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wd_entity_claims_pkey',
+         'CREATE UNIQUE INDEX wd_entity_claims_pkey ON %s.entity_claims(wikidata_id)' % schema),
+  ]
+  steps += index_config.steps(schema, maintenance_work_mem)
+  steps.append(Step('constraints', [
+    'ALTER TABLE %s.wikidata ADD PRIMARY KEY USING INDEX wikidata_pkey, ' % schema +
+    'ADD CONSTRAINT wd_wikidata_id_unique UNIQUE USING INDEX wd_wikidata_id_unique',
+    'ALTER TABLE %s.id2name ADD PRIMARY KEY USING INDEX id2name_pkey' % schema,
+    'ALTER TABLE %s.geo ADD CONSTRAINT wd_geo_unique UNIQUE USING INDEX wd_geo_unique' % schema,
+    'ALTER TABLE %s.labels ADD CONSTRAINT wd_label_unique UNIQUE USING INDEX wd_label_unique' % schema,
+    'ALTER TABLE %s.instance ADD CONSTRAINT wd_instance_unique UNIQUE USING INDEX wd_instance_unique' % schema,
+    'ALTER TABLE %s.entity_claims ADD PRIMARY KEY USING INDEX wd_entity_claims_pkey' % schema,
+  ], deps=[step.name for step in steps]))
+  return steps
+
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(
       description='Import wikidata into postgress')
@@ -203,75 +760,60 @@ if __name__ == '__main__':
                       help='postgres connection string')
   parser.add_argument('dump', type=str,
                       help='BZipped wikipedia dump')
+  parser.add_argument('--resume', action='store_true',
+                      help='continue an interrupted import from its last checkpoint instead of starting over')
+  parser.add_argument('--single_pass', action='store_true',
+                      help='when there\'s no name store yet, decompress the dump once and spool the entities '
+                           'to store to a temporary file instead of reading the dump a second time')
+  parser.add_argument('--spool_dir', type=str,
+                      help='directory for the --single_pass spool file, it needs room for all the stored entities')
+  parser.add_argument('--languages', type=str, nargs='+',
+                      help='only store labels and sitelinks in these languages, e.g. en de fr')
+  parser.add_argument('--no_property_copies', action='store_true',
+                      help='don\'t copy the labels and sitelinks into properties as well, they have their own columns')
+  parser.add_argument('--no_prefilter', action='store_true',
+                      help='decode every line in the second pass, also those without an enwiki sitelink')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='decode and map entities in this many worker processes, with a separate writer process')
+  parser.add_argument('--index_workers', type=int, default=4,
+                      help='build this many indexes and derived tables at the same time once the dump is loaded')
+  parser.add_argument('--maintenance_work_mem', type=str,
+                      help='maintenance_work_mem for each of the GIN and GiST index builds, e.g. 1GB')
+  parser.add_argument('--index_config', type=str,
+                      help='json file listing the property keys that get expression indexes or generated columns, '
+                           'see index_config.py; by default \'located in the administrative territorial entity\' '
+                           'is indexed along with all of properties')
+  parser.add_argument('--integer_ids', action='store_true',
+                      help='store entity ids as integers (Q42 -> 42, P31 -> -31) for smaller indexes and faster joins; '
+                           'views named <table>%s show them as text' % TEXT_VIEW_SUFFIX)
+  parser.add_argument('--staging', action='store_true',
+                      help='build unlogged tables in the %s schema and only replace the ones in import once '
+                           'they and their indexes are complete' % STAGING_SCHEMA)
 
   args = parser.parse_args()
-  conn, cursor = setup_db(args.postgres)
-
-  main(args.dump, cursor, conn)
-
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_wikidata_id ON import.wikidata(wikidata_id)')
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_properties ON import.wikidata USING gin(properties)')
-  cursor.execute('''CREATE INDEX wd_wikidata_properties_located_admin_btree
-                    ON wd.wikidata USING btree
-                    ((properties ->> 'located in the administrative territorial entity'::text)
-                    COLLATE pg_catalog."default" ASC NULLS LAST) TABLESPACE pg_default;''')
-  cursor.execute('''CREATE INDEX wd_wikidata_properties_located_admin_gin
-                    ON wd.wikidata USING gin
-                    ((properties -> 'located in the administrative territorial entity'::text))
-                    TABLESPACE pg_default;''')
-  cursor.execute('''CREATE INDEX wd_wikidata_wikipedia_id
-                    ON wd.wikidata USING btree
-                    (wikipedia_id COLLATE pg_catalog."default" ASC NULLS LAST)
-                    TABLESPACE pg_default;''')
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_labels ON import.wikidata USING gin(labels)')
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_sitelinks ON import.wikidata USING gin(sitelinks)')
-  conn.commit()
-  cursor.execute('DROP TABLE IF EXISTS import.geo')
-  cursor.execute('CREATE TABLE import.geo ('
-                 '    wikidata_id TEXT,'
-                 '    geometry geometry(POINT, 4326),'
-                 '    CONSTRAINT wd_geo_unique UNIQUE (wikidata_id)'
-                 ')')
-  cursor.execute('INSERT into import.geo (wikidata_id, geometry) '
-                 'SELECT wikidata_id, ST_SETSRID(ST_MAKEPOINT((properties->\'coordinate location\'->>\'lng\')::DECIMAL, '
-                 '(properties->\'coordinate location\'->>\'lat\')::DECIMAL), 4326) AS geometry '
-                 'FROM import.wikidata WHERE properties->\'coordinate location\' IS NOT NULL;'
-                 )
-  cursor.execute(
-      'CREATE INDEX wd_geo_geometry ON import.geo USING gist (geometry) TABLESPACE pg_default;')
-  conn.commit()
-  cursor.execute('DROP TABLE IF EXISTS import.labels')
-  cursor.execute('CREATE TABLE import.labels ('
-                 '    wikidata_id TEXT,'
-                 '    label TEXT,'
-                 '    CONSTRAINT wd_label_unique UNIQUE (wikidata_id, label)'
-                 ')'
-                 )
-  cursor.execute('INSERT INTO import.labels (wikidata_id, label) SELECT wikidata_id, jsonb_array_elements_text(labels) '
-                 'FROM import.wikidata ON CONFLICT DO NOTHING;'
-                 )
-  cursor.execute('CREATE INDEX wd_wikidata_labels_trgm ON import.labels USING gist (label COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;')
+  if args.staging and args.resume:
+    # unlogged tables are emptied when postgres restarts after a crash, the checkpoint wouldn't be
+    parser.error('--staging always builds from scratch and can\'t be combined with --resume')
+  schema = STAGING_SCHEMA if args.staging else TARGET_SCHEMA
+  index_config = load_index_config(args.index_config) if args.index_config else DEFAULT_INDEX_CONFIG
+  conn, cursor = setup_db(args.postgres, args.resume, schema, index_config, args.integer_ids)
+  checkpoint = Checkpoint(cursor, 'wikidata')
+  if not args.resume:
+    checkpoint.clear()
   conn.commit()
 
-  cursor.execute('DROP TABLE IF EXISTS import.instance')
-  cursor.execute('CREATE TABLE import.instance ('
-                 '    wikidata_id TEXT,'
-                 '    instance_of TEXT,'
-                 '    CONSTRAINT wd_instance_unique UNIQUE (wikidata_id)'
-                 ');'
-                 )
-  cursor.execute('INSERT INTO import.instance (wikidata_id, instance_of) '
-                 'SELECT wikidata_id, lower(properties->>\'instance of\')::jsonb '
-                 'FROM import.wikidata WHERE jsonb_typeof(properties->\'instance of\') = \'array\';'
-                 )
-  cursor.execute('INSERT INTO import.instance (wikidata_id, instance_of) '
-                 'SELECT wikidata_id, jsonb_build_array(lower(properties->>\'instance of\')) '
-                 'FROM import.wikidata WHERE jsonb_typeof(properties->\'instance of\') = \'string\';'
-                 )
-  cursor.execute('CREATE INDEX wd_wikidata_instance ON import.instance USING gist (instance_of COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;')
+  main(args.dump, cursor, conn, checkpoint, schema, args.single_pass, args.spool_dir, args.workers, args.postgres,
+       not args.no_prefilter, Projection(args.languages, not args.no_property_copies), args.integer_ids)
+  names = open_names()
+  store_names(cursor, conn, names, schema, args.integer_ids)
+  names.close()
 
   conn.commit()
+  timings = IndexBuilder(args.postgres, post_load_steps(schema, args.maintenance_work_mem, index_config),
+                         args.index_workers, checkpoint='wikidata-indexes', resume=args.resume).run()
+  if args.staging:
+    drop_text_views(cursor, TARGET_SCHEMA)
+    publish(cursor, conn, TABLES)
+  if args.integer_ids:
+    create_text_views(cursor, conn, TARGET_SCHEMA)
+  report_indexes(cursor, TARGET_SCHEMA, TABLES, timings)
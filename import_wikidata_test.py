@@ -1,18 +1,84 @@
 #!/usr/bin/env python
 
+import bz2
+from collections import Counter, defaultdict
 import json
+import os
+import queue
+import tempfile
 import unittest
-from import_wikidata import parse_wikidata, map_value
+from unittest import mock
+
+import import_wikidata
+from import_wikidata import parse_wikidata, map_value, main, map_entities, decode_line, create_text_views, store_names
+from name_store import NameStore, NameStoreWriter
+
+ENTITIES = [
+  {'id': 'Q1', 'lastrevid': 10, 'labels': {'en': {'value': 'Amsterdam'}, 'nl': {'value': 'Amsterdam'}},
+   'descriptions': {'en': {'value': 'capital'}}, 'sitelinks': {'enwiki': {'title': 'Amsterdam'}},
+   'claims': {'P31': [{'rank': 'normal', 'mainsnak': {'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q2'}}}},
+                      {'rank': 'normal', 'mainsnak': {'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q3'}}}}],
+              'P17': [{'rank': 'normal', 'mainsnak': {'datavalue': {'type': 'string', 'value': 'old'}}},
+                      {'rank': 'preferred', 'mainsnak': {'datavalue': {'type': 'string', 'value': 'new'}}},
+                      {'rank': 'normal', 'mainsnak': {'snaktype': 'novalue'}}],
+              'P625': [{'rank': 'normal', 'mainsnak': {'datavalue': {'type': 'globecoordinate',
+                                                                     'value': {'latitude': 52.37, 'longitude': 4.9}}}}],
+              'P571': [{'rank': 'normal', 'mainsnak': {'datavalue': {'type': 'time',
+                                                                    'value': {'time': '+1275-10-27T00:00:00Z', 'precision': 11}}}}]}},
+  {'id': 'Q2', 'lastrevid': 30, 'labels': {'en': {'value': 'city'}}, 'descriptions': {}, 'claims': {}},
+  {'id': 'Q3', 'lastrevid': 20, 'labels': {'en': {'value': 'capital'}}, 'descriptions': {},
+   'sitelinks': {'enwiki': {'title': 'Capital city'}}, 'claims': {}},
+  {'id': 'P31', 'lastrevid': 5, 'labels': {'en': {'value': 'instance of'}}, 'descriptions': {}, 'claims': {}},
+  {'id': 'P17', 'lastrevid': 5, 'labels': {'en': {'value': 'motto'}}, 'descriptions': {}, 'claims': {}},
+  {'id': 'P625', 'lastrevid': 5, 'labels': {'en': {'value': 'coordinate location'}}, 'descriptions': {}, 'claims': {}},
+]
+
+
+class FakeCursor():
+  def __init__(self):
+    self.copied = defaultdict(list)
+
+    self.statements = []
+    self.columns = []
+
+  def execute(self, sql, params=None):
+    self.statements.append(sql)
+
+  def fetchall(self):
+    return self.columns
+
+  def copy_expert(self, sql, f, size=8192):
+    table = sql.split()[1]
+    self.copied[table] += [line.split('\t') for line in f.read().splitlines()]
+
+
+class FakeConn():
+  def commit(self):
+    pass
 
 class TestImportWikidata(unittest.TestCase):
   def test_parse_wikidata(self):
     objs = [{'hello': 'world'}, {'all': 'ok?'}, {'or': ['something', 'with', 'more']}]
-    lines = ['[\n']
+    lines = [b'[\n']
     for idx, obj in enumerate(objs):
-      lines.append(json.dumps(obj) + (',' if idx < len(objs) -1 else '') + '\n')
-    lines.append(']\n')
-    parsed = list(parse_wikidata(lines))
-    self.assertEqual(parsed, objs)
+      lines.append(json.dumps(obj).encode('utf-8') + (b',' if idx < len(objs) -1 else b'') + b'\n')
+    lines.append(b']\n')
+    parsed = [parse_wikidata(line) for line in lines]
+    self.assertEqual(parsed, [None] + objs + [None])
+
+  def test_json_fallback(self):
+    class FakeOrjson():
+      class JSONDecodeError(ValueError):
+        pass
+
+      @classmethod
+      def loads(cls, data):
+        raise cls.JSONDecodeError('refused')
+
+    # lines orjson refuses are decoded with json
+    with mock.patch.object(import_wikidata, 'orjson', FakeOrjson):
+      self.assertEqual(parse_wikidata(b'{"a": "\\ud800", "b": 1e400},\n'), {'a': '\ud800', 'b': float('inf')})
+    self.assertEqual(parse_wikidata(b'{"a": "\\ud800", "b": 1e400}\n'), {'a': '\ud800', 'b': float('inf')})
 
   def test_map_value(self):
     coo = {'value': {
@@ -35,5 +101,103 @@ class TestImportWikidata(unittest.TestCase):
             'type': 'time'}
     self.assertEqual(map_value(time, {}), '2001-12-01T00:00:00')
 
+  def test_single_pass(self):
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+      os.chdir(tmp)
+      try:
+        with bz2.open('dump.json.bz2', 'wt') as f:
+          f.write('[\n' + ',\n'.join(json.dumps(entity) for entity in ENTITIES) + '\n]\n')
+        for single_pass in False, True:
+          if os.path.exists('names.bin'):
+            os.remove('names.bin')
+          cursor = FakeCursor()
+          main('dump.json.bz2', cursor, FakeConn(), single_pass=single_pass, spool_dir=tmp)
+          results.append(cursor.copied)
+          self.assertEqual(open('maxrevid.txt').read(), '30')
+      finally:
+        os.chdir(cwd)
+    self.assertEqual(results[0], results[1])
+    copied = results[1]
+    self.assertEqual([row[0] for row in copied['import.wikidata']], ['Amsterdam', 'Capital city'])
+    properties = json.loads(copied['import.wikidata'][0][6])
+    self.assertEqual(properties['instance of'], ['Capital city', 'city'])
+    self.assertEqual(properties['motto'], 'new')
+    self.assertEqual(copied['import.geo'], [['Q1', 'SRID=4326;POINT(4.9 52.37)']])
+    self.assertEqual(copied['import.labels'], [['Q1', 'Amsterdam'], ['Q3', 'capital']])
+    self.assertEqual(copied['import.instance'], [['Q1', '["capital city", "city"]']])
+    self.assertEqual(copied['import.claims'], [['Q1', 'P571', '\\N', '\\N', '1275-10-27 00:00:00', '11']])
+    self.assertEqual(copied['import.refs'], [['Q1', 'Q2'], ['Q1', 'Q3']])
+    # the claims are kept as compact_claims left them, for wd_updater.rematerialize
+    entity_claims = dict((wikidata_id, json.loads(claims)) for wikidata_id, claims in copied['import.entity_claims'])
+    self.assertEqual(sorted(entity_claims), ['Q1', 'Q3'])
+    self.assertEqual(entity_claims['Q1']['P31'][0][1], {'type': 'wikibase-entityid', 'value': {'id': 'Q2'}})
+
+  def test_integer_ids(self):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+      os.chdir(tmp)
+      try:
+        with bz2.open('dump.json.bz2', 'wt') as f:
+          f.write('[\n' + ',\n'.join(json.dumps(entity) for entity in ENTITIES) + '\n]\n')
+        cursor = FakeCursor()
+        main('dump.json.bz2', cursor, FakeConn(), integer_ids=True)
+        names = NameStore('names.bin')
+        store_names(cursor, FakeConn(), names, integer_ids=True)
+        names.close()
+      finally:
+        os.chdir(cwd)
+    copied = cursor.copied
+    self.assertEqual([row[2] for row in copied['import.wikidata']], ['1', '3'])
+    self.assertEqual(copied['import.geo'], [['1', 'SRID=4326;POINT(4.9 52.37)']])
+    self.assertEqual(copied['import.claims'][0][:2], ['1', 'P571'])
+    self.assertEqual(copied['import.refs'], [['1', '2'], ['1', '3']])
+    self.assertEqual([row[0] for row in copied['import.entity_claims']], ['1', '3'])
+    self.assertEqual(copied['import.id2name'], [['-625', 'coordinate location'], ['-31', 'instance of'],
+                                                ['-17', 'motto'], ['1', 'Amsterdam'], ['2', 'city'],
+                                                ['3', 'Capital city']])
+
+  def test_text_views(self):
+    cursor = FakeCursor()
+    cursor.columns = [('wikidata_id', ), ('time', )]
+    create_text_views(cursor, FakeConn())
+    self.assertIn('CREATE VIEW import.claims_text AS SELECT CASE WHEN "wikidata_id" < 0 THEN \'P\' || -"wikidata_id" '
+                  'ELSE \'Q\' || "wikidata_id" END AS "wikidata_id", "time" FROM import.claims', cursor.statements)
+
+  def test_map_entities(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'names.bin')
+      names = NameStoreWriter()
+      for entity_id, name in ('Q2', 'city'), ('Q3', 'Capital city'), ('P31', 'instance of'):
+        names[entity_id] = name
+      names.save(path)
+      lines = [b'[\n'] + [(json.dumps(entity) + ',\n').encode('utf-8') for entity in ENTITIES]
+      batches = queue.Queue()
+      batches.put((0, (3, 100), list(enumerate(lines[:3], 1))))
+      batches.put((1, (6, 200), list(enumerate(lines[3:], 4))))
+      batches.put(None)
+      results = queue.Queue()
+      map_entities(batches, results, path, decode_line)
+    (seq, position, maxrevid, rows, stats), second, done = results.get(), results.get(), results.get()
+    self.assertEqual((seq, position, maxrevid, second[2], done), (0, (3, 100), 30, 20, None))
+    self.assertEqual((stats, second[4]), ({'decoded': 1, 'prefiltered': 1}, {'decoded': 1, 'prefiltered': 3}))
+    self.assertEqual([row[0] for row, derived in rows + second[3]], ['Amsterdam', 'Capital city'])
+    row, derived = rows[0]
+    self.assertEqual(json.loads(row[6])['instance of'], ['Capital city', 'city'])
+    self.assertEqual(json.loads(row[3]), ['Amsterdam', 'Amsterdam'])
+    self.assertEqual(derived['instance'], [('Q1', '["capital city", "city"]')])
+
+  def test_prefilter(self):
+    stats = Counter()
+    lines = [(json.dumps(entity) + ',\n').encode('utf-8') for entity in ENTITIES]
+    self.assertEqual(decode_line((1, lines[1]), stats=stats), (1, 30, None))
+    line_no, lastrevid, record = decode_line((1, lines[0]), stats=stats)
+    self.assertEqual((lastrevid, record[0]), (10, 'Amsterdam'))
+    self.assertIsNone(decode_line((2, b']\n'), stats=stats))
+    self.assertEqual(decode_line((3, lines[1]), prefilter=False, stats=stats), (3, 30, None))
+    self.assertEqual(stats, {'decoded': 2, 'prefiltered': 1})
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,12 +1,23 @@
 #!/bin/python3
 
 import argparse
-import subprocess
+import bz2
+from collections import Counter
+import multiprocessing
+import os
+import sys
 import xml.sax
 
 import mwparserfromhell
+from mwparserfromhell.definitions import PARSER_BLACKLIST
 import psycopg2
 import re
+from checkpoint import Checkpoint, Watermark
+from copy_writer import CopyWriter
+from dump_reader import DumpReader
+from index_builder import IndexBuilder, Step
+import pipeline
+from staging import STAGING_SCHEMA, TARGET_SCHEMA, publish, unlogged
 from progressbar import ProgressBar, Bar, SimpleProgress, Percentage, RotatingMarker, AdaptiveETA, UnknownLength
 
 CAT_PREFIX = 'Category:'
@@ -14,24 +25,103 @@ INFOBOX_PREFIX = 'infobox '
 
 RE_GENERAL = re.compile('(.+?)(\ (in|of|by)\ )(.+)')
 
-def setup_db(connection_string):
+# for scan_wikitext: markup we leave to mwparserfromhell. The tags are the ones it doesn't parse the
+# contents of.
+RE_SCAN_UNSAFE = re.compile(r'<!--|\{\{\{|\[\[\[|<\s*/?\s*(%s)\b' % '|'.join(map(re.escape, PARSER_BLACKLIST)),
+                            re.IGNORECASE)
+RE_BRACES = re.compile(r'\{\{|\}\}')
+RE_TEMPLATE_NAME = re.compile(r'\{\{([^|{}\[\]<>&]*)(\||\}\})')
+RE_CATEGORY_LINK = re.compile(r'\[\[' + CAT_PREFIX + r'([^|{}\[\]<>\n]*)(\||\]\])')
+MAX_SCAN_DEPTH = 20
+
+WIKIPEDIA_COLUMNS = ('id', 'title', 'infobox', 'wikitext', 'templates', 'categories', 'general', 'revision_id', 'sha1')
+
+# pages are passed between processes in batches of this size; each queue holds at most
+# QUEUE_DEPTH batches per worker.
+PAGE_BATCH = 100
+QUEUE_DEPTH = 4
+
+CHECKPOINT = 'wikipedia'
+CHECKPOINT_MULTISTREAM = 'wikipedia-multistream'
+CHECKPOINT_INDEXES = 'wikipedia-indexes'
+
+def setup_db(connection_string, resume=False, schema=TARGET_SCHEMA):
+  """The primary key on title is added by the index_steps once the pages are loaded."""
   conn = psycopg2.connect(connection_string)
   cursor = conn.cursor()
-  cursor.execute('CREATE SCHEMA IF NOT EXISTS import;')
-  cursor.execute('DROP TABLE IF EXISTS import.wikipedia')
-  cursor.execute('CREATE TABLE import.wikipedia ('
+  cursor.execute('CREATE SCHEMA IF NOT EXISTS %s;' % schema)
+  if not resume:
+    cursor.execute('DROP TABLE IF EXISTS %s.wikipedia' % schema)
+  cursor.execute('CREATE %sTABLE IF NOT EXISTS %s.wikipedia (' % (unlogged(schema), schema) +
                  '    id integer,'
-                 '    title TEXT PRIMARY KEY,'
+                 '    title TEXT,'
                  '    infobox TEXT,'
                  '    wikitext TEXT,'
                  '    templates TEXT[] NOT NULL DEFAULT \'{}\','
                  '    categories TEXT[] NOT NULL DEFAULT \'{}\','
-                 '    general TEXT[] NOT NULL DEFAULT \'{}\''
+                 '    general TEXT[] NOT NULL DEFAULT \'{}\','
+                 '    revision_id BIGINT,'
+                 '    sha1 TEXT'
                  ')')
+  # tables created before we stored revisions
+  cursor.execute('ALTER TABLE %s.wikipedia ADD COLUMN IF NOT EXISTS revision_id BIGINT, ' % schema +
+                 'ADD COLUMN IF NOT EXISTS sha1 TEXT')
 
   return conn, cursor
 
 
+def index_steps(schema=TARGET_SCHEMA, maintenance_work_mem=None):
+  """Steps for IndexBuilder. The primary key index is built alongside the others and attached once they're
+  done, since ALTER TABLE would lock out the other builds."""
+  steps = [
+    Step('wikipedia_pkey', 'CREATE UNIQUE INDEX wikipedia_pkey ON %s.wikipedia(title)' % schema),
+    Step('wp_wikipedia_infobox', 'CREATE INDEX wp_wikipedia_infobox ON %s.wikipedia(infobox)' % schema),
+    Step('wp_wikipedia_templates', 'CREATE INDEX wp_wikipedia_templates ON %s.wikipedia USING gin(templates)' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wp_wikipedia_categories',
+         'CREATE INDEX wp_wikipedia_categories ON %s.wikipedia USING gin(categories)' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+    Step('wp_wikipedia_general', 'CREATE INDEX wp_wikipedia_general ON %s.wikipedia USING gin(general)' % schema,
+         maintenance_work_mem=maintenance_work_mem),
+  ]
+  steps.append(Step('wikipedia_primary_key',
+                    'ALTER TABLE %s.wikipedia ADD PRIMARY KEY USING INDEX wikipedia_pkey' % schema,
+                    deps=[step.name for step in steps]))
+  return steps
+
+
+def stored_titles(cursor):
+  cursor.execute('SELECT title FROM import.wikipedia')
+  return set(title for title, in cursor)
+
+
+def stored_revisions(cursor):
+  cursor.execute('SELECT title, sha1 FROM import.wikipedia')
+  return dict(cursor)
+
+
+def make_writer(cursor, conn, batch_size, commit_every, update=False, seen=None, before_commit=None,
+                schema=TARGET_SCHEMA):
+  """Writer for the wikipedia table in schema. For an update the rows are copied into a temp table and
+  upserted from there, so changed pages replace their old version."""
+  if not update:
+    return CopyWriter(cursor, conn, schema + '.wikipedia', WIKIPEDIA_COLUMNS, batch_size=batch_size,
+                      commit_every=commit_every, unique='title', seen=seen, before_commit=before_commit)
+  cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wikipedia_changes (LIKE %s.wikipedia INCLUDING DEFAULTS)' % schema)
+  columns = ', '.join(WIKIPEDIA_COLUMNS)
+  merge = ('INSERT INTO %s.wikipedia (%s) SELECT %s FROM wikipedia_changes ' % (schema, columns, columns) +
+           'ON CONFLICT (title) DO UPDATE SET ' +
+           ', '.join('%s = EXCLUDED.%s' % (column, column) for column in WIKIPEDIA_COLUMNS if column != 'title') +
+           '; TRUNCATE wikipedia_changes')
+  return CopyWriter(cursor, conn, 'wikipedia_changes', WIKIPEDIA_COLUMNS, batch_size=batch_size,
+                    commit_every=commit_every, unique='title', seen=seen, before_commit=before_commit, merge=merge)
+
+
+def delete_pages(cursor, titles, batch_size=10000):
+  for idx in range(0, len(titles), batch_size):
+    cursor.execute('DELETE FROM import.wikipedia WHERE title = ANY(%s)', (titles[idx:idx + batch_size],))
+
+
 def make_tags(iterable):
   return list(set(x.strip().lower() for x in iterable if x and len(x) < 256))
 
@@ -47,65 +137,213 @@ def extact_general(category):
   return None
 
 
+def make_row(page_id, title, text, template_names, categories, revision_id=None, sha1=None):
+  infobox = None
+  for template in template_names:
+    if template.startswith(INFOBOX_PREFIX):
+      infobox = template[len(INFOBOX_PREFIX):]
+      break
+  if len(infobox or '') > 1024 or len(title) > 1024:
+    print('Too long')
+    raise mwparserfromhell.parser.ParserError('too long')
+  general = make_tags(extact_general(x) for x in categories)
+  # print(title, page_id, infobox, template_names, categories, general)
+  return page_id, title, infobox, text, template_names, categories, general, revision_id, sha1
+
+
+def extract_page(page_id, title, text, revision_id=None, sha1=None):
+  """Parse the wikitext of a page and return the row to store for it, or None if it can't be parsed."""
+  try:
+    wikicode = mwparserfromhell.parse(text)
+    templates = wikicode.filter_templates()
+    template_names = make_tags(strip_template_name(template.name) for template in templates)
+    categories = make_tags(l.title[len(CAT_PREFIX):] for l in wikicode.filter_wikilinks() if l.title.startswith(CAT_PREFIX))
+    return make_row(page_id, title, text, template_names, categories, revision_id, sha1)
+  except mwparserfromhell.parser.ParserError:
+    print('mwparser error for:', title)
+  return None
+
+
+def scan_wikitext(text):
+  """Find the template names and category titles in text without building a parse tree.
+
+  Both are returned in document order, which is the order mwparserfromhell's recursive filters
+  use. Returns None if the text has markup where a plain scan could disagree with mwparserfromhell:
+  comments, tags whose contents aren't parsed, template arguments, deep nesting, unbalanced braces
+  and template names or category links that aren't plain text.
+  """
+  if RE_SCAN_UNSAFE.search(text):
+    return None
+  names = []
+  depth = 0
+  for m in RE_BRACES.finditer(text):
+    if m.group() == '{{':
+      depth += 1
+      name = RE_TEMPLATE_NAME.match(text, m.start())
+      if depth > MAX_SCAN_DEPTH or not name:
+        return None
+      name = name.group(1).strip()
+      if not name or '\n' in name or "''" in name:
+        return None
+      names.append(name)
+    elif depth:
+      depth -= 1
+    else:
+      return None
+  if depth:
+    return None
+
+  categories = []
+  pos = text.find('[[' + CAT_PREFIX)
+  while pos != -1:
+    m = RE_CATEGORY_LINK.match(text, pos)
+    if not m:
+      return None
+    categories.append(m.group(1))
+    pos = text.find('[[' + CAT_PREFIX, m.end())
+  return names, categories
+
+
+def extract_page_fast(page_id, title, text, revision_id=None, sha1=None):
+  """Like extract_page, but uses scan_wikitext and only falls back to mwparserfromhell if that gives up."""
+  found = scan_wikitext(text)
+  if found is None:
+    return extract_page(page_id, title, text, revision_id, sha1)
+  try:
+    return make_row(page_id, title, text, make_tags(found[0]), make_tags(found[1]), revision_id, sha1)
+  except mwparserfromhell.parser.ParserError:
+    print('mwparser error for:', title)
+  return None
+
+
+EXTRACTORS = {
+  'mwparser': extract_page,
+  'fast': extract_page_fast,
+}
+
+
+class PageFilter(object):
+  """Which pages WikiXmlHandler passes on: namespaces is a collection of namespace numbers to keep (None
+  keeps all of them) and redirects says whether to keep redirect pages."""
+  def __init__(self, namespaces=None, redirects=True):
+    self.namespaces = set(namespaces) if namespaces is not None else None
+    self.redirects = redirects
+
+  def skip_namespace(self, ns):
+    return self.namespaces is not None and int(ns) not in self.namespaces
+
+
+class Refresh(object):
+  """State of an incremental update: the sha1 of every stored page, keyed on title, and the titles seen
+  in the new dump."""
+  def __init__(self, stored):
+    self.stored = stored
+    self.seen = set()
+
+  def unchanged(self, title, sha1):
+    self.seen.add(title)
+    return sha1 is not None and self.stored.get(title) == sha1
+
+  def keep(self, title):
+    """title is in the dump but not imported this time - filtered out, or before the point we resumed from -
+    so its stored rows are not removed."""
+    self.seen.add(title)
+
+  def removed(self):
+    return [title for title in self.stored if title not in self.seen]
+
+
 class WikiXmlHandler(xml.sax.handler.ContentHandler):
-  def __init__(self, cursor, conn):
+  """Collects (id, title, text, revision_id, sha1) for each page. If extract is set it is used to turn
+  those into a row, otherwise the raw tuples are handed to the writer.
+
+  Pages rejected by page_filter are dropped as soon as their <ns> or <redirect> element is seen, so their
+  text is never buffered. The first skip_pages pages are dropped the same way, to resume an import.
+  With a refresh, pages whose sha1 matches the stored one are dropped before they are parsed, and the titles
+  of the other dropped pages are still read to keep them from being removed.
+  skipped counts them per reason, pages counts all pages seen."""
+  def __init__(self, writer, extract=extract_page, progress=True, page_filter=None, skip_pages=0, refresh=None):
     xml.sax.handler.ContentHandler.__init__(self)
-    self._db_cursor = cursor
-    self._db_conn = conn
+    self._writer = writer
+    self._extract = extract
+    self._filter = page_filter or PageFilter()
+    self._skip_pages = skip_pages
+    self._refresh = refresh
     self._count = 0
-    self._pbar = ProgressBar(widgets=[Bar(),SimpleProgress(), AdaptiveETA()], maxval=UnknownLength)
+    self.pages = 0
+    self.skipped = Counter()
+    self._pbar = None
+    if progress:
+      self._pbar = ProgressBar(widgets=[Bar(),SimpleProgress(), AdaptiveETA()], maxval=UnknownLength)
     self.reset()
 
 
   def pstart(self):
-      self._pbar.start()
+      if self._pbar:
+        self._pbar.start()
 
 
   def pstop(self):
-      self._pbar.finish()
+      if self._pbar:
+        self._pbar.finish()
 
 
   def reset(self):
     self._buffer = []
     self._state = None
+    self._key = None
+    self._open = set()
     self._values = {}
+    self._skip = None
 
   def startElement(self, name, attrs):
-    if name in ('title', 'text', 'id'):
+    if name == 'page':
+      self.pages += 1
+      if self.pages <= self._skip_pages:
+        self._skip = 'resumed'
+    if self._skip and not (name == 'title' and self._refresh):
+      return
+    if name in ('title', 'text', 'id', 'ns', 'sha1'):
       self._state = name
+      self._key = name
+      if name == 'id' and self._open:
+        # the revision's own id, not the contributor's
+        self._key = 'revision_id' if self._open == {'revision'} else None
+    elif name in ('revision', 'contributor'):
+      self._open.add(name)
+    elif name == 'redirect' and not self._filter.redirects:
+      self._skip = 'redirect'
 
   def endElement(self, name):
     if name == self._state:
-      if name not in self._values: self._values[name] = ''.join(self._buffer)
+      if self._key and self._key not in self._values: self._values[self._key] = ''.join(self._buffer)
       self._state = None
       self._buffer = []
+      if name == 'ns' and self._filter.skip_namespace(self._values['ns']):
+        self._skip = 'namespace'
+    elif name in ('revision', 'contributor'):
+      self._open.discard(name)
 
     if name == 'page':
-      try:
-        wikicode = mwparserfromhell.parse(self._values['text'])
-        templates = wikicode.filter_templates()
-        template_names = make_tags(strip_template_name(template.name) for template in templates)
-        infobox = None
-        for template in template_names:
-          if template.startswith(INFOBOX_PREFIX):
-            infobox = template[len(INFOBOX_PREFIX):]
-            break
-        if len(infobox or '') > 1024 or len(self._values['title']) > 1024:
-          print('Too long')
-          raise mwparserfromhell.parser.ParserError('too long')
-        categories = make_tags(l.title[len(CAT_PREFIX):] for l in wikicode.filter_wikilinks() if l.title.startswith(CAT_PREFIX))
-        general = make_tags(extact_general(x) for x in categories)
-        # even though we shouldn't get dupes, sometimes wikidumps are faulty:
-        # print(self._values['title'], self._values['id'], infobox, templates, categories, general)
-        self._db_cursor.execute('INSERT INTO import.wikipedia (id, title, infobox, wikitext, templates, categories, general) VALUES (%s, %s, %s, %s, %s, %s, %s)  ON CONFLICT DO NOTHING',
-                                (self._values['id'], self._values['title'], infobox, self._values['text'], make_tags(templates), categories, general))
-        self._pbar.update(self._count)
+      if self._refresh and self._skip:
+        self._refresh.keep(self._values['title'])
+      elif self._refresh and self._refresh.unchanged(self._values['title'], self._values.get('sha1')):
+        self._skip = 'unchanged'
+      if self._skip:
+        self.skipped[self._skip] += 1
+        page = None
+      else:
+        page = (self._values['id'], self._values['title'], self._values['text'],
+                self._values.get('revision_id'), self._values.get('sha1'))
+      if page and self._extract:
+        page = self._extract(*page)
+      if page:
+        # even though we shouldn't get dupes, sometimes wikidumps are faulty. The writer drops
+        # titles it has already seen.
+        self._writer.write(page)
+        if self._pbar:
+          self._pbar.update(self._count)
         self._count += 1
-        if self._count % 100000 == 0:
-          # print(self._count)
-          self._db_conn.commit()
-      except mwparserfromhell.parser.ParserError:
-        print('mwparser error for:', self._values['title'])
       self.reset()
 
   def characters(self, content):
@@ -113,19 +351,223 @@ class WikiXmlHandler(xml.sax.handler.ContentHandler):
       self._buffer.append(content)
 
 
-def main(dump, cursor, conn):
+class QueueWriter(object):
+  """Writer that puts items on a multiprocessing queue in batches of (seq, position, items), where seq
+  numbers the batches and position, if given, is called to tell how far the input is at that point. put
+  replaces queue.put, see pipeline.put."""
+  def __init__(self, queue, batch_size=PAGE_BATCH, position=None, put=None):
+    self._put = put or queue.put
+    self._batch_size = batch_size
+    self.position = position
+    self._seq = 0
+    self._buffer = []
+
+  def write(self, item):
+    self._buffer.append(item)
+    if len(self._buffer) >= self._batch_size:
+      self.flush()
+
+  def flush(self):
+    if self._buffer:
+      self._put((self._seq, self.position() if self.position else None, self._buffer))
+      self._seq += 1
+      self._buffer = []
+
+  def close(self):
+    self.flush()
+
+
+def extract_pages(pages, results, extract=extract_page):
+  """Worker process: turns batches of raw pages into batches of rows until it gets a None."""
+  for seq, position, batch in iter(pages.get, None):
+    results.put((seq, position, [row for row in (extract(*page) for page in batch) if row]))
+  results.put(None)
+
+
+def write_pages(results, workers, connection_string, batch_size, commit_every, checkpoint_name, resume=False,
+                update=False, schema=TARGET_SCHEMA):
+  """Writer process: stores the rows produced by the workers until each of them is done. Workers that
+  filter pages themselves send a Counter of skipped pages before they finish.
+
+  Batches arrive out of order, so the checkpoint saved with each commit is the position of the last batch
+  that was stored along with all batches before it. Batches after that may have been stored too, which is
+  why a resumed import starts from the titles already in the table."""
+  conn = psycopg2.connect(connection_string)
+  cursor = conn.cursor()
+  checkpoint = Checkpoint(cursor, checkpoint_name)
+  watermark = Watermark()
+
+  def save_checkpoint():
+    if watermark.position:
+      checkpoint.save(*watermark.position)
+
+  writer = make_writer(cursor, conn, batch_size, commit_every, update,
+                       seen=stored_titles(cursor) if resume else None, before_commit=save_checkpoint, schema=schema)
+  skipped = Counter()
+  done = 0
+  while done < workers:
+    message = results.get()
+    if message is None:
+      done += 1
+      continue
+    if isinstance(message, Counter):
+      skipped.update(message)
+      continue
+    seq, position, rows = message
+    for row in rows:
+      writer.write(row)
+    watermark.done(seq, position)
+  writer.close()
+  conn.close()
+  print('Stored', writer.count, 'pages, skipped', writer.dupes, 'duplicate titles')
+  if skipped:
+    report_skipped(skipped)
+
+
+def report_skipped(skipped):
+  print('Skipped pages:', ', '.join('%s: %d' % item for item in sorted(skipped.items())))
+
+
+class ListWriter(list):
+  def write(self, item):
+    self.append(item)
+
+  def close(self):
+    pass
+
+
+def read_stream_offsets(index, dump):
+  """Read a multistream index (lines of offset:page_id:title) and return the (start, end) byte range of
+  every bzip2 stream in the dump that holds pages."""
+  offsets = []
+  with bz2.open(index, 'rb') as f:
+    for line in f:
+      offset = int(line.split(b':', 1)[0])
+      if not offsets or offsets[-1] != offset:
+        offsets.append(offset)
+  offsets.append(os.path.getsize(dump))
+  return list(zip(offsets, offsets[1:]))
+
+
+def parse_stream(dump, start, end, extract=extract_page, page_filter=None):
+  """Decompress the bzip2 stream(s) between start and end and return what extract makes of the pages in it,
+  plus the counts of skipped pages. The last range also includes the stream closing the <mediawiki> element."""
+  with open(dump, 'rb') as f:
+    f.seek(start)
+    data = bz2.decompress(f.read(end - start))
+  rows = ListWriter()
   parser = xml.sax.make_parser()
-  xmlHandler = WikiXmlHandler(cursor, conn)
+  xmlHandler = WikiXmlHandler(rows, extract, progress=False, page_filter=page_filter)
   parser.setContentHandler(xmlHandler)
-
-  xmlHandler.pstart()
-  for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
+  parser.feed(b'<mediawiki>')
+  parser.feed(data)
+  if not data.rstrip().endswith(b'</mediawiki>'):
+    parser.feed(b'</mediawiki>')
+  parser.close()
+  return rows, xmlHandler.skipped
+
+
+def extract_streams(dump, streams, results, extract=extract_page, page_filter=None):
+  """Worker process: parses batches of stream ranges from a multistream dump until it gets a None. A stream that
+  doesn't decompress or parse is left out and counted as skipped, the others still get imported."""
+  skipped = Counter()
+  for seq, position, batch in iter(streams.get, None):
+    rows = []
+    for start, end in batch:
+      try:
+        stream_rows, stream_skipped = parse_stream(dump, start, end, extract, page_filter)
+      except (EOFError, OSError, ValueError, xml.sax.SAXException) as err:
+        print('skipping the stream at offset %d: %s' % (start, err), file=sys.stderr)
+        skipped['broken stream'] += 1
+        continue
+      rows.extend(stream_rows)
+      skipped.update(stream_skipped)
+    results.put((seq, position, rows))
+  results.put(skipped)
+  results.put(None)
+
+
+def feed_dump(reader, xmlHandler):
+  parser = xml.sax.make_parser()
+  parser.setContentHandler(xmlHandler)
+  for chunk in reader.chunks():
     try:
-      parser.feed(line)
+      parser.feed(chunk)
     except StopIteration:
       break
 
-  xmlHandler.pstop()
+
+def main(dump, writer, extract=extract_page, page_filter=None, checkpoint=None, refresh=None):
+  """Import dump through writer. With a checkpoint, the pages it covers are skipped and every commit
+  records the number of pages read so far. With a refresh only changed pages are passed on."""
+  xmlHandler = WikiXmlHandler(writer, extract, progress=False, page_filter=page_filter,
+                              skip_pages=checkpoint.position if checkpoint else 0, refresh=refresh)
+  with DumpReader(dump, progress=True) as reader:
+    if checkpoint:
+      writer.before_commit = lambda: checkpoint.save(xmlHandler.pages, reader.tell())
+    feed_dump(reader, xmlHandler)
+    writer.close()
+
+  if xmlHandler.skipped:
+    report_skipped(xmlHandler.skipped)
+
+
+def main_pipeline(dump, connection_string, workers, batch_size, commit_every, extract=extract_page, page_filter=None,
+                  checkpoint_name=CHECKPOINT, skip_pages=0, refresh=None, schema=TARGET_SCHEMA):
+  """Parse with a pool of worker processes: this process reads the dump, the workers run mwparserfromhell
+  and a single writer process stores the results. The queues are bounded so a slow stage blocks the
+  ones feeding it instead of piling up pages in memory."""
+  pages = multiprocessing.Queue(maxsize=workers * QUEUE_DEPTH)
+  results = multiprocessing.Queue(maxsize=workers * QUEUE_DEPTH)
+  extractors = [multiprocessing.Process(target=extract_pages, args=(pages, results, extract)) for _ in range(workers)]
+  writer = multiprocessing.Process(target=write_pages,
+                                   args=(results, workers, connection_string, batch_size, commit_every,
+                                         checkpoint_name, skip_pages > 0, refresh is not None, schema))
+  for process in extractors + [writer]:
+    process.start()
+
+  pages_writer = QueueWriter(pages, put=lambda item: pipeline.put(pages, item, writer, extractors))
+  xmlHandler = WikiXmlHandler(pages_writer, extract=None, progress=False, page_filter=page_filter,
+                              skip_pages=skip_pages, refresh=refresh)
+  with DumpReader(dump, progress=True) as reader:
+    pages_writer.position = lambda: (xmlHandler.pages, reader.tell())
+    feed_dump(reader, xmlHandler)
+    pages_writer.close()
+  if xmlHandler.skipped:
+    report_skipped(xmlHandler.skipped)
+  for _ in extractors:
+    pipeline.put(pages, None, writer, extractors)
+  pipeline.join(writer, extractors)
+
+
+def main_multistream(dump, index, connection_string, workers, batch_size, commit_every, extract=extract_page,
+                     page_filter=None, checkpoint_name=CHECKPOINT_MULTISTREAM, skip_streams=0, schema=TARGET_SCHEMA):
+  """Import a pages-articles-multistream dump. Every bzip2 stream in it can be decompressed on its own, so
+  the workers seek straight to the ranges listed in the index and both decompression and parsing run
+  in parallel. The checkpoint counts the streams stored, so resuming just starts further down the list."""
+  streams = read_stream_offsets(index, dump)
+  print('Found', len(streams), 'streams, skipping', skip_streams)
+  ranges = multiprocessing.Queue(maxsize=workers * QUEUE_DEPTH)
+  results = multiprocessing.Queue(maxsize=workers * QUEUE_DEPTH)
+  extractors = [multiprocessing.Process(target=extract_streams,
+                                        args=(dump, ranges, results, extract, page_filter)) for _ in range(workers)]
+  writer = multiprocessing.Process(target=write_pages,
+                                   args=(results, workers, connection_string, batch_size, commit_every,
+                                         checkpoint_name, skip_streams > 0, False, schema))
+  for process in extractors + [writer]:
+    process.start()
+
+  pbar = ProgressBar(widgets=[Bar(), SimpleProgress(), AdaptiveETA()], maxval=len(streams)).start()
+  # every stream is flushed as soon as it's written, so position sees the current idx and stream
+  ranges_writer = QueueWriter(ranges, batch_size=1, position=lambda: (idx + 1, stream[1]),
+                              put=lambda item: pipeline.put(ranges, item, writer, extractors))
+  for idx, stream in enumerate(streams[skip_streams:], skip_streams):
+    ranges_writer.write(stream)
+    pbar.update(idx + 1)
+  for _ in extractors:
+    pipeline.put(ranges, None, writer, extractors)
+  pipeline.join(writer, extractors)
+  pbar.finish()
 
 
 if __name__ == '__main__':
@@ -134,19 +576,81 @@ if __name__ == '__main__':
                       help='postgres connection string')
   parser.add_argument('dump', type=str,
                       help='BZipped wikipedia dump')
+  parser.add_argument('--index', type=str,
+                      help='multistream index matching a pages-articles-multistream dump; '
+                           'streams are then decompressed and parsed in parallel')
+  parser.add_argument('--batch_size', type=int, default=10000,
+                      help='number of pages to send to postgres per COPY')
+  parser.add_argument('--commit_every', type=int, default=100000,
+                      help='commit after at least this many pages')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='parse wikitext in this many worker processes')
+  parser.add_argument('--engine', choices=sorted(EXTRACTORS), default='mwparser',
+                      help='how to find templates and categories: mwparser parses every page, fast scans for '
+                           'them and only parses pages it can\'t handle')
+  parser.add_argument('--namespaces', type=int, nargs='+',
+                      help='only import pages in these namespaces, e.g. 0 for articles and 14 for categories')
+  parser.add_argument('--skip_redirects', action='store_true',
+                      help='don\'t import redirect pages')
+  parser.add_argument('--resume', action='store_true',
+                      help='continue an interrupted import from its last checkpoint instead of starting over')
+  parser.add_argument('--update', action='store_true',
+                      help='update an existing import from a newer dump: only pages whose sha1 changed are parsed '
+                           'and stored, pages missing from the dump are deleted')
+  parser.add_argument('--index_workers', type=int, default=4,
+                      help='build this many indexes at the same time once the pages are loaded')
+  parser.add_argument('--maintenance_work_mem', type=str,
+                      help='maintenance_work_mem for each of the GIN index builds, e.g. 1GB')
+  parser.add_argument('--staging', action='store_true',
+                      help='load into unlogged tables in the %s schema and only replace import.wikipedia once '
+                           'the import and its indexes are complete' % STAGING_SCHEMA)
 
   args = parser.parse_args()
+  if args.update and (args.index or args.resume):
+    parser.error('--update needs to see the whole dump and can\'t be combined with --index or --resume')
+  if args.staging and (args.update or args.resume):
+    # unlogged tables are emptied when postgres restarts after a crash, the checkpoint wouldn't be
+    parser.error('--staging always builds from scratch and can\'t be combined with --update or --resume')
+  schema = STAGING_SCHEMA if args.staging else TARGET_SCHEMA
+  extract = EXTRACTORS[args.engine]
+  page_filter = PageFilter(args.namespaces, redirects=not args.skip_redirects)
   print('Setup db')
-  conn, cursor = setup_db(args.postgres)
+  conn, cursor = setup_db(args.postgres, args.resume or args.update, schema)
+  refresh = None
+  if args.update:
+    refresh = Refresh(stored_revisions(cursor))
+    print('Updating', len(refresh.stored), 'stored pages')
+  checkpoint = Checkpoint(cursor, CHECKPOINT_MULTISTREAM if args.index else CHECKPOINT)
+  if args.resume:
+    print('Resuming after', checkpoint.position, 'streams' if args.index else 'pages')
+  else:
+    checkpoint.clear()
+  conn.commit()
 
   print('Parsing...')
-  main(args.dump, cursor, conn)
-  print('Create indexes')
-  conn.commit()
-  cursor.execute('CREATE INDEX wp_wikipedia_infobox ON import.wikipedia(infobox)')
-  cursor.execute('CREATE INDEX wp_wikipedia_templates ON import.wikipedia USING gin(templates)')
-  cursor.execute('CREATE INDEX wp_wikipedia_categories ON import.wikipedia USING gin(categories)')
-  cursor.execute('CREATE INDEX wp_wikipedia_general ON import.wikipedia USING gin(general)')
+  if args.index:
+    main_multistream(args.dump, args.index, args.postgres, args.workers or multiprocessing.cpu_count(),
+                     args.batch_size, args.commit_every, extract, page_filter, skip_streams=checkpoint.position,
+                     schema=schema)
+  elif args.workers > 0:
+    main_pipeline(args.dump, args.postgres, args.workers, args.batch_size, args.commit_every, extract, page_filter,
+                  skip_pages=checkpoint.position, refresh=refresh, schema=schema)
+  else:
+    writer = make_writer(cursor, conn, args.batch_size, args.commit_every, args.update,
+                         seen=stored_titles(cursor) if args.resume else None, schema=schema)
+    main(args.dump, writer, extract, page_filter, checkpoint, refresh)
+
+  if refresh:
+    removed = refresh.removed()
+    print('Deleting', len(removed), 'pages that are no longer in the dump')
+    delete_pages(cursor, removed)
+  else:
+    print('Create indexes')
+    conn.commit()
+    IndexBuilder(args.postgres, index_steps(schema, args.maintenance_work_mem), args.index_workers,
+                 checkpoint=CHECKPOINT_INDEXES, resume=args.resume).run()
 
   conn.commit()
-
+  if args.staging:
+    print('Publishing', schema + '.wikipedia')
+    publish(cursor, conn, ['wikipedia'])
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
+import bz2
+import os
+import queue
+import tempfile
 import unittest
 import xml
 
-import re
-from import_wikipedia import WikiXmlHandler, extact_general
+from compare_extractors import Comparison, compare_page
+from import_wikipedia import WikiXmlHandler, WIKIPEDIA_COLUMNS, QueueWriter, extact_general, extract_pages, \
+  PageFilter, Refresh, extract_streams, parse_stream, read_stream_offsets, scan_wikitext
 
 DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.mediawiki.org/xml/export-0.10/ http://www.mediawiki.org/xml/export-0.10.xsd" version="0.10" xml:lang="en">
   <siteinfo>
@@ -69,22 +74,35 @@ DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xmlns:xsi
 </mediawiki>"""
 
 
-RE_PAR = re.compile('\(([^\)]+)\)')
-
-class FakeCursor():
+# wikitext the fast extractor should either get right or leave to mwparserfromhell
+SNIPPETS = [
+  "{{a|b={{c|d}}}}",
+  "{{ Infobox person\n| name = x\n| born = {{birth date|1900|1|1}}\n}}\n[[Category:People in Foo]] [[Category:Bar|baz]]",
+  "{{x|[[a|b]]}} [[File:x.png|thumb|a [[Category:Hidden]] b]]",
+  "{{#if:{{{1|}}}|a}} {{#invoke:String|len|x}}",
+  "{{foo\nbar|x}} {{foo &amp; bar}} {{''foo''}} {{foo<!-- c -->}} {{foo [bar]}}",
+  "{{foo|\n{|\n|a\n|}}}",
+  "{{Infobox a}}{{Infobox b}}{{infobox c}}",
+  "[[ Category:Spaced]] [[:Category:Linked]] [[Category:Foo&amp;Bar]] [[Category:With {{x}}]]",
+  "<ref>{{cite web|url=http://x}}</ref> <nowiki>{{x}}</nowiki> <!-- {{x}} -->",
+  "{{x|y=[[Category:In template|{{y}}]]}} [[Category:Unclosed",
+  "}} {{x}} {{Unclosed {{a|{{b|{{c}}}}}} {{ }} {{|x}} a {{{{b}}}}",
+  "<gallery>\nFile:a.jpg|{{lang|fr|Paris}}\nFile:b.jpg|[[Category:X]]\n</gallery> {{y}}",
+]
+
+
+class FakeWriter():
   def __init__(self):
     self.results = []
 
-  def execute(self, sql, params):
-    g = RE_PAR.search(sql)
-    fields = [x.strip() for x in g.group(1).split(',')]
-    self.results.append(dict(zip(fields, params)))
+  def write(self, row):
+    self.results.append(dict(zip(WIKIPEDIA_COLUMNS, row)))
 
 
 class TestImportWikipedia(unittest.TestCase):
   def test_parse_wikipedia(self):
     parser = xml.sax.make_parser()
-    fc = FakeCursor()
+    fc = FakeWriter()
     parser.setContentHandler(WikiXmlHandler(fc))
     for line in DUMP.split('\n'):
       parser.feed(line + '\n')
@@ -96,6 +114,126 @@ class TestImportWikipedia(unittest.TestCase):
     self.assertTrue("<--This is a *citation* from a book, DON'T CHANGE-->" in fc.results[1]['wikitext'])
     self.assertTrue('main article' in fc.results[1]['templates'])
     self.assertTrue('ideas' in fc.results[1]['general'])
+    self.assertEqual(fc.results[0]['id'], '10')
+    self.assertEqual(fc.results[0]['revision_id'], '631144794')
+    self.assertEqual(fc.results[1]['sha1'], 'az60vahaazg403faw6x2gzpbmiws0o3')
+
+  def test_refresh(self):
+    refresh = Refresh({'AccessibleComputing': '4ro7vvppa5kmm0o1egfjztzcwd0vabw', 'Anarchism': 'old', 'Gone': 'x'})
+    parser = xml.sax.make_parser()
+    fc = FakeWriter()
+    handler = WikiXmlHandler(fc, refresh=refresh)
+    parser.setContentHandler(handler)
+    parser.feed(DUMP)
+    self.assertEqual([result['title'] for result in fc.results], ['Anarchism'])
+    self.assertEqual(handler.skipped, {'unchanged': 1})
+    self.assertEqual(refresh.removed(), ['Gone'])
+
+  def test_refresh_skipped(self):
+    # pages that are filtered out or were imported before resuming are still in the dump and stay
+    stored = {'AccessibleComputing': 'old', 'Anarchism': 'old', 'Gone': 'x'}
+    for page_filter, skip_pages, titles in ((PageFilter(redirects=False), 0, ['Anarchism']),
+                                            (PageFilter(namespaces=[14]), 0, []),
+                                            (None, 1, ['Anarchism'])):
+      refresh = Refresh(stored)
+      fc = FakeWriter()
+      parser = xml.sax.make_parser()
+      parser.setContentHandler(WikiXmlHandler(fc, page_filter=page_filter, skip_pages=skip_pages, refresh=refresh))
+      parser.feed(DUMP)
+      self.assertEqual([result['title'] for result in fc.results], titles)
+      self.assertEqual(refresh.removed(), ['Gone'])
+
+  def test_page_filter(self):
+    for page_filter, titles, skipped in ((PageFilter(redirects=False), ['Anarchism'], {'redirect': 1}),
+                                         (PageFilter(namespaces=[14]), [], {'namespace': 2}),
+                                         (PageFilter(namespaces=[0, 14]), ['AccessibleComputing', 'Anarchism'], {})):
+      parser = xml.sax.make_parser()
+      fc = FakeWriter()
+      handler = WikiXmlHandler(fc, page_filter=page_filter)
+      parser.setContentHandler(handler)
+      parser.feed(DUMP)
+      self.assertEqual([result['title'] for result in fc.results], titles)
+      self.assertEqual(handler.skipped, skipped)
+
+  def test_extract_pages(self):
+    parser = xml.sax.make_parser()
+    pages = queue.Queue()
+    writer = QueueWriter(pages, batch_size=1)
+    handler = WikiXmlHandler(writer, extract=None)
+    writer.position = lambda: handler.pages
+    parser.setContentHandler(handler)
+    parser.feed(DUMP)
+    writer.close()
+    pages.put(None)
+    self.assertEqual(pages.qsize(), 3)
+
+    results = queue.Queue()
+    extract_pages(pages, results)
+    batches = [results.get(), results.get()]
+    self.assertEqual([(seq, position) for seq, position, _ in batches], [(0, 1), (1, 2)])
+    rows = [dict(zip(WIKIPEDIA_COLUMNS, row)) for _, _, rows in batches for row in rows]
+    self.assertEqual([row['title'] for row in rows], ['AccessibleComputing', 'Anarchism'])
+    self.assertTrue('anti-fascism' in rows[1]['categories'])
+    self.assertIsNone(results.get())
+
+  def test_resume(self):
+    parser = xml.sax.make_parser()
+    fc = FakeWriter()
+    handler = WikiXmlHandler(fc, skip_pages=1)
+    parser.setContentHandler(handler)
+    parser.feed(DUMP)
+    self.assertEqual([result['title'] for result in fc.results], ['Anarchism'])
+    self.assertEqual((handler.pages, handler.skipped), (2, {'resumed': 1}))
+
+  def test_multistream(self):
+    header, rest = DUMP.split('</siteinfo>')
+    pages = ['  <page>' + page for page in rest.split('  <page>')[1:]]
+    pages[-1], footer = pages[-1].split('</mediawiki>')[0], '</mediawiki>'
+    with tempfile.TemporaryDirectory() as tmp:
+      dump = os.path.join(tmp, 'pages-articles-multistream.xml.bz2')
+      index = os.path.join(tmp, 'pages-articles-multistream-index.txt.bz2')
+      offsets = []
+      with open(dump, 'wb') as f:
+        f.write(bz2.compress((header + '</siteinfo>\n').encode('utf-8')))
+        for page in pages:
+          offsets.append(f.tell())
+          f.write(bz2.compress(page.encode('utf-8')))
+        f.write(bz2.compress(footer.encode('utf-8')))
+      with bz2.open(index, 'wt') as f:
+        for offset, page_id in zip(offsets, (10, 12)):
+          f.write('%d:%d:Some: title\n' % (offset, page_id))
+
+      streams = read_stream_offsets(index, dump)
+      self.assertEqual(len(streams), 2)
+      self.assertEqual(streams[-1][1], os.path.getsize(dump))
+      rows = [dict(zip(WIKIPEDIA_COLUMNS, row)) for start, end in streams for row in parse_stream(dump, start, end)[0]]
+      self.assertEqual([row['title'] for row in rows], ['AccessibleComputing', 'Anarchism'])
+      self.assertEqual(rows[1]['id'], '12')
+      self.assertTrue('ideas' in rows[1]['general'])
+
+      rows, skipped = parse_stream(dump, streams[0][0], streams[0][1], page_filter=PageFilter(redirects=False))
+      self.assertEqual((rows, skipped), ([], {'redirect': 1}))
+
+      # a broken stream costs just its own pages
+      ranges, results = queue.Queue(), queue.Queue()
+      ranges.put((0, (2, streams[1][0]), [(streams[0][0], streams[0][0] + 10), streams[1]]))
+      ranges.put(None)
+      extract_streams(dump, ranges, results)
+      seq, position, rows = results.get()
+      self.assertEqual([row[1] for row in rows], ['Anarchism'])
+      self.assertEqual((results.get(), results.get()), ({'broken stream': 1}, None))
+
+  def test_fast_extractor(self):
+    self.assertEqual(scan_wikitext(SNIPPETS[1]), (['Infobox person', 'birth date'], ['People in Foo', 'Bar']))
+    self.assertIsNone(scan_wikitext(SNIPPETS[3]))
+    for idx, text in enumerate(SNIPPETS):
+      self.assertEqual(compare_page(idx, 'Snippet %d' % idx, text), [], text)
+
+    comparison = Comparison(verbose=False)
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(WikiXmlHandler(comparison, extract=None))
+    parser.feed(DUMP)
+    self.assertEqual((comparison.pages, comparison.scanned, comparison.mismatches), (2, 2, []))
 
   def test_extact_general(self):
     self.assertEqual(extact_general('something something dark'), None)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+import psycopg2
+
+from checkpoint import Checkpoint
+
+
+class Step(object):
+  """A unit of post-load work: statements executed in one transaction once all steps named in deps are
+  done. maintenance_work_mem (e.g. '1GB') is set for just this transaction; builds running at the same
+  time each get their own, so keep workers * maintenance_work_mem within what the server can spare."""
+
+  def __init__(self, name, statements, deps=(), maintenance_work_mem=None):
+    self.name = name
+    self.statements = [statements] if isinstance(statements, str) else list(statements)
+    self.deps = set(deps)
+    self.maintenance_work_mem = maintenance_work_mem
+
+
+class IndexBuilder(object):
+  """Runs steps on up to workers connections at once, each step as soon as its dependencies are done.
+  timings holds the seconds every finished step took. If a step fails no new steps are started and
+  run() raises the first error once the running ones are done.
+
+  With a checkpoint name, every step records that it's done in import.checkpoint, as <checkpoint>/<step> in
+  its own transaction. With resume the steps recorded before are skipped, so running the build again after a
+  crash doesn't trip over the indexes and constraints that are already there; without, the records are
+  cleared."""
+
+  def __init__(self, connection_string, steps, workers=4, connect=psycopg2.connect, checkpoint=None, resume=False):
+    names = set(step.name for step in steps)
+    if len(names) != len(steps):
+      raise ValueError('step names must be unique')
+    for step in steps:
+      missing = step.deps - names
+      if missing:
+        raise ValueError('%s depends on unknown steps %s' % (step.name, ', '.join(sorted(missing))))
+    self._connection_string = connection_string
+    self._connect = connect
+    self._workers = workers
+    self._checkpoint = checkpoint
+    self._resume = resume
+    self._pending = list(steps)
+    self._running = set()
+    self._done = set()
+    self._error = None
+    self._lock = threading.Condition()
+    self.timings = {}
+
+  def _next_step(self):
+    """Block until a step can start and return it, or return None once there's nothing left to start."""
+    with self._lock:
+      while True:
+        if self._error or not self._pending:
+          return None
+        for step in self._pending:
+          if step.deps <= self._done:
+            self._pending.remove(step)
+            self._running.add(step.name)
+            return step
+        if not self._running:
+          self._error = ValueError('circular dependencies between %s' %
+                                   ', '.join(step.name for step in self._pending))
+          self._lock.notify_all()
+          return None
+        self._lock.wait()
+
+  def _finish(self, step, error=None):
+    with self._lock:
+      self._running.discard(step.name)
+      if error:
+        self._error = self._error or error
+      else:
+        self._done.add(step.name)
+      self._lock.notify_all()
+
+  def _work(self):
+    try:
+      conn = self._connect(self._connection_string)
+    except Exception as e:
+      with self._lock:
+        self._error = self._error or e
+        self._lock.notify_all()
+      return
+    cursor = conn.cursor()
+    try:
+      for step in iter(self._next_step, None):
+        start = time.time()
+        try:
+          if step.maintenance_work_mem:
+            cursor.execute('SET LOCAL maintenance_work_mem = %s', (step.maintenance_work_mem,))
+          for statement in step.statements:
+            cursor.execute(statement)
+          if self._checkpoint:
+            self._step_checkpoint(cursor, step).save(1)
+          conn.commit()
+        except Exception as e:
+          conn.rollback()
+          self._finish(step, e)
+          print('FAILED', step.name, e)
+          continue
+        self.timings[step.name] = time.time() - start
+        print('%s took %.1fs' % (step.name, self.timings[step.name]))
+        self._finish(step)
+    finally:
+      conn.close()
+
+  def _step_checkpoint(self, cursor, step):
+    return Checkpoint(cursor, '%s/%s' % (self._checkpoint, step.name))
+
+  def _skip_done(self):
+    conn = self._connect(self._connection_string)
+    cursor = conn.cursor()
+    try:
+      for step in list(self._pending):
+        checkpoint = self._step_checkpoint(cursor, step)
+        if not self._resume:
+          checkpoint.clear()
+        elif checkpoint.position:
+          print(step.name, 'was done before')
+          self._pending.remove(step)
+          self._done.add(step.name)
+      conn.commit()
+    finally:
+      conn.close()
+
+  def run(self):
+    start = time.time()
+    if self._checkpoint:
+      self._skip_done()
+    threads = [threading.Thread(target=self._work) for _ in range(min(self._workers, len(self._pending)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if self._error:
+      raise self._error
+    print('Built %d steps in %.1fs, the slowest were:' % (len(self.timings), time.time() - start))
+    for name, seconds in sorted(self.timings.items(), key=lambda item: -item[1])[:5]:
+      print('  %s: %.1fs' % (name, seconds))
+    return self.timings
+
+
+def report_indexes(cursor, schema, tables, timings):
+  """Print the size of every index on tables in schema, biggest first, with the time its step took to build
+  (steps named after their index). Returns (index, table, size in bytes, seconds or None) for each."""
+  cursor.execute('SELECT idx.relname, tbl.relname, pg_relation_size(idx.oid) '
+                 'FROM pg_index '
+                 'JOIN pg_class idx ON idx.oid = pg_index.indexrelid '
+                 'JOIN pg_class tbl ON tbl.oid = pg_index.indrelid '
+                 'JOIN pg_namespace ON pg_namespace.oid = tbl.relnamespace '
+                 'WHERE pg_namespace.nspname = %s AND tbl.relname = ANY(%s) '
+                 'ORDER BY 3 DESC', (schema, list(tables)))
+  rows = [(name, table, size, timings.get(name)) for name, table, size in cursor.fetchall()]
+  print('%-50s %-12s %12s %10s' % ('index', 'table', 'MB', 'seconds'))
+  for name, table, size, seconds in rows:
+    print('%-50s %-12s %12.1f %10s' % (name, table, size / (1 << 20), '-' if seconds is None else '%.1f' % seconds))
+  print('%-50s %-12s %12.1f' % ('total', '', sum(row[2] for row in rows) / (1 << 20)))
+  return rows
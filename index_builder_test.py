@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import threading
+import unittest
+
+from index_builder import IndexBuilder, Step, report_indexes
+
+
+class FakeDb():
+  """With parallel, the first that many commits wait for each other, so they only get through if the steps
+  really run at the same time."""
+  def __init__(self, parallel=0):
+    self.lock = threading.Lock()
+    self.log = []
+    self.active = 0
+    self.max_active = 0
+    self.commits = 0
+    self.parallel = parallel
+    self.barrier = threading.Barrier(parallel, timeout=10) if parallel else None
+    self.checkpoints = set()
+
+  def connect(self, connection_string):
+    return FakeConn(self)
+
+
+class FakeConn():
+  def __init__(self, db):
+    self.db = db
+    self.statements = []
+
+  def cursor(self):
+    return self
+
+  def execute(self, sql, params=None):
+    if sql == 'FAIL':
+      raise RuntimeError('failed')
+    if 'import.checkpoint' in sql or sql == 'CREATE SCHEMA IF NOT EXISTS import;':
+      # only what Checkpoint does, applied straight away
+      if sql.startswith('SELECT'):
+        self.row = (1, None, None) if params[0] in self.db.checkpoints else None
+      elif sql.startswith('INSERT'):
+        self.db.checkpoints.add(params[0])
+      elif sql.startswith('DELETE'):
+        self.db.checkpoints.discard(params[0])
+      return
+    self.statements.append(sql % params if params else sql)
+
+  def fetchone(self):
+    return self.row
+
+  def commit(self):
+    with self.db.lock:
+      self.db.active += 1
+      self.db.max_active = max(self.db.max_active, self.db.active)
+      wait = self.db.commits < self.db.parallel
+      self.db.commits += 1
+    if wait:
+      self.db.barrier.wait()
+    with self.db.lock:
+      self.db.active -= 1
+      self.db.log.append(self.statements)
+    self.statements = []
+
+  def rollback(self):
+    self.statements = []
+
+  def close(self):
+    pass
+
+
+class TestIndexBuilder(unittest.TestCase):
+  def test_dependencies(self):
+    db = FakeDb(parallel=3)
+    steps = [Step('constraint', 'ALTER', deps=['pkey', 'unique']),
+             Step('pkey', 'PKEY'),
+             Step('unique', 'UNIQUE'),
+             Step('gin', 'GIN', maintenance_work_mem='1GB'),
+             Step('geo', ['CREATE geo', 'INSERT geo']),
+             Step('geo_index', 'GIST', deps=['geo'])]
+    timings = IndexBuilder('', steps, workers=3, connect=db.connect).run()
+    self.assertEqual(set(timings), set(step.name for step in steps))
+    order = [statements[-1] for statements in db.log]
+    self.assertTrue(order.index('ALTER') > max(order.index('PKEY'), order.index('UNIQUE')))
+    self.assertTrue(order.index('GIST') > order.index('INSERT geo'))
+    self.assertIn(['SET LOCAL maintenance_work_mem = 1GB', 'GIN'], db.log)
+    self.assertEqual(db.max_active, 3)
+
+  def test_errors(self):
+    db = FakeDb()
+    with self.assertRaises(ValueError):
+      IndexBuilder('', [Step('a', 'A', deps=['b'])], connect=db.connect)
+    with self.assertRaises(ValueError):
+      IndexBuilder('', [Step('a', 'A', deps=['b']), Step('b', 'B', deps=['a'])], connect=db.connect).run()
+    with self.assertRaises(RuntimeError):
+      IndexBuilder('', [Step('a', 'FAIL'), Step('b', 'B', deps=['a'])], connect=db.connect).run()
+    self.assertEqual(db.log, [])
+
+  def test_resume(self):
+    db = FakeDb()
+    steps = [Step('pkey', 'PKEY'), Step('gin', 'FAIL'), Step('constraint', 'ALTER', deps=['pkey', 'gin'])]
+    with self.assertRaises(RuntimeError):
+      IndexBuilder('', steps, workers=1, connect=db.connect, checkpoint='test').run()
+    self.assertEqual(db.checkpoints, {'test/pkey'})
+    steps[1] = Step('gin', 'GIN')
+    IndexBuilder('', steps, workers=1, connect=db.connect, checkpoint='test', resume=True).run()
+    self.assertEqual([statements for statements in db.log if statements], [['PKEY'], ['GIN'], ['ALTER']])
+    self.assertEqual(db.checkpoints, {'test/pkey', 'test/gin', 'test/constraint'})
+    # starting over builds everything again
+    timings = IndexBuilder('', steps, workers=1, connect=db.connect, checkpoint='test').run()
+    self.assertEqual(set(timings), {'pkey', 'gin', 'constraint'})
+
+  def test_report_indexes(self):
+    class FakeCursor():
+      def execute(self, sql, params=None):
+        self.params = params
+
+      def fetchall(self):
+        return [('gin', 'wikidata', 3 << 20), ('wikidata_pkey', 'wikidata', 1 << 20)]
+
+    cursor = FakeCursor()
+    rows = report_indexes(cursor, 'import', ('wikidata', 'geo'), {'gin': 2.5, 'constraints': 0.1})
+    self.assertEqual(cursor.params, ('import', ['wikidata', 'geo']))
+    self.assertEqual(rows, [('gin', 'wikidata', 3 << 20, 2.5), ('wikidata_pkey', 'wikidata', 1 << 20, None)])
+
+
+if __name__ == '__main__':
+  unittest.main()
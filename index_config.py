@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import json
+import re
+
+from index_builder import Step
+
+IDENTIFIER_RE = re.compile(r'^[a-z_][a-z0-9_]*$')
+METHODS = ('btree', 'gin')
+
+
+def property_expression(key, method):
+  """The expression indexed for a property: its text for btree, its json for gin (so @> can use it)."""
+  return "(properties %s '%s'::text)" % ('->>' if method == 'btree' else '->', key.replace("'", "''"))
+
+
+class IndexConfig(object):
+  """Which property keys of wikidata get indexes of their own.
+
+  properties_gin is the GIN index on all of properties, which serves any @> query but is by far the
+  biggest index. indexes are expression indexes on single keys, each a dict with a name, a key and a
+  method (btree or gin). columns break keys out into generated text columns with a btree index, each a
+  dict with a name for the column and a key; setup_db creates them, so they are filled during the load.
+  """
+
+  def __init__(self, properties_gin=True, indexes=(), columns=()):
+    self.properties_gin = properties_gin
+    self.indexes = [dict(index, method=index.get('method', 'btree')) for index in indexes]
+    self.columns = list(columns)
+    names = [index['name'] for index in self.indexes] + [column['name'] for column in self.columns]
+    for name in names:
+      if not IDENTIFIER_RE.match(name):
+        raise ValueError('%r is not a valid index or column name' % name)
+    if len(set(names)) != len(names):
+      raise ValueError('index and column names must be unique')
+    for index in self.indexes:
+      if index['method'] not in METHODS:
+        raise ValueError('unknown index method %r for %s' % (index['method'], index['name']))
+
+  def column_definitions(self):
+    """The generated columns, to add to wikidata's CREATE TABLE."""
+    return ['%s TEXT GENERATED ALWAYS AS %s STORED' % (column['name'], property_expression(column['key'], 'btree'))
+            for column in self.columns]
+
+  def steps(self, schema, maintenance_work_mem=None):
+    """IndexBuilder steps for the indexes."""
+    steps = []
+    if self.properties_gin:
+      steps.append(Step('wd_wikidata_properties',
+                        'CREATE INDEX wd_wikidata_properties ON %s.wikidata USING gin(properties)' % schema,
+                        maintenance_work_mem=maintenance_work_mem))
+    for index in self.indexes:
+      steps.append(Step(index['name'],
+                        'CREATE INDEX %s ON %s.wikidata USING %s (%s)' % (
+                            index['name'], schema, index['method'], property_expression(index['key'], index['method'])),
+                        maintenance_work_mem=maintenance_work_mem if index['method'] == 'gin' else None))
+    for column in self.columns:
+      name = 'wd_wikidata_' + column['name']
+      steps.append(Step(name, 'CREATE INDEX %s ON %s.wikidata (%s)' % (name, schema, column['name'])))
+    return steps
+
+
+# what the import always built
+DEFAULT_INDEX_CONFIG = IndexConfig(indexes=[
+  {'name': 'wd_wikidata_properties_located_admin_btree', 'method': 'btree',
+   'key': 'located in the administrative territorial entity'},
+  {'name': 'wd_wikidata_properties_located_admin_gin', 'method': 'gin',
+   'key': 'located in the administrative territorial entity'},
+])
+
+
+def load_index_config(path):
+  """Read an IndexConfig from a json file with its arguments, e.g.
+    {"properties_gin": false,
+     "indexes": [{"name": "wd_instance_of_gin", "key": "instance of", "method": "gin"}],
+     "columns": [{"name": "country", "key": "country"}]}
+  """
+  with open(path) as f:
+    return IndexConfig(**json.load(f))
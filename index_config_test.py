@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+import unittest
+
+from import_wikidata import post_load_steps
+from index_config import DEFAULT_INDEX_CONFIG, IndexConfig, load_index_config
+
+
+class TestIndexConfig(unittest.TestCase):
+  def test_default(self):
+    steps = {step.name: step for step in post_load_steps('import', '1GB')}
+    self.assertIn('wd_wikidata_properties', steps)
+    self.assertEqual(steps['wd_wikidata_properties_located_admin_btree'].statements,
+                     ["CREATE INDEX wd_wikidata_properties_located_admin_btree ON import.wikidata USING btree "
+                      "((properties ->> 'located in the administrative territorial entity'::text))"])
+    self.assertEqual(steps['wd_wikidata_properties_located_admin_gin'].maintenance_work_mem, '1GB')
+    self.assertEqual(DEFAULT_INDEX_CONFIG.column_definitions(), [])
+    self.assertLessEqual(set(steps) - {'constraints'}, steps['constraints'].deps)
+
+  def test_load(self):
+    config = {'properties_gin': False,
+              'indexes': [{'name': 'wd_instance_of_gin', 'key': 'instance of', 'method': 'gin'},
+                          {'name': 'wd_occupation', 'key': "occupation's"}],
+              'columns': [{'name': 'country', 'key': 'country'}]}
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'indexes.json')
+      with open(path, 'w') as f:
+        json.dump(config, f)
+      index_config = load_index_config(path)
+    steps = {step.name: step for step in post_load_steps('import', index_config=index_config)}
+    self.assertNotIn('wd_wikidata_properties', steps)
+    self.assertNotIn('wd_wikidata_properties_located_admin_btree', steps)
+    self.assertEqual(steps['wd_instance_of_gin'].statements,
+                     ["CREATE INDEX wd_instance_of_gin ON import.wikidata USING gin ((properties -> 'instance of'::text))"])
+    self.assertEqual(steps['wd_occupation'].statements,
+                     ["CREATE INDEX wd_occupation ON import.wikidata USING btree ((properties ->> 'occupation''s'::text))"])
+    self.assertEqual(steps['wd_wikidata_country'].statements, ['CREATE INDEX wd_wikidata_country ON import.wikidata (country)'])
+    self.assertEqual(index_config.column_definitions(),
+                     ["country TEXT GENERATED ALWAYS AS (properties ->> 'country'::text) STORED"])
+
+  def test_invalid(self):
+    with self.assertRaises(ValueError):
+      IndexConfig(columns=[{'name': 'drop table', 'key': 'country'}])
+    with self.assertRaises(ValueError):
+      IndexConfig(indexes=[{'name': 'wd_country', 'key': 'country', 'method': 'hash'}])
+    with self.assertRaises(ValueError):
+      IndexConfig(indexes=[{'name': 'country', 'key': 'country'}], columns=[{'name': 'country', 'key': 'country'}])
+
+
+if __name__ == '__main__':
+  unittest.main()
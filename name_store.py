@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import argparse
+from array import array
+import bisect
+import heapq
+import json
+import mmap
+import os
+import struct
+
+NAMES_FILE = 'names.bin'
+# names added or changed since names.bin was written, one json [id, name] per line
+NAMES_LOG = 'names.log'
+PROPERTIES_FILE = 'properties.json'
+# NamesLog.compact folds the log into names.bin once it has this many entries
+COMPACT_AT = 1000000
+
+# NameStoreWriter.save sorts the keys in runs of this many
+SORT_RUN = 1 << 20
+# and writes them out this many at a time
+WRITE_CHUNK = 1 << 16
+
+MAGIC = b'WDNAMES1'
+HEADER = struct.Struct('<8sQ')
+
+
+def entity_key(entity_id):
+  """Q42 -> 42, P31 -> -31. None for ids the store can't hold (lexemes, forms, ...)."""
+  if entity_id and entity_id[0] in 'QP' and entity_id[1:].isdigit():
+    n = int(entity_id[1:])
+    return n if entity_id[0] == 'Q' else -n
+  return None
+
+
+def entity_name(d):
+  """The name other entities refer to d by: its english wikipedia title, or else its english label."""
+  sitelinks = d.get('sitelinks')
+  if isinstance(sitelinks, dict) and sitelinks.get('enwiki'):
+    return sitelinks['enwiki']['title']
+  labels = d.get('labels')
+  if isinstance(labels, dict) and labels.get('en'):
+    return labels['en']['value']
+  return None
+
+
+def entity_id(key):
+  """The inverse of entity_key: 42 -> Q42, -31 -> P31."""
+  return 'Q%d' % key if key >= 0 else 'P%d' % -key
+
+
+class NameStore(object):
+  """Read-only entity id -> name map, memory mapped from a file written by NameStoreWriter.
+
+  The file holds a header, the sorted integer keys, the offsets of the names and then the names as
+  one utf-8 blob. Lookups bisect the keys, so opening the store costs nothing and only the pages
+  touched become resident. Supports the bits of the dict interface map_value uses.
+  """
+
+  def __init__(self, path):
+    self._file = open(path, 'rb')
+    self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count = HEADER.unpack_from(self._mmap)
+    if magic != MAGIC:
+      raise ValueError('%s is not a name store' % path)
+    view = memoryview(self._mmap)
+    keys_end = HEADER.size + 8 * count
+    offsets_end = keys_end + 8 * (count + 1)
+    self._keys = view[HEADER.size:keys_end].cast('q')
+    self._offsets = view[keys_end:offsets_end].cast('Q')
+    self._blob = view[offsets_end:]
+
+  def _index(self, entity_id):
+    key = entity_key(entity_id)
+    if key is None:
+      return None
+    idx = bisect.bisect_left(self._keys, key)
+    if idx < len(self._keys) and self._keys[idx] == key:
+      return idx
+    return None
+
+  def get(self, entity_id, default=None):
+    idx = self._index(entity_id)
+    if idx is None:
+      return default
+    return str(self._blob[self._offsets[idx]:self._offsets[idx + 1]], 'utf-8')
+
+  def __getitem__(self, entity_id):
+    name = self.get(entity_id)
+    if name is None:
+      raise KeyError(entity_id)
+    return name
+
+  def __contains__(self, entity_id):
+    return self._index(entity_id) is not None
+
+  def __len__(self):
+    return len(self._keys)
+
+  def items(self):
+    """(entity_id, name) for every entity, in key order."""
+    for idx, key in enumerate(self._keys):
+      yield entity_id(key), str(self._blob[self._offsets[idx]:self._offsets[idx + 1]], 'utf-8')
+
+  def close(self):
+    for view in self._keys, self._offsets, self._blob:
+      view.release()
+    self._mmap.close()
+    self._file.close()
+
+
+class NameStoreWriter(object):
+  """Collects id -> name pairs in compact arrays and writes them out as a NameStore file. Ids the store
+  can't hold are dropped; if an id is added twice the last name wins."""
+
+  def __init__(self):
+    self._keys = array('q')
+    self._offsets = array('Q', [0])
+    self._blob = bytearray()
+
+  def __setitem__(self, entity_id, name):
+    key = entity_key(entity_id)
+    if key is not None:
+      self._keys.append(key)
+      self._blob += name.encode('utf-8')
+      self._offsets.append(len(self._blob))
+
+  def __len__(self):
+    return len(self._keys)
+
+  def _order(self):
+    """The indices of the keys in key order, keeping only the last index of keys added more than once.
+
+    Keys and indices are packed into one 64 bit integer each, which are sorted in runs of SORT_RUN and merged,
+    so this takes a few bytes per key rather than a list of python ints. That packing holds ids below 2^31.
+    """
+    keys = self._keys
+    if all(keys[idx] < keys[idx + 1] for idx in range(len(keys) - 1)):
+      return range(len(keys))
+    # the P ids (negative keys) come between the Q ids, so the keys are never quite in order
+    runs = [array('q', sorted((keys[idx] << 32) | idx for idx in range(start, min(start + SORT_RUN, len(keys)))))
+            for start in range(0, len(keys), SORT_RUN)]
+    order = array('I')
+    previous = None
+    for packed in heapq.merge(*runs):
+      key = packed >> 32
+      if key == previous:
+        order[-1] = packed & 0xffffffff
+      else:
+        order.append(packed & 0xffffffff)
+        previous = key
+    return order
+
+  def save(self, path):
+    keys = self._keys
+    order = self._order()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(HEADER.pack(MAGIC, len(order)))
+      for start in range(0, len(order), WRITE_CHUNK):
+        f.write(array('q', (keys[idx] for idx in order[start:start + WRITE_CHUNK])).tobytes())
+      offset = 0
+      f.write(array('Q', [offset]).tobytes())
+      for start in range(0, len(order), WRITE_CHUNK):
+        offsets = array('Q')
+        for idx in order[start:start + WRITE_CHUNK]:
+          offset += self._offsets[idx + 1] - self._offsets[idx]
+          offsets.append(offset)
+        f.write(offsets.tobytes())
+      for idx in order:
+        f.write(self._blob[self._offsets[idx]:self._offsets[idx + 1]])
+    os.replace(tmp_path, path)
+
+
+class NamesLog(object):
+  """A NameStore with the names added since it was written on top, as the updates find them. New names are
+  appended to a log next to the store, so keeping the map current costs a line per change instead of
+  rewriting the store; compact() folds the log back in once it has grown.
+
+  New names are only written to the log by flush(), which the updater calls right before it commits the batch
+  they came with. A batch that doesn't get committed is applied again, and then its names are new again too.
+  """
+
+  def __init__(self, path, log_path):
+    self._path = path
+    self._log_path = log_path
+    self._store = NameStore(path)
+    self._names = {}
+    # log lines of the names set since the last flush
+    self._pending = []
+    line = '\n'
+    if os.path.isfile(log_path):
+      with open(log_path, encoding='utf-8') as f:
+        for line in f:
+          try:
+            entity_id, name = json.loads(line)
+          except ValueError:
+            # the last line of a log that was being written when we went down
+            continue
+          self._names[entity_id] = name
+    self._log = open(log_path, 'a', encoding='utf-8')
+    if not line.endswith('\n'):
+      self._log.write('\n')
+
+  def get(self, entity_id, default=None):
+    name = self._names.get(entity_id)
+    if name is None:
+      return self._store.get(entity_id, default)
+    return name
+
+  def __getitem__(self, entity_id):
+    name = self.get(entity_id)
+    if name is None:
+      raise KeyError(entity_id)
+    return name
+
+  def __contains__(self, entity_id):
+    return entity_id in self._names or entity_id in self._store
+
+  def set(self, entity_id, name):
+    """Record the name of entity_id. Returns whether that changed it, i.e. it's new or renamed."""
+    if entity_key(entity_id) is None or self.get(entity_id) == name:
+      return False
+    self._names[entity_id] = name
+    self._pending.append(json.dumps([entity_id, name], ensure_ascii=False) + '\n')
+    return True
+
+  def flush(self):
+    self._log.write(''.join(self._pending))
+    self._pending = []
+    self._log.flush()
+
+  def compact(self, min_entries=COMPACT_AT):
+    """Write the store with the log folded in and start a new log, if the log has at least min_entries."""
+    if len(self._names) < min_entries:
+      return
+    self.flush()
+    writer = NameStoreWriter()
+    for entity_id, name in self._store.items():
+      writer[entity_id] = name
+    for entity_id, name in self._names.items():
+      writer[entity_id] = name
+    self._store.close()
+    writer.save(self._path)
+    self._log.close()
+    self._log = open(self._log_path, 'w', encoding='utf-8')
+    self._names = {}
+    self._store = NameStore(self._path)
+
+  def close(self):
+    """Names set since the last flush are dropped, they came with a batch that wasn't committed."""
+    self._log.close()
+    self._store.close()
+
+
+def convert(properties_path, path):
+  """Write the map in a properties.json, as older imports left behind, to a name store at path."""
+  writer = NameStoreWriter()
+  for entity_id, name in json.load(open(properties_path)).items():
+    writer[entity_id] = name
+  writer.save(path)
+
+
+def open_names(directory='.', log=False):
+  """Open the name store in directory, creating it from properties.json there if that's all there is.
+  Returns None if there is neither. With log, returns a NamesLog that can take new names."""
+  path = os.path.join(directory, NAMES_FILE)
+  if not os.path.isfile(path):
+    properties_path = os.path.join(directory, PROPERTIES_FILE)
+    if not os.path.isfile(properties_path):
+      return None
+    print('converting', properties_path, 'to', path)
+    convert(properties_path, path)
+  if log:
+    return NamesLog(path, os.path.join(directory, NAMES_LOG))
+  return NameStore(path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert a properties.json id -> name map to a name store')
+  parser.add_argument('properties', type=str,
+                      help='properties.json written by import_wikidata')
+  parser.add_argument('store', type=str, nargs='?', default=NAMES_FILE,
+                      help='name store to write')
+
+  args = parser.parse_args()
+  convert(args.properties, args.store)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from name_store import NAMES_FILE, NAMES_LOG, NameStore, NameStoreWriter, entity_id, entity_key, entity_name, open_names
+
+
+class TestNameStore(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self._tmp.name, NAMES_FILE)
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def test_entity_key(self):
+    self.assertEqual(entity_key('Q42'), 42)
+    self.assertEqual(entity_key('P31'), -31)
+    self.assertIsNone(entity_key('L7'))
+    self.assertIsNone(entity_key('Q'))
+    self.assertEqual((entity_id(42), entity_id(-31)), ('Q42', 'P31'))
+
+  def test_lookup(self):
+    writer = NameStoreWriter()
+    for entity_id, name in (('Q5', 'human'), ('P31', 'instance of'), ('Q2', 'Earth'), ('L1', 'lexeme'),
+                            ('Q64', 'Berlin'), ('Q2', 'earth'), ('Q90', 'Paris, ville lumière')):
+      writer[entity_id] = name
+    writer.save(self.path)
+
+    names = NameStore(self.path)
+    self.assertEqual(len(names), 5)
+    self.assertEqual(names.get('Q5'), 'human')
+    self.assertEqual(names['P31'], 'instance of')
+    self.assertEqual(names.get('Q2'), 'earth')
+    self.assertEqual(names.get('Q90'), 'Paris, ville lumière')
+    self.assertIsNone(names.get('Q3'))
+    self.assertIsNone(names.get('L1'))
+    self.assertEqual(names.get('P5', 'missing'), 'missing')
+    self.assertEqual(list(names.items()), [('P31', 'instance of'), ('Q2', 'earth'), ('Q5', 'human'),
+                                           ('Q64', 'Berlin'), ('Q90', 'Paris, ville lumière')])
+    self.assertTrue('Q64' in names)
+    self.assertFalse('Q31' in names)
+    with self.assertRaises(KeyError):
+      names['Q1']
+    names.close()
+
+  def test_sort_runs(self):
+    writer = NameStoreWriter()
+    ids = ['Q%d' % n for n in range(20, 0, -1)] + ['P%d' % n for n in range(1, 8)] + ['Q3', 'P2']
+    for idx, entity_id in enumerate(ids):
+      writer[entity_id] = '%s/%d' % (entity_id, idx)
+    with mock.patch('name_store.SORT_RUN', 4), mock.patch('name_store.WRITE_CHUNK', 3):
+      writer.save(self.path)
+
+    names = NameStore(self.path)
+    self.assertEqual(len(names), 27)
+    self.assertEqual([entity_id for entity_id, name in names.items()][:8],
+                     ['P7', 'P6', 'P5', 'P4', 'P3', 'P2', 'P1', 'Q1'])
+    # the last name added wins, also when the two are in different runs
+    self.assertEqual((names['Q3'], names['P2'], names['Q20']), ('Q3/27', 'P2/28', 'Q20/0'))
+    names.close()
+
+  def test_empty(self):
+    NameStoreWriter().save(self.path)
+    names = NameStore(self.path)
+    self.assertEqual((len(names), names.get('Q1')), (0, None))
+    names.close()
+
+  def test_open_names(self):
+    self.assertIsNone(open_names(self._tmp.name))
+    with open(os.path.join(self._tmp.name, 'properties.json'), 'w') as f:
+      json.dump({'Q1': 'universe', 'P17': 'country'}, f)
+    names = open_names(self._tmp.name)
+    self.assertEqual((names.get('Q1'), names.get('P17')), ('universe', 'country'))
+    names.close()
+    self.assertTrue(os.path.isfile(self.path))
+
+  def test_entity_name(self):
+    self.assertEqual(entity_name({'labels': {'en': {'value': 'Amsterdam'}},
+                                  'sitelinks': {'enwiki': {'title': 'Amsterdam (city)'}}}), 'Amsterdam (city)')
+    self.assertEqual(entity_name({'labels': {'en': {'value': 'Amsterdam'}}, 'sitelinks': []}), 'Amsterdam')
+    self.assertIsNone(entity_name({'labels': [], 'sitelinks': []}))
+    self.assertIsNone(entity_name({'entity': 'Q1', 'redirect': 'Q2'}))
+
+  def test_log(self):
+    writer = NameStoreWriter()
+    writer['Q1'] = 'universe'
+    writer['P17'] = 'country'
+    writer.save(self.path)
+
+    names = open_names(self._tmp.name, log=True)
+    self.assertFalse(names.set('Q1', 'universe'))
+    self.assertTrue(names.set('Q1', 'Universe'))
+    self.assertTrue(names.set('Q2', 'Earth'))
+    self.assertFalse(names.set('L1', 'lexeme'))
+    self.assertEqual((names['Q1'], names.get('Q2'), names.get('P17'), 'Q3' in names), ('Universe', 'Earth', 'country', False))
+    names.flush()
+    # names set after the last flush didn't make it into a commit, so they're forgotten
+    self.assertTrue(names.set('Q3', 'Sun'))
+    names.close()
+    with open(os.path.join(self._tmp.name, NAMES_LOG), 'a') as f:
+      f.write('["Q4", "cut o')
+
+    names = open_names(self._tmp.name, log=True)
+    self.assertEqual((names.get('Q1'), names.get('Q2'), names.get('Q3'), names.get('Q4')),
+                     ('Universe', 'Earth', None, None))
+    self.assertTrue(names.set('Q3', 'Sun'))
+    names.set('Q5', 'five')
+    names.flush()
+    names.close()
+    names = open_names(self._tmp.name, log=True)
+    self.assertEqual(names.get('Q5'), 'five')
+    names.compact(min_entries=5)
+    self.assertEqual(len(NameStore(self.path)), 2)
+    names.compact(min_entries=4)
+    names.close()
+    self.assertEqual(os.path.getsize(os.path.join(self._tmp.name, NAMES_LOG)), 0)
+    store = NameStore(self.path)
+    self.assertEqual(list(store.items()),
+                     [('P17', 'country'), ('Q1', 'Universe'), ('Q2', 'Earth'), ('Q3', 'Sun'), ('Q5', 'five')])
+    store.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import queue
+
+# how often a blocked put or join checks on the processes
+PUT_TIMEOUT = 5
+
+
+def put(items, item, writer, workers, timeout=PUT_TIMEOUT):
+  """items.put(item) for a pipeline where the workers take from items and feed the writer process. If the
+  writer exits while we wait for room - it only does that early when it fails - or a worker fails, all processes
+  are terminated and a RuntimeError raised, instead of waiting for room that will never come."""
+  while True:
+    try:
+      items.put(item, timeout=timeout)
+      return
+    except queue.Full:
+      if not writer.is_alive():
+        fail(writer, workers)
+      check_workers(writer, workers)
+
+
+def join(writer, workers, timeout=PUT_TIMEOUT):
+  """Wait for the pipeline to finish once the workers have been sent everything. Raises a RuntimeError if the
+  writer or a worker failed, after terminating the other processes: a worker that dies never tells the writer
+  it's done, and the workers block on feeding a dead writer."""
+  while writer.exitcode is None:
+    writer.join(timeout)
+    check_workers(writer, workers)
+  if writer.exitcode:
+    fail(writer, workers)
+  for process in workers:
+    process.join()
+  check_workers(writer, workers)
+
+
+def check_workers(writer, workers):
+  for process in workers:
+    if process.exitcode:
+      fail(writer, workers, process)
+
+
+def fail(writer, workers, failed=None):
+  """Terminate the processes and raise for the one that failed, the writer unless given."""
+  failed = failed or writer
+  for process in workers + [writer]:
+    if process.is_alive():
+      process.terminate()
+  for process in workers + [writer]:
+    process.join()
+  raise RuntimeError('%s process failed with exit code %s' % ('writer' if failed is writer else 'worker',
+                                                             failed.exitcode))
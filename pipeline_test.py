@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import sys
+import time
+import unittest
+
+import pipeline
+
+
+def fail():
+  sys.exit(3)
+
+
+def block(items):
+  # never takes anything off items, like a worker stuck feeding a dead writer
+  time.sleep(60)
+
+
+def drain(items):
+  for item in iter(items.get, None):
+    pass
+
+
+def work(items, results):
+  for item in iter(items.get, None):
+    if item == 2:
+      raise ValueError('bad item')
+    results.put(item)
+  results.put(None)
+
+
+class TestPipeline(unittest.TestCase):
+  def test_writer_fails(self):
+    items = multiprocessing.Queue(maxsize=1)
+    writer = multiprocessing.Process(target=fail)
+    workers = [multiprocessing.Process(target=block, args=(items, ))]
+    for process in workers + [writer]:
+      process.start()
+    pipeline.put(items, 1, writer, workers, timeout=0.1)
+    with self.assertRaisesRegex(RuntimeError, 'exit code 3'):
+      pipeline.put(items, 2, writer, workers, timeout=0.1)
+    self.assertFalse(workers[0].is_alive())
+
+  def test_worker_fails(self):
+    items = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    # the writer waits for the worker to say it's done, which it never does
+    writer = multiprocessing.Process(target=drain, args=(results, ))
+    workers = [multiprocessing.Process(target=work, args=(items, results))]
+    for process in workers + [writer]:
+      process.start()
+    for item in [1, 2, 3, None]:
+      pipeline.put(items, item, writer, workers, timeout=0.1)
+    with self.assertRaisesRegex(RuntimeError, 'worker process failed with exit code 1'):
+      pipeline.join(writer, workers, timeout=0.1)
+    self.assertFalse(writer.is_alive())
+
+  def test_join(self):
+    items = multiprocessing.Queue(maxsize=1)
+    writer = multiprocessing.Process(target=drain, args=(items, ))
+    writer.start()
+    for item in [1, 2, 3, None]:
+      pipeline.put(items, item, writer, [], timeout=0.1)
+    pipeline.join(writer, [], timeout=0.1)
+    self.assertEqual(writer.exitcode, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+PROJECTION_FILE = 'projection.json'
+
+
+class Projection(object):
+  """Which of an entity's labels and sitelinks to store.
+
+  languages limits the labels to those languages and the sitelinks to the wikis in them (enwiki, but also
+  enwikivoyage for en). Without property_copies the labels and sitelinks dicts are only stored in their
+  own columns, not copied into properties as well. The default keeps everything.
+  """
+
+  def __init__(self, languages=None, property_copies=True):
+    self.languages = sorted(set(languages)) if languages else None
+    self.property_copies = property_copies
+    self._sites = tuple(language.replace('-', '_') + 'wiki' for language in self.languages or ())
+
+  def labels(self, labels):
+    if self.languages is None or not labels:
+      return labels
+    return {language: label for language, label in labels.items() if language in self.languages}
+
+  def sitelinks(self, sitelinks):
+    if self.languages is None or not sitelinks:
+      return sitelinks
+    return {site: link for site, link in sitelinks.items() if site.startswith(self._sites)}
+
+  def properties(self, labels, sitelinks):
+    """The properties an entity starts out with, before its claims are added."""
+    if not self.property_copies:
+      return {}
+    return {'sitelinks': sitelinks, 'labels': labels}
+
+  def save(self, directory='.'):
+    with open(os.path.join(directory, PROJECTION_FILE), 'w') as f:
+      json.dump({'languages': self.languages, 'property_copies': self.property_copies}, f)
+
+
+def load_projection(directory='.'):
+  """The projection the import in directory was made with, so updates store entities the same way."""
+  path = os.path.join(directory, PROJECTION_FILE)
+  if not os.path.isfile(path):
+    return Projection()
+  with open(path) as f:
+    return Projection(**json.load(f))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import tempfile
+import unittest
+
+from import_wikidata import make_record
+from projection import Projection, load_projection
+from wd_updater import parse_props
+
+ENTITY = {
+  'id': 'Q1', 'descriptions': {}, 'claims': {},
+  'labels': {'en': {'value': 'Amsterdam'}, 'nl': {'value': 'Amsterdam'}, 'zh-hant': {'value': '阿姆斯特丹'},
+             'fr': {'value': 'Amsterdam (ville)'}},
+  'sitelinks': {'enwiki': {'title': 'Amsterdam'}, 'enwikivoyage': {'title': 'Amsterdam (travel)'},
+                'frwiki': {'title': 'Amsterdam (fr)'}, 'zh_hantwiki': {'title': 'Amsterdam (zh)'},
+                'commonswiki': {'title': 'Category:Amsterdam'}},
+}
+
+
+class TestProjection(unittest.TestCase):
+  def test_keep_all(self):
+    record = make_record(ENTITY)
+    self.assertEqual(len(record[3]), 4)
+    self.assertEqual(len(record[4]), 5)
+    self.assertEqual(record[6], {'labels': ENTITY['labels'], 'sitelinks': ENTITY['sitelinks']})
+
+  def test_languages(self):
+    projection = Projection(['en', 'zh-hant'], property_copies=False)
+    record = make_record(ENTITY, projection)
+    self.assertEqual(record[:3], ('Amsterdam', 'Amsterdam', 'Q1'))
+    self.assertEqual(record[3], ['Amsterdam', '阿姆斯特丹'])
+    self.assertEqual(record[4], ['Amsterdam', 'Amsterdam (travel)', 'Amsterdam (zh)'])
+    self.assertEqual(record[6], {})
+
+    # the updater stores the same thing
+    wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties = parse_props(ENTITY, {}, projection)
+    self.assertEqual((labels, sitelinks, properties), (record[3], record[4], record[6]))
+
+  def test_save(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      self.assertEqual(load_projection(tmp).languages, None)
+      Projection(['fr', 'en'], property_copies=False).save(tmp)
+      projection = load_projection(tmp)
+    self.assertEqual((projection.languages, projection.property_copies), (['en', 'fr'], False))
+
+
+if __name__ == '__main__':
+  unittest.main()
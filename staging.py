@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+TARGET_SCHEMA = 'import'
+STAGING_SCHEMA = 'import_staging'
+
+
+def unlogged(schema):
+  """Prefix for CREATE TABLE: tables built in the staging schema skip the WAL until they are published."""
+  return 'UNLOGGED ' if schema == STAGING_SCHEMA else ''
+
+
+def publish(cursor, conn, tables, staging=STAGING_SCHEMA, target=TARGET_SCHEMA):
+  """Make the tables built in staging durable and move them into target, replacing the tables with the same
+  name there. Setting the tables logged rewrites them and is committed table by table; the replacement
+  itself happens in a single transaction, so readers see either the old or the new tables, never an empty
+  one. Indexes and constraints move along with their table."""
+  for table in tables:
+    print('Setting', table, 'logged')
+    cursor.execute('ALTER TABLE %s.%s SET LOGGED' % (staging, table))
+    conn.commit()
+  for table in tables:
+    cursor.execute('DROP TABLE IF EXISTS %s.%s' % (target, table))
+    cursor.execute('ALTER TABLE %s.%s SET SCHEMA %s' % (staging, table, target))
+  conn.commit()
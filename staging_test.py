@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import unittest
+
+from staging import STAGING_SCHEMA, publish, unlogged
+
+
+class FakeCursor():
+  def __init__(self, log):
+    self.log = log
+
+  def execute(self, sql):
+    self.log.append(sql)
+
+
+class FakeConn():
+  def __init__(self, log):
+    self.log = log
+
+  def commit(self):
+    self.log.append('COMMIT')
+
+
+class TestStaging(unittest.TestCase):
+  def test_unlogged(self):
+    self.assertEqual(unlogged(STAGING_SCHEMA), 'UNLOGGED ')
+    self.assertEqual(unlogged('import'), '')
+
+  def test_publish(self):
+    log = []
+    publish(FakeCursor(log), FakeConn(log), ['wikidata', 'geo'])
+    self.assertEqual(log, [
+      'ALTER TABLE import_staging.wikidata SET LOGGED', 'COMMIT',
+      'ALTER TABLE import_staging.geo SET LOGGED', 'COMMIT',
+      'DROP TABLE IF EXISTS import.wikidata', 'ALTER TABLE import_staging.wikidata SET SCHEMA import',
+      'DROP TABLE IF EXISTS import.geo', 'ALTER TABLE import_staging.geo SET SCHEMA import',
+      'COMMIT'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import calendar
+import re
+
+from name_store import entity_key
+
+CLAIMS_COLUMNS = ('wikidata_id', 'property', 'quantity', 'unit', 'time', 'precision')
+REFS_COLUMNS = ('wikidata_id', 'ref')
+ENTITY_CLAIMS_COLUMNS = ('wikidata_id', 'claims')
+
+TIME_RE = re.compile(r'([-+]?[0-9]+)-([0-9][0-9])-([0-9][0-9])T([0-9][0-9]):([0-9][0-9]):([0-9][0-9])Z?')
+
+# the years postgres' timestamp can hold, see claim_time
+MAX_YEAR_AD = 9999
+MAX_YEAR_BC = 4713
+
+
+def compact_claims(claims):
+  """Keep just the rank and value of the claims, which is all map_claims and typed_claims look at."""
+  compact = {}
+  for prop_id, prop_claims in claims.items():
+    values = [(claim['rank'], claim['mainsnak']['datavalue'])
+              for claim in prop_claims if claim.get('mainsnak') and claim['mainsnak'].get('datavalue')]
+    if values:
+      compact[prop_id] = values
+  return compact
+
+
+def claim_time(value):
+  """A wikidata time value as a postgres timestamp literal, or None if it doesn't fit in one.
+
+  Like map_value, unknown months and days (00) become the first. Negative years are taken to be
+  years BC, the way wikidata uses them. Dates that don't exist in postgres' (proleptic gregorian) calendar,
+  like the julian 1500-02-29, are left out too: one of them would fail the whole COPY.
+  """
+  time_split = TIME_RE.match(value.get('time', ''))
+  if not time_split:
+    return None
+  year, month, day, hour, minute, second = map(int, time_split.groups())
+  if year == 0 or year > MAX_YEAR_AD or -year > MAX_YEAR_BC:
+    return None
+  month, day = month or 1, day or 1
+  # 1 BC is year 0 when counting astronomically, which is what the leap years go by
+  leap = calendar.isleap(year + 1 if year < 0 else year)
+  if month > 12 or day > calendar.mdays[month] + (month == 2 and leap) or hour > 23 or minute > 59 or second > 59:
+    return None
+  return '%04d-%02d-%02d %02d:%02d:%02d%s' % (abs(year), month, day, hour, minute, second,
+                                              ' BC' if year < 0 else '')
+
+
+def claim_unit(value):
+  """The entity id of a quantity's unit, or None if it has none."""
+  unit = value.get('unit', '1')
+  if unit == '1':
+    return None
+  return unit.rsplit('/', 1)[-1]
+
+
+def typed_claims(wikidata_id, claims):
+  """The rows for the claims table of an entity with (compacted) claims: one for every quantity or time
+  value of its best rank claims, which is the preferred ones if there are any and the normal ones
+  otherwise. Properties are kept as ids, so queries don't depend on names:
+    SELECT wikidata_id FROM claims WHERE property = 'P1082' AND quantity > 1000000
+  """
+  rows = []
+  for prop_id, values in claims.items():
+    typed = [(rank, datavalue) for rank, datavalue in values
+             if datavalue.get('type') in ('quantity', 'time') and isinstance(datavalue.get('value'), dict)]
+    ranks = {rank for rank, datavalue in typed}
+    best = 'preferred' if 'preferred' in ranks else 'normal'
+    for rank, datavalue in typed:
+      if rank != best:
+        continue
+      value = datavalue['value']
+      if datavalue['type'] == 'quantity':
+        try:
+          rows.append((wikidata_id, prop_id, float(value['amount']), claim_unit(value), None, None))
+        except (KeyError, ValueError):
+          pass
+      else:
+        time = claim_time(value)
+        if time:
+          rows.append((wikidata_id, prop_id, None, None, time, value.get('precision')))
+  return rows
+
+
+def entity_refs(wikidata_id, claims):
+  """The rows for the refs table of an entity with (compacted) claims: the ids of the entities its claims point
+  to, whose names are the values of its properties. When one of those gets a new name, the entity's row is
+  stale. The property ids aren't in there, a renamed property is renamed in place (see BatchUpdater), since
+  the likes of P31 are used by nearly every row."""
+  refs = set()
+  for prop_id, values in claims.items():
+    for rank, datavalue in values:
+      value = datavalue.get('value')
+      if datavalue.get('type') == 'wikibase-entityid' and isinstance(value, dict) and value.get('id'):
+        refs.add(value['id'])
+  return [(wikidata_id, ref) for ref in sorted(refs) if entity_key(ref) is not None]
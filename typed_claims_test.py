@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import unittest
+
+from typed_claims import claim_time, compact_claims, entity_refs, typed_claims
+
+
+def snak(typ, value, rank='normal'):
+  return {'rank': rank, 'mainsnak': {'datavalue': {'type': typ, 'value': value}}}
+
+
+class TestTypedClaims(unittest.TestCase):
+  def test_claim_time(self):
+    self.assertEqual(claim_time({'time': '+1952-03-11T00:00:00Z'}), '1952-03-11 00:00:00')
+    self.assertEqual(claim_time({'time': '+1900-00-00T00:00:00Z'}), '1900-01-01 00:00:00')
+    self.assertEqual(claim_time({'time': '-0044-03-15T00:00:00Z'}), '0044-03-15 00:00:00 BC')
+    self.assertIsNone(claim_time({'time': '-13798000000-00-00T00:00:00Z'}))
+    self.assertIsNone(claim_time({'time': '+0000-00-00T00:00:00Z'}))
+    # a julian leap day that postgres' calendar doesn't have
+    self.assertIsNone(claim_time({'time': '+1500-02-29T00:00:00Z'}))
+    self.assertEqual(claim_time({'time': '+1600-02-29T00:00:00Z'}), '1600-02-29 00:00:00')
+    self.assertEqual(claim_time({'time': '-0005-02-29T00:00:00Z'}), '0005-02-29 00:00:00 BC')
+    self.assertIsNone(claim_time({'time': '-0004-02-29T00:00:00Z'}))
+    self.assertIsNone(claim_time({'time': '+2001-04-31T00:00:00Z'}))
+    self.assertIsNone(claim_time({'time': '+2001-13-01T00:00:00Z'}))
+
+  def test_typed_claims(self):
+    claims = compact_claims({
+      'P1082': [snak('quantity', {'amount': '+800000', 'unit': '1'}),
+                snak('quantity', {'amount': '+921402', 'unit': '1'}, rank='preferred')],
+      'P2044': [snak('quantity', {'amount': '-2', 'unit': 'http://www.wikidata.org/entity/Q11573'}),
+                snak('quantity', {'amount': '+1', 'unit': 'http://www.wikidata.org/entity/Q11573'})],
+      'P571': [snak('time', {'time': '+1275-10-27T00:00:00Z', 'precision': 11}),
+               snak('time', {'time': '+1300-00-00T00:00:00Z', 'precision': 7}, rank='deprecated')],
+      'P31': [snak('wikibase-entityid', {'id': 'Q515'})],
+      'P17': [{'rank': 'normal', 'mainsnak': {'snaktype': 'novalue'}}],
+    })
+    self.assertEqual(typed_claims('Q727', claims), [
+      ('Q727', 'P1082', 921402.0, None, None, None),
+      ('Q727', 'P2044', -2.0, 'Q11573', None, None),
+      ('Q727', 'P2044', 1.0, 'Q11573', None, None),
+      ('Q727', 'P571', None, None, '1275-10-27 00:00:00', 11),
+    ])
+
+  def test_entity_refs(self):
+    claims = compact_claims({
+      'P31': [snak('wikibase-entityid', {'id': 'Q515'}), snak('wikibase-entityid', {'id': 'Q5119'})],
+      'P1647': [snak('wikibase-entityid', {'id': 'P361'})],
+      'P5137': [snak('wikibase-entityid', {'id': 'L7'})],
+      'P1082': [snak('quantity', {'amount': '+800000', 'unit': '1'})],
+    })
+    # just what the claims point to, not the properties themselves
+    self.assertEqual(entity_refs('Q727', claims), [('Q727', 'P361'), ('Q727', 'Q5119'), ('Q727', 'Q515')])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,13 +2,14 @@
 
 import argparse
 import sys
-import json
 import os
+import shutil
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import timedelta
 
-from subprocess import call
 from urllib.request import urlopen
 from urllib.error import URLError
 
@@ -19,20 +20,24 @@ if not THIS_DIR.endswith('/'):
     THIS_DIR = THIS_DIR + '/'
 sys.path.append(THIS_DIR)
 import wd_updater as Updater
+from name_store import open_names
+from projection import load_projection
 
-PROPS_FILE = '/properties.json'
 MAXREVID = '/maxrevid.txt'
 
 BASE_URL = 'https://dumps.wikimedia.org/other/incr/wikidatawiki/'
-STATUS_URL = BASE_URL + '%s/status.txt'
-MAXREVID_URL = BASE_URL + '%s/maxrevid.txt'
-DUMP_URL = BASE_URL + '%s/wikidatawiki-%s-pages-meta-hist-incr.xml.bz2'
+# relative to the base url
+STATUS_URL = '%s/status.txt'
+MAXREVID_URL = '%s/maxrevid.txt'
+DUMP_URL = '%s/wikidatawiki-%s-pages-meta-hist-incr.xml.bz2'
 
 MAXREVID_FILE = '/wikidatawiki-%s-maxrevid.txt'
 DUMP_FILE = '/wikidatawiki-%s-pages-meta-hist-incr.xml.bz2'
 
 STATUS_DONE = 'done:all'
 
+COPY_BUFFER = 1 << 20
+
 
 def read_url_resource(url):
     result = ''
@@ -47,72 +52,90 @@ def read_url_resource(url):
     return result
 
 
-def download(version, dump_path):
-    # save revision id for the future in case dump have to be reloaded
-    file_path = dump_path + MAXREVID_FILE % version
-    if not os.path.isfile(file_path):
-        params = ['wget', '-nv', '-O', file_path, MAXREVID_URL % version]
-        call(params)
-    else:
+def fetch(url, file_path):
+    """Download url to file_path, through a .part file so an interrupted download isn't mistaken for a
+    complete one."""
+    if os.path.isfile(file_path):
         print('File %s already exists, skip downloading' % file_path)
+        return
+    part_path = file_path + '.part'
+    with urlopen(url) as response, open(part_path, 'wb') as f:
+        shutil.copyfileobj(response, f, COPY_BUFFER)
+    os.replace(part_path, file_path)
 
-    file_path = dump_path + DUMP_FILE % version
-    if not os.path.isfile(file_path):
-        params = ['wget', '-nv', '-O', file_path,
-                  DUMP_URL % (version, version)]
-        call(params)
-    else:
-        print('File %s already exists, skip downloading' % file_path)
+
+def download(version, dump_path, base_url=BASE_URL):
+    # save revision id for the future in case dump have to be reloaded
+    fetch(base_url + MAXREVID_URL % version, dump_path + MAXREVID_FILE % version)
+    fetch(base_url + DUMP_URL % (version, version), dump_path + DUMP_FILE % version)
+
+
+def prepare(version, max_rev_id, dump_path, base_url=BASE_URL):
+    """Download the dump of version if it is complete and has revisions past max_rev_id. Returns its max
+    revision id, or None if there's nothing to apply."""
+    # check dump status (if it exists and is ready)
+    status = read_url_resource(base_url + STATUS_URL % version)
+    if status.strip() != STATUS_DONE:
+        return None
+    # check if this dump has any updates
+    rev_id = int(read_url_resource(base_url + MAXREVID_URL % version))
+    if rev_id <= max_rev_id:
+        print('Skip %s dump as DB already contains that revision' % version)
+        return None
+    download(version, dump_path, base_url)
+    return rev_id
 
 
-def update(version, dump_path, conn_str, schema, id_name_map):
+def update(version, dump_path, conn_str, schema, id_name_map, projection):
     if not conn_str or len(conn_str) == 0:
         return
 
     file_path = dump_path + DUMP_FILE % version
     conn, cursor = Updater.setup_db(conn_str)
-    Updater.parse(file_path, id_name_map, conn, cursor, schema)
+    Updater.parse(file_path, id_name_map, conn, cursor, schema, projection)
     conn.commit()
 
 
-def main(max_days, max_rev_id, dump_path, conn_str, schema):
-    id_name_map = {}
-    # this file is required for updates
+def main(max_days, max_rev_id, dump_path, conn_str, schema, prefetch=0, base_url=BASE_URL, apply=update):
+    """Apply the dumps of the last max_days days that have revisions past max_rev_id, oldest first. While
+    one is applied, the next prefetch days are checked and downloaded in the background (with the default of
+    0, one day at a time); they are still applied strictly in order, and maxrevid.txt only moves on once a
+    dump is applied completely."""
+    # the name store is required for updates
     # it is created by main WD import script during first time dump import
-    props_path = dump_path + PROPS_FILE
-    if os.path.isfile(props_path):
-        print('loading properties from file')
-        id_name_map = json.load(open(props_path))
-    else:
-        print('ERROR: properties.json file is missing')
+    id_name_map = open_names(dump_path, log=True)
+    if id_name_map is None:
+        print('ERROR: names.bin and properties.json files are missing')
         exit(-1)
+    projection = load_projection(dump_path)
     print('Loading dumps for', max_days, 'days', max_rev_id, dump_path)
 
-    day = timedelta(days=1)
-    start_date = date.today() - timedelta(days=max_days)
     today = date.today()
-    while start_date <= today:
-        # check dump status (if it exists and is ready)
-        date_str = start_date.strftime('%Y%m%d')
-
-        status = read_url_resource(STATUS_URL % date_str)
-        if status.strip() == STATUS_DONE:
-            # check if this dump has any updates
-            rev_id = int(read_url_resource(MAXREVID_URL % date_str))
-            if rev_id > max_rev_id:
-                # download dump
-                download(date_str, dump_path)
-
-                # parse and load dump into DB
-                update(date_str, dump_path, conn_str, schema, id_name_map)
+    days = iter([(today - timedelta(days=n)).strftime('%Y%m%d') for n in range(max_days, -1, -1)])
+    with ThreadPoolExecutor(max_workers=prefetch + 1) as executor:
+        pending = deque()
+
+        def submit():
+            date_str = next(days, None)
+            if date_str:
+                pending.append((date_str, executor.submit(prepare, date_str, max_rev_id, dump_path, base_url)))
+
+        for _ in range(prefetch + 1):
+            submit()
+        while pending:
+            date_str, future = pending.popleft()
+            rev_id = future.result()
+            if rev_id and rev_id > max_rev_id:
+                # parse and load dump into DB, a dump that was partly applied before continues where it stopped
+                apply(date_str, dump_path, conn_str, schema, id_name_map, projection)
 
                 max_rev_id = rev_id
                 write_revid(dump_path, rev_id)
-            else:
-                print('Skip %s dump as DB already contains that revision' % date_str)
-
-        start_date += day
+            # only now, so no more than prefetch days are fetched while one is applied
+            submit()
 
+    id_name_map.compact()
+    id_name_map.close()
     return max_rev_id
 
 
@@ -135,10 +158,15 @@ if __name__ == '__main__':
     parser.add_argument('dump_path', type=str, help='Location where to save BZipped wikipedia dumps')
     parser.add_argument('postgres', type=str, help='postgres connection string')
     parser.add_argument('schema', type=str, help='DB schema containing wikidata tables')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='check and download this many of the following days\' dumps while one is applied')
+    parser.add_argument('--base_url', type=str, default=BASE_URL,
+                        help='where to get the incremental dumps from')
 
     args = parser.parse_args()
 
     max_rev_id = read_revid(args.dump_path)
 
-    max_rev_id = main(args.max_days, max_rev_id, args.dump_path, args.postgres, args.schema)
-    write_revid(args.dump_path)
+    max_rev_id = main(args.max_days, max_rev_id, args.dump_path, args.postgres, args.schema, args.prefetch,
+                      args.base_url)
+    write_revid(args.dump_path, max_rev_id)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+from datetime import date, timedelta
+import functools
+import http.server
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import wd_downloader
+from name_store import NAMES_FILE, NameStoreWriter
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+
+class TestDownloader(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.served = os.path.join(self._tmp.name, 'served')
+    self.dump_path = os.path.join(self._tmp.name, 'dumps')
+    os.makedirs(self.dump_path)
+    NameStoreWriter().save(os.path.join(self.dump_path, NAMES_FILE))
+    self.server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(QuietHandler, directory=self.served))
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.base_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self._tmp.cleanup()
+
+  def add_day(self, days_ago, status, rev_id):
+    version = (date.today() - timedelta(days=days_ago)).strftime('%Y%m%d')
+    os.makedirs(os.path.join(self.served, version))
+    for name, content in (('status.txt', status), ('maxrevid.txt', str(rev_id)),
+                          ('wikidatawiki-%s-pages-meta-hist-incr.xml.bz2' % version, 'dump of ' + version)):
+      with open(os.path.join(self.served, version, name), 'w') as f:
+        f.write(content)
+    return version
+
+  def test_prefetch(self):
+    skipped = self.add_day(4, 'done:all', 90)
+    first = self.add_day(3, 'done:all', 110)
+    unfinished = self.add_day(2, 'in progress', 120)
+    second = self.add_day(1, 'done:all', 130)
+    applied = []
+
+    def apply(version, dump_path, conn_str, schema, id_name_map, projection):
+      with open(dump_path + wd_downloader.DUMP_FILE % version) as f:
+        applied.append((f.read(), wd_downloader.read_revid(dump_path)))
+
+    max_rev_id = wd_downloader.main(5, 100, self.dump_path, '', 'import', prefetch=2, base_url=self.base_url,
+                                    apply=apply)
+    self.assertEqual(max_rev_id, 130)
+    self.assertEqual(applied, [('dump of ' + first, 0), ('dump of ' + second, 110)])
+    self.assertEqual(wd_downloader.read_revid(self.dump_path), 130)
+    files = sorted(os.listdir(self.dump_path))
+    self.assertNotIn('wikidatawiki-%s-pages-meta-hist-incr.xml.bz2' % skipped, files)
+    self.assertNotIn('wikidatawiki-%s-pages-meta-hist-incr.xml.bz2' % unfinished, files)
+    self.assertFalse([name for name in files if name.endswith('.part')])
+
+  def test_concurrency(self):
+    for days_ago, rev_id in (4, 90), (3, 110), (2, 120), (1, 130):
+      self.add_day(days_ago, 'done:all', rev_id)
+    prepare = wd_downloader.prepare
+    lock = threading.Lock()
+
+    for prefetch, expected in (0, [3, 4, 5]), (2, [5, 6, 6]):
+      calls = {'started': 0, 'active': 0, 'max_active': 0}
+      applied = []
+
+      def counting_prepare(*args):
+        with lock:
+          calls['started'] += 1
+          calls['active'] += 1
+          calls['max_active'] = max(calls['max_active'], calls['active'])
+        try:
+          return prepare(*args)
+        finally:
+          with lock:
+            calls['active'] -= 1
+
+      def apply(*args):
+        # give whatever was submitted by now time to start
+        time.sleep(0.1)
+        with lock:
+          applied.append(calls['started'])
+
+      wd_downloader.write_revid(self.dump_path, 0)
+      with mock.patch.object(wd_downloader, 'prepare', counting_prepare):
+        wd_downloader.main(5, 100, self.dump_path, '', 'import', prefetch=prefetch, base_url=self.base_url,
+                           apply=apply)
+      # days 5 to 0 are checked in order, and a day is only submitted once the one prefetch days before it is
+      # applied, so at most that many have been started by then: without prefetch, nothing is fetched while a
+      # dump is applied
+      self.assertEqual(len(applied), len(expected))
+      for started, most in zip(applied, expected):
+        self.assertLessEqual(started, most)
+      if not prefetch:
+        self.assertEqual(applied, expected)
+      self.assertLessEqual(calls['max_active'], prefetch + 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,17 +1,21 @@
 #!/bin/python3
 
 import argparse
-import subprocess
+import os
 import xml.sax
 
 from collections import defaultdict
 import mwparserfromhell
 import psycopg2
-from psycopg2 import extras
 import re
 import json
-import os
 
+from checkpoint import Checkpoint
+from copy_writer import CopyWriter
+from dump_reader import DumpReader
+from name_store import entity_id, entity_key, entity_name, open_names
+from projection import Projection, load_projection
+from typed_claims import CLAIMS_COLUMNS, ENTITY_CLAIMS_COLUMNS, REFS_COLUMNS, compact_claims, entity_refs, typed_claims
 
 DATE_PARSE_RE = re.compile(
     r'([-+]?[0-9]+)-([0-9][0-9])-([0-9][0-9])T([0-9][0-9]):([0-9][0-9]):([0-9][0-9])Z?')
@@ -24,6 +28,14 @@ def setup_db(connection_string):
   return conn, cursor
 
 
+def uses_integer_ids(cursor, schema):
+  """Whether the import stored the entity ids as integers (import_wikidata --integer_ids)."""
+  cursor.execute('SELECT data_type FROM information_schema.columns '
+                 'WHERE table_schema = %s AND table_name = \'wikidata\' AND column_name = \'wikidata_id\'', (schema, ))
+  row = cursor.fetchone()
+  return bool(row) and row[0] == 'bigint'
+
+
 def map_value(value, id_name_map):
   if not value or not 'type' in value or not 'value' in value:
     return None
@@ -63,14 +75,44 @@ def map_value(value, id_name_map):
   return None
 
 
-def parse_props(d, id_name_map):
+def map_claims(claims, id_name_map):
+  """The properties for the (compacted) claims of an entity, keyed on property name."""
+  properties = {}
+  for prop_id, values in claims.items():
+    prop_name = id_name_map.get(prop_id)
+    if prop_name:
+      ranks = defaultdict(list)
+      for rank, datavalue in values:
+        data_value = map_value(datavalue, id_name_map)
+        if data_value:
+          lst = ranks[rank]
+          if datavalue.get('type') != 'wikibase-entityid':
+            del lst[:]
+          lst.append(data_value)
+      for r in 'preferred', 'normal', 'depricated':
+        value = ranks[r]
+        if value:
+          if len(value) == 1:
+            value = value[0]
+          else:
+            value = sorted(value)
+          properties[prop_name] = value
+          break
+  return properties
+
+
+def parse_props(d, id_name_map, projection=Projection()):
+  """projection should be the one the import was made with, see load_projection. Entities without an english
+  wikipedia page or label come back with just their id, they aren't stored."""
   if type(d) != dict:
-    return None, None, None, None, None, None
+    return None, None, None, None, None, None, None
   wikidata_id = d.get('id')
   labels = None
   title = None
+  label_map = None
   try:
-    labels = [d['labels'][x]['value'] for x in d.get('labels', {})]
+    label_map = projection.labels(d.get('labels'))
+    labels = [label_map[x]['value'] for x in label_map or {}]
     title = d['labels'].get('en', {}).get('value')
   except:
     pass
@@ -78,11 +120,12 @@ def parse_props(d, id_name_map):
   sitelinks = None
   wikipedia_id = None
   try:
-    sitelinks = [d.get('sitelinks')[x]['title']
-                 for x in d.get('sitelinks', {})]
+    sitelink_map = projection.sitelinks(d.get('sitelinks'))
+    sitelinks = [sitelink_map[x]['title']
+                 for x in sitelink_map or {}]
     wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
   except:
-    return None, None, None, None, None, None
+    return d.get('id'), None, None, None, None, None, None
 
   description = None
   try:
@@ -90,144 +133,369 @@ def parse_props(d, id_name_map):
   except:
     pass
 
-  properties = {}
-  properties['sitelinks'] = d.get('sitelinks')
-  properties['labels'] = d.get('labels')
+  properties = projection.properties(label_map, sitelink_map)
 
   if wikipedia_id and title and type(d['claims']) == dict:
-    for prop_id, claims in d['claims'].items():
-      prop_name = id_name_map.get(prop_id)
-      if prop_name:
-        ranks = defaultdict(list)
-        for claim in claims:
-          mainsnak = claim.get('mainsnak')
-          if mainsnak:
-            data_value = map_value(mainsnak.get('datavalue'), id_name_map)
-            if data_value:
-              lst = ranks[claim['rank']]
-              if mainsnak['datavalue'].get('type') != 'wikibase-entityid':
-                del lst[:]
-              lst.append(data_value)
-        for r in 'preferred', 'normal', 'depricated':
-          value = ranks[r]
-          if value:
-            if len(value) == 1:
-              value = value[0]
-            else:
-              value = sorted(value)
-            properties[prop_name] = value
-            break
-
+    properties.update(map_claims(compact_claims(d['claims']), id_name_map))
     return wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties
 
-  return None, None, None, None, None, None
-
-
-def update_DB(wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, conn, cursor, schema):
-  cursor.execute('INSERT INTO %s.wikidata (wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties)' % schema +
-                 'VALUES (%s, %s, %s, %s, %s, %s, %s)'
-                 'ON CONFLICT (wikidata_id) DO UPDATE SET wikipedia_id = EXCLUDED.wikipedia_id, title = EXCLUDED.title, labels = EXCLUDED.labels, sitelinks = EXCLUDED.sitelinks,'
-                 'description = EXCLUDED.description, properties = EXCLUDED.properties;',
-                 (wikipedia_id, title, wikidata_id, extras.Json(labels), extras.Json(sitelinks), description, extras.Json(properties)))
-
-  cursor.execute('INSERT into %s.geo (wikidata_id, geometry) ' % schema +
-                 'SELECT wikidata_id, ST_SETSRID(ST_MAKEPOINT((properties->\'coordinate location\'->>\'lng\')::DECIMAL, '
-                 '(properties->\'coordinate location\'->>\'lat\')::DECIMAL), 4326) AS geometry '
-                 'FROM %s.wikidata ' % schema +
-                 'WHERE properties->\'coordinate location\' IS NOT NULL AND wikidata_id = %s '
-                 'ON CONFLICT (wikidata_id) DO UPDATE SET geometry = EXCLUDED.geometry;',
-                 (wikidata_id, ))
-
-  cursor.execute('INSERT INTO %s.labels (label, wikidata_id) SELECT distinct(jsonb_array_elements_text(labels)), wikidata_id ' % schema +
-                 'FROM %s.wikidata ' % schema +
-                 'WHERE wikidata_id = %s ON CONFLICT (wikidata_id, label) DO NOTHING;',
-                 (wikidata_id, ))
-
-  cursor.execute('INSERT INTO %s.instance (wikidata_id, instance_of) ' % schema +
-                 'SELECT wikidata_id, lower(properties->>\'instance of\')::jsonb '
-                 'FROM %s.wikidata ' % schema +
-                 'WHERE jsonb_typeof(properties->\'instance of\') = \'array\' AND wikidata_id = %s '
-                 'ON CONFLICT (wikidata_id) DO UPDATE SET instance_of = EXCLUDED.instance_of;',
-                 (wikidata_id, ))
-  cursor.execute('INSERT INTO %s.instance (wikidata_id, instance_of) ' % schema +
-                 'SELECT wikidata_id, jsonb_build_array(lower(properties->>\'instance of\')) '
-                 'FROM %s.wikidata ' % schema +
-                 'WHERE jsonb_typeof(properties->\'instance of\') = \'string\' AND wikidata_id = %s '
-                 'ON CONFLICT (wikidata_id) DO UPDATE SET instance_of = EXCLUDED.instance_of;',
-                 (wikidata_id, ))
+  return wikidata_id, None, None, None, None, None, None
+
+
+# the columns of the entities staged by BatchUpdater
+BATCH_COLUMNS = ('wikipedia_id', 'title', 'wikidata_id', 'labels', 'sitelinks', 'description', 'properties')
+# and of the tables derived from their claims
+BATCH_DERIVED = {'claims': CLAIMS_COLUMNS, 'refs': REFS_COLUMNS, 'entity_claims': ENTITY_CLAIMS_COLUMNS}
+
+
+class BatchUpdater(object):
+  """Collects updated and deleted entities and applies them batch_size at a time: the batch is COPYed into
+  temp tables and wikidata, geo, labels, instance, claims, refs and entity_claims are each brought up to date
+  with a set-based statement or two. An entity that changes more than once in a batch is only applied as it
+  was last.
+
+  Rows in geo, labels, instance, claims, refs and entity_claims of the entities in a batch are replaced, so
+  values an entity lost disappear as well. wikidata_ids should be in the form the tables use, see
+  uses_integer_ids. Every batch is committed; before_commit is called right before, so progress can be recorded
+  with it.
+
+  Entities passed to renamed() got a new name. The rows that refer to them are added to the stale table, to
+  be made again by rematerialize. The rows in the batch are up to date and taken out of it, unless they refer
+  to an entity renamed in the same batch: they may have been made before the new name came in. Properties passed
+  to renamed_property() are renamed in the properties of every row instead; the rows with claims of a property
+  that had no name yet are added to stale.
+  """
+
+  def __init__(self, cursor, conn, schema, batch_size=1000, integer_ids=False, before_commit=None):
+    self._cursor = cursor
+    self._conn = conn
+    self.before_commit = before_commit
+    self._schema = schema
+    self._batch_size = batch_size
+    self._entities = {}
+    self._renamed = set()
+    self._renamed_properties = {}
+    id_type = 'BIGINT' if integer_ids else 'TEXT'
+    cursor.execute('CREATE TABLE IF NOT EXISTS %s.stale (wikidata_id %s PRIMARY KEY)' % (schema, id_type))
+    cursor.execute('CREATE TABLE IF NOT EXISTS %s.entity_claims (wikidata_id %s PRIMARY KEY, claims JSONB)' % (
+        schema, id_type))
+    # imports made before claims and refs were split out don't have them; the batch tables are made like them
+    cursor.execute('CREATE TABLE IF NOT EXISTS %s.claims (' % schema +
+                   '    wikidata_id %s,' % id_type +
+                   '    property TEXT,'
+                   '    quantity DOUBLE PRECISION,'
+                   '    unit TEXT,'
+                   '    time TIMESTAMP,'
+                   '    precision SMALLINT'
+                   ')')
+    cursor.execute('CREATE TABLE IF NOT EXISTS %s.refs (wikidata_id %s, ref %s)' % (schema, id_type, id_type))
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wd_batch ('
+                   '    wikipedia_id TEXT,'
+                   '    title TEXT,'
+                   '    wikidata_id %s,' % id_type +
+                   '    labels JSONB,'
+                   '    sitelinks JSONB,'
+                   '    description TEXT,'
+                   '    properties JSONB'
+                   ')')
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wd_batch_deleted (wikidata_id %s)' % id_type)
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wd_batch_renamed (ref %s)' % id_type)
+    for table in BATCH_DERIVED:
+      cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wd_batch_%s (LIKE %s.%s)' % (table, schema, table))
+    self.updated = 0
+    self.deleted = 0
+    self.stale = 0
+
+  def update(self, wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, claims=(),
+             refs=(), compact=None):
+    """claims and refs are the entity's rows for the claims and refs tables, see typed_claims. compact are its
+    compacted claims, which entity_claims keeps for rematerialize."""
+    derived = {'claims': claims, 'refs': refs,
+               'entity_claims': [(wikidata_id, json.dumps(compact))] if compact is not None else []}
+    self._entities[wikidata_id] = ((wikipedia_id, title, wikidata_id, json.dumps(labels), json.dumps(sitelinks),
+                                    description, json.dumps(properties)), derived)
+    self._added()
+
+  def delete(self, wikidata_id):
+    """Sometimes records get removed or merged."""
+    self._entities[wikidata_id] = None
+    self._added()
+
+  def renamed(self, wikidata_id):
+    self._renamed.add(wikidata_id)
+
+  def renamed_property(self, property_id, old_name, name):
+    """old_name is None for a property that had no name yet."""
+    old_name = self._renamed_properties.pop(property_id, (old_name, ))[0]
+    self._renamed_properties[property_id] = (old_name, name)
+
+  def _added(self):
+    if len(self._entities) >= self._batch_size:
+      self.flush()
+
+  def flush(self):
+    if not self._entities and not self._renamed and not self._renamed_properties:
+      return
+    schema = self._schema
+    cursor = self._cursor
+    rows = CopyWriter(cursor, self._conn, 'wd_batch', BATCH_COLUMNS, commit_every=float('inf'))
+    deleted = CopyWriter(cursor, self._conn, 'wd_batch_deleted', ('wikidata_id', ), commit_every=float('inf'))
+    renamed = CopyWriter(cursor, self._conn, 'wd_batch_renamed', ('ref', ), commit_every=float('inf'))
+    derived = {table: CopyWriter(cursor, self._conn, 'wd_batch_' + table, columns, commit_every=float('inf'))
+               for table, columns in BATCH_DERIVED.items()}
+    for wikidata_id, entity in self._entities.items():
+      if entity is None:
+        deleted.write((wikidata_id, ))
+        continue
+      row, entity_derived = entity
+      rows.write(row)
+      for table, derived_rows in entity_derived.items():
+        for derived_row in derived_rows:
+          derived[table].write(derived_row)
+    for ref in self._renamed:
+      renamed.write((ref, ))
+    for writer in [rows, deleted, renamed] + list(derived.values()):
+      writer.flush()
+    renamed_properties = self._renamed_properties
+    self.updated += rows.count
+    self.deleted += deleted.count
+    self._entities = {}
+    self._renamed = set()
+    self._renamed_properties = {}
+
+    batch_ids = 'SELECT wikidata_id FROM wd_batch UNION ALL SELECT wikidata_id FROM wd_batch_deleted'
+    cursor.execute('DELETE FROM %s.wikidata WHERE wikidata_id IN (SELECT wikidata_id FROM wd_batch_deleted)' % schema)
+    cursor.execute('INSERT INTO %s.wikidata (%s) ' % (schema, ', '.join(BATCH_COLUMNS)) +
+                   'SELECT %s FROM wd_batch ' % ', '.join(BATCH_COLUMNS) +
+                   'ON CONFLICT (wikidata_id) DO UPDATE SET wikipedia_id = EXCLUDED.wikipedia_id, title = EXCLUDED.title, '
+                   'labels = EXCLUDED.labels, sitelinks = EXCLUDED.sitelinks, description = EXCLUDED.description, '
+                   'properties = EXCLUDED.properties')
+    for table in ['geo', 'labels', 'instance'] + list(BATCH_DERIVED) + ['stale']:
+      cursor.execute('DELETE FROM %s.%s WHERE wikidata_id IN (%s)' % (schema, table, batch_ids))
+
+    cursor.execute('INSERT INTO %s.geo (wikidata_id, geometry) ' % schema +
+                   'SELECT wikidata_id, ST_SETSRID(ST_MAKEPOINT((properties->\'coordinate location\'->>\'lng\')::DECIMAL, '
+                   '(properties->\'coordinate location\'->>\'lat\')::DECIMAL), 4326) AS geometry '
+                   'FROM wd_batch WHERE properties->\'coordinate location\' IS NOT NULL')
+    cursor.execute('INSERT INTO %s.labels (wikidata_id, label) ' % schema +
+                   'SELECT DISTINCT wikidata_id, jsonb_array_elements_text(labels) FROM wd_batch')
+    cursor.execute('INSERT INTO %s.instance (wikidata_id, instance_of) ' % schema +
+                   'SELECT wikidata_id, lower(properties->>\'instance of\')::jsonb '
+                   'FROM wd_batch WHERE jsonb_typeof(properties->\'instance of\') = \'array\'')
+    cursor.execute('INSERT INTO %s.instance (wikidata_id, instance_of) ' % schema +
+                   'SELECT wikidata_id, jsonb_build_array(lower(properties->>\'instance of\')) '
+                   'FROM wd_batch WHERE jsonb_typeof(properties->\'instance of\') = \'string\'')
+    for table, columns in BATCH_DERIVED.items():
+      cursor.execute('INSERT INTO %s.%s (%s) SELECT %s FROM wd_batch_%s' % (
+          schema, table, ', '.join(columns), ', '.join(columns), table))
+    if renamed.count:
+      # the rows in this batch may have been made before the name came in too, so they're not left out
+      cursor.execute('INSERT INTO %s.stale (wikidata_id) ' % schema +
+                     'SELECT DISTINCT wikidata_id FROM %s.refs WHERE ref IN (SELECT ref FROM wd_batch_renamed) ' % schema +
+                     'ON CONFLICT DO NOTHING')
+      self.stale += max(cursor.rowcount, 0)
+    new_properties = []
+    for property_id, (old_name, name) in sorted(renamed_properties.items()):
+      if old_name is None:
+        new_properties.append(property_id)
+      elif old_name != name:
+        cursor.execute('UPDATE ' + schema + '.wikidata SET properties = (properties - %s) || '
+                       'jsonb_build_object(%s, properties -> %s) WHERE properties ? %s',
+                       (old_name, name, old_name, old_name))
+    if new_properties:
+      # rows made while the property had no name left it out
+      cursor.execute('INSERT INTO ' + schema + '.stale (wikidata_id) '
+                     'SELECT wikidata_id FROM ' + schema + '.entity_claims WHERE claims ?| %s '
+                     'ON CONFLICT DO NOTHING', (new_properties, ))
+      self.stale += max(cursor.rowcount, 0)
+    cursor.execute('TRUNCATE wd_batch, wd_batch_deleted, wd_batch_renamed, %s' % ', '.join(
+        'wd_batch_' + table for table in BATCH_DERIVED))
+    if self.before_commit:
+      self.before_commit()
+    self._conn.commit()
+
+
+def update_entity(batch, wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, claims,
+                  integer_ids=False):
+  """Pass an entity to batch along with the rows derived from its (compacted) claims. wikidata_id is the text
+  id, it's converted if the tables use integer_ids. Returns the id as passed to batch."""
+  refs = entity_refs(wikidata_id, claims)
+  if integer_ids:
+    wikidata_id = entity_key(wikidata_id)
+    refs = [(wikidata_id, entity_key(ref)) for _, ref in refs]
+  batch.update(wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties,
+               typed_claims(wikidata_id, claims), refs, claims)
+  return wikidata_id
+
+
+def apply_entity(batch, data, id_name_map, projection=Projection(), integer_ids=False):
+  """Pass the entity with json data to batch and record its name in id_name_map, a NamesLog. Raises a
+  ValueError if data isn't an entity we can store. Entities merged into another one are left as a redirect,
+  {"entity": "Q3", "redirect": "Q1"}, and deleted."""
+  if isinstance(data, dict) and 'redirect' in data:
+    merged = data.get('entity')
+    if entity_key(merged) is None:
+      raise ValueError('%r is not an entity' % merged)
+    batch.delete(entity_key(merged) if integer_ids else merged)
+    return merged
+  entity_id = data.get('id') if isinstance(data, dict) else None
+  name = entity_name(data) if entity_id else None
+  old_name = id_name_map.get(entity_id) if name else None
+  if name and id_name_map.set(entity_id, name):
+    batch.renamed(entity_key(entity_id) if integer_ids else entity_id)
+    if entity_id.startswith('P'):
+      batch.renamed_property(entity_id, old_name, name)
+
+  wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties = parse_props(
+      data, id_name_map, projection)
+  # print(wikipedia_id, title, wikidata_id, description)
+  if wikipedia_id:
+    wikidata_id = update_entity(batch, wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties,
+                                compact_claims(data['claims']), integer_ids)
+  elif entity_key(wikidata_id) is not None:
+    # sometimes records get removed/merged, or lose their english wikipedia page
+    batch.delete(entity_key(wikidata_id) if integer_ids else wikidata_id)
+  else:
+    raise ValueError('%r is not an entity' % wikidata_id)
+  return wikidata_id
 
 
 class WikiXmlHandler(xml.sax.handler.ContentHandler):
-  def __init__(self, cursor, conn, schema, id_name_map):
+  """Applies the pages of an incremental dump to batch. The dump has every revision made to a page that day;
+  only the newest one is decoded and applied. The first skip_pages pages are passed over, they were applied
+  before. pages counts the pages read, including the one being applied, and revision is the newest revision
+  of the last page applied."""
+
+  def __init__(self, batch, id_name_map, projection=Projection(), integer_ids=False, skip_pages=0):
     xml.sax.handler.ContentHandler.__init__(self)
-    self._db_cursor = cursor
-    self._db_conn = conn
-    self._db_schema = schema
+    self._batch = batch
     self._id_name_map = id_name_map
+    self._projection = projection
+    self._integer_ids = integer_ids
+    self._skip_pages = skip_pages
     self._count = 0
+    self.revisions = 0
+    self.pages = 0
+    self.revision = None
     self.reset()
 
   def reset(self):
     self._buffer = []
     self._state = None
     self._values = {}
+    self._revision = None
+    # (revision id, text) of the newest revision of the page so far
+    self._latest = None
 
   def startElement(self, name, attrs):
+    if name == 'revision':
+      self._revision = {}
     if name in ('title', 'text', 'id'):
       self._state = name
 
   def endElement(self, name):
     if name == self._state:
-      if name not in self._values:
-        self._values[name] = ''.join(self._buffer)
+      values = self._values if self._revision is None else self._revision
+      if name not in values:
+        values[name] = ''.join(self._buffer)
       self._state = None
       self._buffer = []
 
     if name == 'revision':
-      try:
-        data = self._values['text']
-        data = json.loads(data)
-
-        wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties = parse_props(
-            data, self._id_name_map)
-        # print(wikipedia_id, title, wikidata_id, description)
-        if wikipedia_id:
-            update_DB(wikipedia_id, title, wikidata_id, labels, sitelinks, description,
-                      properties, self._db_conn, self._db_cursor, self._db_schema)
-        else:
-            # sometimes records get removed/merged
-            delete_one(wikidata_id, self._db_conn,
-                       self._db_cursor, self._db_schema)
-
-        self._count += 1
-        if self._count % 100000 == 0:
-            print(self._count, wikidata_id)
-            # self._db_conn.commit()
-      except mwparserfromhell.parser.ParserError:
-        print('mwparser error for:', self._values['title'])
-      except ValueError:
-        # print('failed to parse json', wikidata_id)
-        pass
-      self._values = {}
+      self.revisions += 1
+      revision_id = int(self._revision.get('id') or 0)
+      if 'text' in self._revision and (self._latest is None or revision_id > self._latest[0]):
+        self._latest = (revision_id, self._revision['text'])
+      self._revision = None
 
     if name == 'page':
+      self.pages += 1
+      if self._latest and self.pages > self._skip_pages:
+        self.revision = self._latest[0]
+        self._apply(self._latest[1])
       self.reset()
 
+  def _apply(self, text):
+    try:
+      wikidata_id = apply_entity(self._batch, json.loads(text), self._id_name_map, self._projection,
+                                 self._integer_ids)
+
+      self._count += 1
+      if self._count % 100000 == 0:
+          print(self._count, wikidata_id)
+    except mwparserfromhell.parser.ParserError:
+      print('mwparser error for:', self._values['title'])
+    except ValueError:
+      # print('failed to parse json', wikidata_id)
+      pass
+
   def characters(self, content):
     if self._state:
       self._buffer.append(content)
 
 
-def parse(dump, id_name_map, conn, cursor, schema):
+def parse(dump, id_name_map, conn, cursor, schema, projection=Projection(), batch_size=1000):
+  """Apply the revisions in dump, batch_size entities at a time (see BatchUpdater). Every batch is committed
+  along with a checkpoint of the pages applied, named after the dump, so a dump that was only partly applied
+  continues where it stopped and a dump that was applied completely is skipped. New names go to id_name_map,
+  a NamesLog, which is flushed with every commit."""
+  checkpoint = Checkpoint(cursor, 'wd_update/' + os.path.basename(dump))
+  if checkpoint.data.get('complete'):
+    print(dump, 'was already applied')
+    return
+  if checkpoint.position:
+    print('Resuming after page', checkpoint.position, 'revision', checkpoint.data.get('revision'))
   parser = xml.sax.make_parser()
-  xmlHandler = WikiXmlHandler(cursor, conn, schema, id_name_map)
+  integer_ids = uses_integer_ids(cursor, schema)
+  batch = BatchUpdater(cursor, conn, schema, batch_size, integer_ids)
+  xmlHandler = WikiXmlHandler(batch, id_name_map, projection, integer_ids, checkpoint.position)
+
+  def save_checkpoint():
+    id_name_map.flush()
+    checkpoint.save(xmlHandler.pages, data={'revision': xmlHandler.revision})
+
+  batch.before_commit = save_checkpoint
   parser.setContentHandler(xmlHandler)
 
-  for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
-    try:
-      parser.feed(line)
-    except StopIteration:
+  with DumpReader(dump) as reader:
+    for chunk in reader.chunks():
+      try:
+        parser.feed(chunk)
+      except StopIteration:
+        break
+  batch.flush()
+  id_name_map.flush()
+  checkpoint.save(xmlHandler.pages, data={'revision': xmlHandler.revision, 'complete': True})
+  conn.commit()
+  print('Updated', batch.updated, 'and deleted', batch.deleted, 'entities, from', xmlHandler.revisions,
+        'revisions.', batch.stale, 'rows refer to renamed entities')
+
+
+def rematerialize(id_name_map, conn, cursor, schema, projection=Projection(), batch_size=1000):
+  """Make the rows in the stale table again from the claims kept in entity_claims, with the names id_name_map has
+  now. This needs no dump and no network: only the properties made from the claims change. Stale rows without
+  kept claims, from an import that predates entity_claims, stay until their entity changes."""
+  integer_ids = uses_integer_ids(cursor, schema)
+  batch = BatchUpdater(cursor, conn, schema, batch_size, integer_ids)
+  # the properties that aren't made from claims, see Projection.properties
+  copies = projection.properties({}, {})
+  made = 0
+  while True:
+    cursor.execute('SELECT w.wikipedia_id, w.title, w.wikidata_id, w.labels, w.sitelinks, w.description, '
+                   'w.properties, c.claims FROM %s.stale s JOIN %s.wikidata w USING (wikidata_id) '
+                   'JOIN %s.entity_claims c USING (wikidata_id) LIMIT %d' % (schema, schema, schema, batch_size))
+    rows = cursor.fetchall()
+    if not rows:
       break
+    for wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, claims in rows:
+      properties = {key: value for key, value in properties.items() if key in copies}
+      properties.update(map_claims(claims, id_name_map))
+      update_entity(batch, wikipedia_id, title, entity_id(wikidata_id) if integer_ids else wikidata_id, labels,
+                    sitelinks, description, properties, claims, integer_ids)
+    # which takes them out of stale
+    batch.flush()
+    made += len(rows)
+  print('Made', made, 'stale rows again')
 
 
 if __name__ == '__main__':
@@ -236,24 +504,30 @@ if __name__ == '__main__':
   parser.add_argument('postgres', type=str, help='postgres connection string')
   parser.add_argument('schema', type=str,
                       help='DB schema containing wikidata tables')
-  parser.add_argument('dump', type=str, help='BZipped wikipedia dump')
+  parser.add_argument('dump', type=str, nargs='?', help='BZipped wikipedia dump')
+  parser.add_argument('--batch_size', type=int, default=1000,
+                      help='apply the changed entities this many at a time')
+  parser.add_argument('--rematerialize', action='store_true',
+                      help='afterwards, make the rows that refer to renamed entities again from their kept claims')
 
-  id_name_map = {}
-  # this file is required for updates
+  # the name store is required for updates
   # it is created by main WD import script during first time dump import
-  props_path = './properties.json'
-  if os.path.isfile(props_path):
-      print('loading properties from file')
-      id_name_map = json.load(open(props_path))
-  else:
-      print('ERROR: properties.json file is missing')
+  id_name_map = open_names('.', log=True)
+  if id_name_map is None:
+      print('ERROR: names.bin and properties.json files are missing')
       exit(-1)
 
   args = parser.parse_args()
   print('Setup db')
   conn, cursor = setup_db(args.postgres)
 
-  print('Parsing...')
-  parse(args.dump, id_name_map, conn, cursor, args.schema)
+  projection = load_projection('.')
+  if args.dump:
+    print('Parsing...')
+    parse(args.dump, id_name_map, conn, cursor, args.schema, projection, args.batch_size)
+  if args.rematerialize:
+    rematerialize(id_name_map, conn, cursor, args.schema, projection, args.batch_size)
 
   conn.commit()
+  id_name_map.compact()
+  id_name_map.close()
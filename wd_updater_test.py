@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+from collections import defaultdict
+import json
+import os
+import tempfile
+import unittest
+from xml.sax.saxutils import escape
+
+from name_store import NAMES_FILE, NAMES_LOG, NameStoreWriter, open_names
+from wd_updater import parse, rematerialize
+
+NAMES = {'P31': 'instance of', 'Q2': 'city'}
+
+
+def entity(entity_id, title, label, claims=None):
+  return {'id': entity_id, 'labels': {'en': {'value': label}}, 'descriptions': {},
+          'sitelinks': {'enwiki': {'title': title}}, 'claims': claims or {}}
+
+
+def revision_xml(revision_id, d):
+  return '<revision><id>%d</id><contributor><id>7</id></contributor><text>%s</text></revision>' % (
+      revision_id, escape(json.dumps(d)))
+
+
+def page_xml(d, revisions):
+  return '<page><title>%s</title><id>%s</id>%s</page>' % (d['id'], d['id'][1:], ''.join(revisions))
+
+
+def revisions_xml(entities):
+  return '<mediawiki>%s</mediawiki>' % ''.join(
+      page_xml(d, [revision_xml(idx, d)]) for idx, d in enumerate(entities))
+
+
+class FakeCursor():
+  def __init__(self, id_type='text', checkpoint=None):
+    self.id_type = id_type
+    self.checkpoint = checkpoint
+    self.statements = []
+    self.copied = defaultdict(list)
+    self.stale = []
+    self.params = []
+    self.rowcount = 0
+    self._result = None
+
+  def execute(self, sql, params=None):
+    self.statements.append(sql)
+    self.params.append(params)
+    if 'information_schema' in sql:
+      self._result = (self.id_type, )
+    elif sql.startswith('SELECT position'):
+      self._result = self.checkpoint
+    elif sql.startswith('INSERT INTO import.checkpoint'):
+      self.checkpoint = (params[1], params[2], params[3].adapted)
+
+  def fetchone(self):
+    return self._result
+
+  def fetchall(self):
+    # the stale rows are taken out once they're made again
+    rows, self.stale = self.stale, []
+    return rows
+
+  def copy_expert(self, sql, f, size=8192):
+    table = sql.split()[1]
+    self.copied[table] += [line.split('\t') for line in f.read().splitlines()]
+    self.statements.append('COPY ' + table)
+    self.params.append(None)
+
+
+class FakeConn():
+  def commit(self):
+    pass
+
+
+class TestUpdater(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    names = NameStoreWriter()
+    for entity_id, name in NAMES.items():
+      names[entity_id] = name
+    names.save(os.path.join(self._tmp.name, NAMES_FILE))
+    self.names = open_names(self._tmp.name, log=True)
+
+  def tearDown(self):
+    self.names.close()
+    self._tmp.cleanup()
+
+  def parse(self, entities, id_type='text', batch_size=1000, xml=None, checkpoint=None):
+    cursor = FakeCursor(id_type, checkpoint)
+    path = os.path.join(self._tmp.name, 'incr.xml')
+    with open(path, 'w') as f:
+      f.write(xml or revisions_xml(entities))
+    parse(path, self.names, FakeConn(), cursor, 'import', batch_size=batch_size)
+    return cursor
+
+  def test_batches(self):
+    instance = {'P31': [{'rank': 'normal', 'mainsnak': {'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q2'}}}}]}
+    cursor = self.parse([entity('Q1', 'Amsterdam', 'Amsterdam'),
+                         entity('Q3', 'Rotterdam', 'Rotterdam'),
+                         entity('Q1', 'Amsterdam', 'Amsterdam', instance),
+                         entity('Q4', 'Utrecht', 'Utrecht'),
+                         entity('Q5', 'Den Haag', 'The Hague')], batch_size=3)
+    # Q1 was changed twice in the first batch, only its last revision is applied
+    self.assertEqual([row[2] for row in cursor.copied['wd_batch']], ['Q1', 'Q3', 'Q4', 'Q5'])
+    self.assertEqual(json.loads(cursor.copied['wd_batch'][0][6])['instance of'], 'city')
+    upserts = [sql for sql in cursor.statements if sql.startswith('INSERT INTO import.wikidata')]
+    self.assertEqual(len(upserts), 2)
+    self.assertEqual(cursor.statements.count(
+        'TRUNCATE wd_batch, wd_batch_deleted, wd_batch_renamed, wd_batch_claims, wd_batch_refs, '
+        'wd_batch_entity_claims'), 2)
+    self.assertEqual(cursor.copied['wd_batch_refs'], [['Q1', 'Q2']])
+    self.assertEqual([row[0] for row in cursor.copied['wd_batch_entity_claims']], ['Q1', 'Q3', 'Q4', 'Q5'])
+    self.assertEqual(json.loads(cursor.copied['wd_batch_entity_claims'][0][1]),
+                     {'P31': [['normal', {'type': 'wikibase-entityid', 'value': {'id': 'Q2'}}]]})
+    self.assertEqual(cursor.checkpoint, (5, None, {'revision': 4, 'complete': True}))
+
+  def test_resume(self):
+    entities = [entity('Q1', 'Amsterdam', 'Amsterdam'), entity('Q3', 'Rotterdam', 'Rotterdam'),
+                entity('Q4', 'Utrecht', 'Utrecht')]
+    cursor = self.parse(entities, checkpoint=(2, None, {'revision': 1}))
+    self.assertEqual([row[2] for row in cursor.copied['wd_batch']], ['Q4'])
+    self.assertEqual(cursor.checkpoint, (3, None, {'revision': 2, 'complete': True}))
+
+    cursor = self.parse(entities, checkpoint=cursor.checkpoint)
+    self.assertEqual(cursor.copied, {})
+
+  def test_latest_revision(self):
+    old, new = entity('Q1', 'Amsterdam', 'Amsterdam'), entity('Q1', 'Amsterdam', 'Mokum')
+    xml = '<mediawiki>%s</mediawiki>' % page_xml(old, [revision_xml(11, old), revision_xml(12, new),
+                                                       revision_xml(10, old)])
+    cursor = self.parse(None, xml=xml)
+    self.assertEqual([json.loads(row[3]) for row in cursor.copied['wd_batch']], [['Mokum']])
+
+  def test_deleted(self):
+    unlinked = entity('Q3', 'Rotterdam', 'Rotterdam')
+    unlinked['sitelinks'] = {'nlwiki': {'title': 'Rotterdam'}}
+    lexeme = {'id': 'L1', 'lemmas': {}}
+    cursor = self.parse([entity('Q1', 'Amsterdam', 'Amsterdam'), unlinked, lexeme])
+    # Q3 lost its english wikipedia page, so its rows go
+    self.assertEqual([row[2] for row in cursor.copied['wd_batch']], ['Q1'])
+    self.assertEqual(cursor.copied['wd_batch_deleted'], [['Q3']])
+    self.assertTrue(any(sql.startswith('DELETE FROM import.wikidata') for sql in cursor.statements))
+
+  def test_redirect(self):
+    # Q3 was merged into Q1, its page now holds a redirect
+    xml = '<mediawiki>%s</mediawiki>' % page_xml({'id': 'Q3'}, [revision_xml(5, {'entity': 'Q3', 'redirect': 'Q1'})])
+    cursor = self.parse(None, xml=xml)
+    self.assertEqual(cursor.copied['wd_batch_deleted'], [['Q3']])
+    cursor = self.parse(None, xml=xml, id_type='bigint')
+    self.assertEqual(cursor.copied['wd_batch_deleted'], [['3']])
+
+  def test_names(self):
+    town = {'id': 'Q2', 'labels': {'en': {'value': 'town'}}, 'descriptions': [], 'sitelinks': [], 'claims': []}
+    cursor = self.parse([entity('Q1', 'Amsterdam', 'Amsterdam'), town, entity('Q5', 'Haarlem', 'Haarlem')])
+    # Q2 has no english wikipedia page, but it is renamed
+    self.assertEqual([row[2] for row in cursor.copied['wd_batch']], ['Q1', 'Q5'])
+    self.assertEqual(cursor.copied['wd_batch_deleted'], [['Q2']])
+    self.assertEqual(sorted(cursor.copied['wd_batch_renamed']), [['Q1'], ['Q2'], ['Q5']])
+    self.assertTrue(any(sql.startswith('INSERT INTO import.stale') for sql in cursor.statements))
+    self.assertEqual(self.names.get('Q2'), 'town')
+    with open(os.path.join(self._tmp.name, NAMES_LOG)) as f:
+      self.assertEqual([json.loads(line) for line in f], [['Q1', 'Amsterdam'], ['Q2', 'town'], ['Q5', 'Haarlem']])
+
+    # nothing changed the second time
+    cursor = self.parse([entity('Q1', 'Amsterdam', 'Amsterdam'), town])
+    self.assertEqual(cursor.copied['wd_batch_renamed'], [])
+
+  def test_properties(self):
+    instance = {'P31': [{'rank': 'normal', 'mainsnak': {'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q2'}}}}]}
+    cursor = self.parse([{'id': 'P31', 'labels': {'en': {'value': 'is a'}}, 'descriptions': {}, 'claims': {}},
+                         {'id': 'P17', 'labels': {'en': {'value': 'country'}}, 'descriptions': {}, 'claims': {}},
+                         entity('Q1', 'Amsterdam', 'Amsterdam', instance)])
+    self.assertEqual(json.loads(cursor.copied['wd_batch'][0][6])['is a'], 'city')
+    # the rows with the renamed property have it renamed in place, not made again
+    renames = [params for sql, params in zip(cursor.statements, cursor.params)
+               if sql.startswith('UPDATE import.wikidata')]
+    self.assertEqual(renames, [('instance of', 'is a', 'instance of', 'instance of')])
+    # while the rows with claims of the new one are
+    stale = [params for sql, params in zip(cursor.statements, cursor.params)
+             if sql.startswith('INSERT INTO import.stale') and 'entity_claims' in sql]
+    self.assertEqual(stale, [(['P17'], )])
+
+  def test_rematerialize(self):
+    cursor = FakeCursor()
+    claims = {'P31': [['normal', {'type': 'wikibase-entityid', 'value': {'id': 'Q2'}}]],
+              'P1082': [['normal', {'type': 'quantity', 'value': {'amount': '+921402', 'unit': '1'}}]]}
+    cursor.stale = [('Amsterdam', 'Amsterdam', 'Q1', ['Amsterdam'], ['Amsterdam'], 'capital',
+                     {'instance of': 'town', 'labels': {'en': {'value': 'Amsterdam'}}}, claims)]
+    self.names.set('Q2', 'capital city')
+
+    rematerialize(self.names, FakeConn(), cursor, 'import')
+    self.assertEqual([row[:6] for row in cursor.copied['wd_batch']],
+                     [['Amsterdam', 'Amsterdam', 'Q1', '["Amsterdam"]', '["Amsterdam"]', 'capital']])
+    self.assertEqual(json.loads(cursor.copied['wd_batch'][0][6]),
+                     {'instance of': 'capital city', 'labels': {'en': {'value': 'Amsterdam'}}})
+    self.assertEqual(cursor.copied['wd_batch_claims'], [['Q1', 'P1082', '921402.0', '\\N', '\\N', '\\N']])
+    self.assertEqual(cursor.copied['wd_batch_refs'], [['Q1', 'Q2']])
+    # until the stale table is empty
+    self.assertEqual(len([sql for sql in cursor.statements if 'FROM import.stale s' in sql]), 2)
+
+  def test_integer_ids(self):
+    cursor = self.parse([entity('Q1', 'Amsterdam', 'Amsterdam')], id_type='bigint')
+    self.assertEqual(cursor.copied['wd_batch'][0][2], '1')
+    self.assertIn('CREATE TEMP TABLE IF NOT EXISTS wd_batch_deleted (wikidata_id BIGINT)', cursor.statements)
+
+    self.assertIn('CREATE TABLE IF NOT EXISTS import.refs (wikidata_id BIGINT, ref BIGINT)', cursor.statements)
+
+  def test_older_import(self):
+    # an import from before claims and refs were split out gets them before the batch tables are made like them
+    statements = self.parse([entity('Q1', 'Amsterdam', 'Amsterdam')]).statements
+    created = [i for i, sql in enumerate(statements) if sql.startswith('CREATE TABLE IF NOT EXISTS import.claims (')]
+    self.assertEqual(len(created), 1)
+    like = statements.index('CREATE TEMP TABLE IF NOT EXISTS wd_batch_claims (LIKE import.claims)')
+    self.assertLess(created[0], like)
+    self.assertIn('CREATE TABLE IF NOT EXISTS import.refs (wikidata_id TEXT, ref TEXT)', statements)
+
+
+if __name__ == '__main__':
+  unittest.main()